@@ -0,0 +1,422 @@
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+import game_session
+import server
+from llm_client import close_llm_client, get_llm_client
+from model_routing import RouteStats
+from mock_llm_server import LATENCY_PRESETS, MockConfig, MockLLMServer
+from script_content import CHARACTERS
+
+# ----------------- 基准测试配置 -----------------
+LAG_SAMPLE_INTERVAL = 0.01  # 事件循环延迟采样间隔（秒）
+HUMAN_POLL_INTERVAL = 0.005 # 模拟的人类玩家检查待办动作的间隔（秒）
+# 最终指认阶段 DM 依次发出真相与结算两条 turn 消息，收到第二条即视为一局结束
+FINAL_TURN_MESSAGES = 2
+
+# 当前协程所属的对局；asyncio.create_task 会复制上下文，所以 advance_game 派生的任务也能归到同一局
+_current_game: contextvars.ContextVar[Optional["GameRun"]] = contextvars.ContextVar("bench_game", default=None)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def busy_time(intervals: List[Tuple[float, float]], start: float, end: float) -> float:
+    """[start, end) 内被至少一个区间覆盖的总时长（并发调用只算一次）。"""
+    clipped = sorted((max(a, start), min(b, end)) for a, b in intervals if b > start and a < end)
+    total, cursor = 0.0, start
+    for a, b in clipped:
+        if b <= cursor:
+            continue
+        total += b - max(a, cursor)
+        cursor = b
+    return total
+
+
+class GameRun:
+    """一局被测对局：阶段切换时间点、该局发起的 LLM 调用、人类玩家的等待时间。"""
+
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.session = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.stage_marks: List[Tuple[str, float]] = []
+        self.calls: List[Dict[str, Any]] = []
+        self.human_waits: List[Tuple[float, float]] = []
+        self.turn_messages = 0
+        self.done = asyncio.Event()
+
+    def mark_stage(self, stage: str):
+        self.stage_marks.append((stage, time.perf_counter()))
+
+    def on_emit(self, event: str, data):
+        now = time.perf_counter()
+        if event == "new_message" and isinstance(data, dict) and data.get("type") == "turn":
+            self.turn_messages += 1
+            if self.turn_messages >= FINAL_TURN_MESSAGES:
+                self.finished = now
+                self.done.set()
+
+    def stage_report(self) -> List[Dict[str, Any]]:
+        end_time = self.finished or time.perf_counter()
+        intervals = [(c["started"], c["started"] + c["duration"]) for c in self.calls]
+        report = []
+        for i, (stage, start) in enumerate(self.stage_marks):
+            end = self.stage_marks[i + 1][1] if i + 1 < len(self.stage_marks) else end_time
+            wall = end - start
+            llm = busy_time(intervals, start, end)
+            human = busy_time(self.human_waits, start, end)
+            report.append({
+                "stage": stage,
+                "wall": wall,
+                "llm_busy": llm,
+                "human_wait": human,
+                "engine": max(0.0, wall - llm - human),
+                "llm_calls": sum(1 for c in self.calls if start <= c["started"] < end),
+            })
+        return report
+
+
+class BenchSession(game_session.GameSession):
+    """阶段切换在广播之前记录时间点，不受出站队列合并发送的延迟影响。"""
+
+    async def publish(self, event: str, data: dict):
+        run = _current_game.get()
+        if run is not None and event == "game_state_update" and "current_stage" in data:
+            run.mark_stage(data["current_stage"])
+        await super().publish(event, data)
+
+
+class BenchSio:
+    """替代 socketio.AsyncServer：不经过网络，只把发给各局模拟连接的事件交给对应的 GameRun 记录。"""
+
+    def __init__(self):
+        self.runs: Dict[str, GameRun] = {}
+        self.emits = 0
+        self.emit_bytes = 0
+
+    async def emit(self, event, data=None, room=None, **kwargs):
+        self.emits += 1
+        self.emit_bytes += len(json.dumps(data, ensure_ascii=False, default=str))
+        run = self.runs.get(room)
+        if run is not None:
+            run.on_emit(event, data)
+
+
+class LoopLagSampler:
+    """周期性地 sleep 固定间隔，记录实际唤醒比预期晚了多少，即事件循环被阻塞的时长。"""
+
+    def __init__(self, interval: float = LAG_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def report(self) -> Dict[str, float]:
+        return {
+            "samples": len(self.samples),
+            "p50_ms": percentile(self.samples, 50) * 1000,
+            "p99_ms": percentile(self.samples, 99) * 1000,
+            "max_ms": max(self.samples, default=0.0) * 1000,
+        }
+
+
+async def play_human(run: GameRun, human_ids: List[str], think_time: float):
+    """模拟人类玩家：看到轮到自己的待办动作就立即（或等待 think_time 后）提交。"""
+    game_state = run.session.game_state
+    others = [pid for pid in CHARACTERS if pid != "dm"]
+    waiting_since: Dict[str, float] = {}
+    while not run.done.is_set():
+        await asyncio.sleep(HUMAN_POLL_INTERVAL)
+        pending = game_state["pending_action"]
+        for pid in human_ids:
+            targets = [o for o in others if o != pid]
+            action = None
+            if pending == f"statement_{pid}":
+                action = {"type": "submit_statement", "payload": {"statement": "我当时一直在驾驶室，没有离开过。"}}
+            elif pending == "vote" and pid not in game_state["votes"]:
+                action = {"type": "submit_vote", "payload": {"trust": targets[0], "suspect": targets[1]}}
+            elif pending == "accuse" and pid not in game_state["accusations"]:
+                action = {"type": "submit_accusation", "payload": {"accused_id": targets[1]}}
+            if action is None:
+                continue
+            key = f"{pid}:{pending}:{game_state['stage']}"
+            since = waiting_since.setdefault(key, time.perf_counter())
+            if time.perf_counter() - since < think_time:
+                continue
+            await server.apply_player_action(run.session, pid, action)
+            run.human_waits.append((since, time.perf_counter()))
+
+
+async def run_game(sio: BenchSio, run: GameRun, llm_url: str, think_time: float, timeout: float):
+    _current_game.set(run)
+    run.session = BenchSession(run.room_id, sio)
+    for agent in [run.session.dm_agent, *run.session.ai_agents.values()]:
+        agent.api_url = llm_url
+    human_ids = [pid for pid, info in CHARACTERS.items() if not info["is_ai"]]
+    # 模拟第一位人类玩家的连接：事件经由它的出站队列送到 BenchSio
+    bench_sid = f"bench:{run.room_id}"
+    run.session.attach(human_ids[0], bench_sid)
+    sio.runs[bench_sid] = run
+
+    run.started = time.perf_counter()
+    await server.apply_player_action(run.session, human_ids[0], {"type": "start_game"})
+    human = asyncio.create_task(play_human(run, human_ids, think_time))
+    try:
+        await asyncio.wait_for(run.done.wait(), timeout)
+    except asyncio.TimeoutError:
+        print(f"[bench] 对局 {run.room_id} 在 {timeout}s 内未完成，停在阶段 {run.session.game_state['stage']}")
+    finally:
+        human.cancel()
+    # 等待阶段摘要等后台任务结束，它们同样计入本局的 LLM 调用
+    await run.session.scheduler.wait_background()
+
+
+def summarize_calls(calls: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    by_type: Dict[str, List[Dict[str, Any]]] = {}
+    for call in calls:
+        by_type.setdefault(call["call_type"] or "unknown", []).append(call)
+    report = {}
+    for call_type, items in sorted(by_type.items()):
+        durations = [c["duration"] for c in items]
+        prompt_tokens = [c["prompt_tokens"] for c in items]
+        report[call_type] = {
+            "count": len(items),
+            "cached": sum(1 for c in items if c["cached"]),
+            "errors": sum(1 for c in items if c["error"]),
+            "retries": sum(max(0, c.get("attempts", 1) - 1) for c in items),
+            "hedged": sum(1 for c in items if c.get("hedged")),
+            "latency_mean": sum(durations) / len(items),
+            "latency_p50": percentile(durations, 50),
+            "latency_p95": percentile(durations, 95),
+            "prompt_tokens_mean": sum(prompt_tokens) / len(items),
+            "prompt_tokens_p50": percentile(prompt_tokens, 50),
+            "prompt_tokens_max": max(prompt_tokens),
+            "prompt_chars_mean": sum(c["prompt_chars"] for c in items) / len(items),
+            "completion_chars_mean": sum(c["completion_chars"] for c in items) / len(items),
+        }
+    return report
+
+
+def summarize_stages(runs: List[GameRun]) -> Dict[str, Dict[str, float]]:
+    """各阶段在所有对局上的平均耗时，按阶段首次出现的顺序排列。"""
+    totals: Dict[str, Dict[str, float]] = {}
+    for run in runs:
+        for row in run.stage_report():
+            agg = totals.setdefault(row["stage"], {"games": 0, "wall": 0.0, "llm_busy": 0.0,
+                                                    "human_wait": 0.0, "engine": 0.0, "llm_calls": 0})
+            agg["games"] += 1
+            for field in ("wall", "llm_busy", "human_wait", "engine", "llm_calls"):
+                agg[field] += row[field]
+    for agg in totals.values():
+        for field in ("wall", "llm_busy", "human_wait", "engine", "llm_calls"):
+            agg[field] /= agg["games"]
+    return totals
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def start_mock(args) -> Tuple[web.AppRunner, MockLLMServer, str]:
+    config = MockConfig.from_preset(args.profile, latency_ms=args.latency_ms, tokens_per_sec=args.tokens_per_sec)
+    config.error_rate = args.error_rate
+    config.rate_limit_rate = args.rate_limit_rate
+    config.stall_rate = args.stall_rate
+    config.seed = args.seed
+    mock = MockLLMServer(config)
+    runner = web.AppRunner(mock.app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    return runner, mock, f"http://{host}:{port}/v1/chat/completions"
+
+
+async def main(args) -> Dict[str, Any]:
+    mock_runner, mock = None, None
+    if args.llm_url:
+        llm_url = args.llm_url
+    else:
+        mock_runner, mock, llm_url = await start_mock(args)
+
+    if not args.keep_pauses:
+        server.INVESTIGATION_PAUSE = 0
+        server.REVEAL_PAUSE = 0
+    game_session.RAG_ROOT = args.workdir
+
+    all_calls: List[Dict[str, Any]] = []
+
+    def observe(record: Dict[str, Any]):
+        all_calls.append(record)
+        run = _current_game.get()
+        if run is not None:
+            run.calls.append(record)
+
+    get_llm_client().add_observer(observe)
+    route_stats = RouteStats()
+    get_llm_client().add_observer(route_stats.observe)
+    sio = BenchSio()
+    runs = [GameRun(f"bench_{i}") for i in range(args.games)]
+    sampler = LoopLagSampler()
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    sampler.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(run_game(sio, run, llm_url, args.think_time, args.timeout) for run in runs))
+    wall = time.perf_counter() - started
+    sampler.stop()
+
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+    await close_llm_client()
+    if mock_runner is not None:
+        await mock_runner.cleanup()
+
+    completed = [r for r in runs if r.finished is not None]
+    llm_total = sum(c["duration"] for c in all_calls)
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "games": args.games,
+            "llm": llm_url if args.llm_url else f"mock:{args.profile}",
+            "pauses": args.keep_pauses,
+            "streaming": server.STREAMING_ENABLED,
+        },
+        "totals": {
+            "wall": wall,
+            "games_completed": len(completed),
+            "game_wall_mean": sum(r.finished - r.started for r in completed) / len(completed) if completed else None,
+            "games_per_minute": len(completed) / wall * 60 if wall else 0.0,
+            "llm_calls": len(all_calls),
+            "llm_call_time_sum": llm_total,
+            "emits": sio.emits,
+            "emit_bytes": sio.emit_bytes,
+        },
+        "stages": summarize_stages(runs),
+        "calls": summarize_calls(all_calls),
+        "routes": route_stats.report(),
+        "loop_lag": sampler.report(),
+        "memory": {
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "tracemalloc_peak_kb": traced_peak // 1024 if traced_peak is not None else None,
+        },
+        "mock": {"requests": dict(mock.requests), "errors": mock.errors,
+                 "rate_limited": mock.rate_limited, "stalled": mock.stalled} if mock else None,
+        "games": [
+            {"room": r.room_id, "completed": r.finished is not None,
+             "wall": (r.finished or time.perf_counter()) - r.started, "stages": r.stage_report()}
+            for r in runs
+        ],
+    }
+
+
+def print_report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    totals = result["totals"]
+    print(f"\n=== 基准测试 ({result['meta']['commit']}) ===")
+    print(f"对局: {totals['games_completed']}/{result['meta']['games']} 完成, 总耗时 {totals['wall']:.2f}s, "
+          f"LLM 调用 {totals['llm_calls']} 次")
+    print(f"\n{'阶段':<20}{'耗时':>9}{'LLM':>9}{'人类':>9}{'引擎':>9}{'调用':>7}")
+    for stage, row in result["stages"].items():
+        print(f"{stage:<20}{row['wall']:>9.3f}{row['llm_busy']:>9.3f}{row['human_wait']:>9.3f}"
+              f"{row['engine']:>9.3f}{row['llm_calls']:>7.1f}")
+    print(f"\n{'调用类型':<16}{'次数':>6}{'p50(s)':>9}{'p95(s)':>9}{'prompt tok':>12}{'max tok':>9}")
+    for call_type, row in result["calls"].items():
+        print(f"{call_type:<16}{row['count']:>6}{row['latency_p50']:>9.3f}{row['latency_p95']:>9.3f}"
+              f"{row['prompt_tokens_mean']:>12.0f}{row['prompt_tokens_max']:>9}")
+    print(f"\n{'路由':<10}{'模型':<24}{'次数':>6}{'p50(s)':>9}{'p95(s)':>9}{'prompt tok':>12}{'output tok':>12}")
+    for route, models in result.get("routes", {}).items():
+        for model, row in models.items():
+            p50 = row["latency_p50"] if row["latency_p50"] is not None else float("nan")
+            p95 = row["latency_p95"] if row["latency_p95"] is not None else float("nan")
+            print(f"{route:<10}{model:<24}{row['calls']:>6}{p50:>9.3f}{p95:>9.3f}"
+                  f"{row['prompt_tokens']:>12}{row['completion_tokens']:>12}")
+    lag = result["loop_lag"]
+    print(f"\n事件循环延迟: p50 {lag['p50_ms']:.2f}ms, p99 {lag['p99_ms']:.2f}ms, max {lag['max_ms']:.2f}ms")
+    print(f"峰值内存: {result['memory']['max_rss_kb']} KB (RSS)")
+
+    if baseline:
+        print(f"\n=== 与基线 ({baseline['meta'].get('commit')}) 对比 ===")
+        for label, path in (("对局平均耗时", ("totals", "game_wall_mean")),
+                            ("LLM 调用次数", ("totals", "llm_calls")),
+                            ("事件循环 p99(ms)", ("loop_lag", "p99_ms")),
+                            ("峰值 RSS(KB)", ("memory", "max_rss_kb"))):
+            old = baseline.get(path[0], {}).get(path[1])
+            new = result[path[0]][path[1]]
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{label:<18}{old:>12.3f} -> {new:>12.3f}  ({change})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="整局游戏的端到端基准测试（默认使用内置的模拟 LLM 服务）")
+    parser.add_argument("--games", type=int, default=1, help="并发进行的对局数")
+    parser.add_argument("--profile", choices=sorted(LATENCY_PRESETS), default="fast", help="模拟 LLM 的延迟预设")
+    parser.add_argument("--latency-ms", type=float, default=None, help="覆盖预设的首 token 延迟（毫秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=None, help="覆盖预设的流式输出速度")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="模拟 LLM 请求卡住（一分钟才响应）的概率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-url", default=None, help="改用外部的 chat/completions 端点，而不是内置模拟服务")
+    parser.add_argument("--think-time", type=float, default=0.0, help="模拟人类玩家每次行动前的思考时间（秒）")
+    parser.add_argument("--keep-pauses", action="store_true", help="保留流程中刻意的停顿")
+    parser.add_argument("--timeout", type=float, default=600.0, help="单局超时（秒）")
+    parser.add_argument("--tracemalloc", action="store_true", help="额外统计 Python 堆的峰值（会拖慢运行）")
+    parser.add_argument("--workdir", default=None, help="记忆目录的存放位置，默认使用临时目录")
+    parser.add_argument("--output", default=None, help="把结果写成 JSON 文件，便于跨提交比较")
+    parser.add_argument("--compare", default=None, help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix="jubensha_bench_")
+
+    result = asyncio.run(main(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入 {args.output}")
+    sys.exit(0 if result["totals"]["games_completed"] == args.games else 1)
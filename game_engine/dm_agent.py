@@ -1,18 +1,26 @@
 import os
-import json
-import requests
-from typing import Dict, Any, List, Optional, Callable
-from submodule.memory_rag.memory import RAGmanager
+from typing import TYPE_CHECKING, Dict, Any, AsyncIterator, List, Optional, Callable
+from llm_client import LLM_API_URL, LLMError, default_headers, get_llm_client
+from memory_context import MemoryContext
+from model_routing import get_router
+from structured_output import Check, generate_structured
+from structured_log import get_logger
+
+if TYPE_CHECKING:
+    # 记忆模块依赖较重，只在类型检查时导入；运行时由 GameSession 在后台按需加载
+    from submodule.memory_rag.memory import RAGmanager
+
+logger = get_logger("dm_agent")
 
 class DMAgent:
-    def __init__(self, rag_manager: RAGmanager, model_name: str = "gemini-2.5-flash"):
+    def __init__(self, rag_manager: Optional["RAGmanager"] = None, model_name: str = "gemini-2.5-flash", memory: Optional[MemoryContext] = None):
         self.rag_manager = rag_manager
-        self.api_url = "https://api.xi-ai.cn/v1/chat/completions"
-        # 警告：为了测试，密钥暂时硬编码。在生产环境中，请务必使用环境变量或安全的密钥管理方式。
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer"
-        }
+        # 有界的对话上下文：阶段摘要 + 最近消息，按 token 预算截断
+        self.memory = memory or MemoryContext(rag_manager)
+        # 端点与密钥由环境变量 JUBENSHA_LLM_API_URL / OPENAI_API_KEY 配置；
+        # 它们与 model_name 是默认值，具体调用类型可由路由表（model_routing）改用其他模型或端点
+        self.api_url = LLM_API_URL
+        self.headers = default_headers()
         self.model = model_name
 
         self.system_prompt = f'''你是一个剧本杀的DM，负责引导游戏流程。你是一名经验丰富的、公平公正的剧本杀游戏主持人（DM）。请注意，你的任务是确保游戏的顺利进行，而不是直接参与游戏。你需要根据剧本内容和玩家的行为，做出合理的判断和回应。时刻牢记你作为DM的身份与职责
@@ -42,64 +50,112 @@ class DMAgent:
 林若彤(歌手)女31岁在船上工作时间1年，是东方之星号酒吧专属爵士乐歌手。
 '''
 
+        # 静态前缀：系统设定 + 剧本背景，只构建一次，每次调用都逐字节相同，便于服务端前缀缓存
+        self.static_prompt = f"{self.system_prompt}\n\n--- 剧本背景 ---\n{self.initial_context}"
+
     def _build_full_prompt(self, task_prompt: str) -> str:
-        """构建包含记忆和当前任务的完整用户提示。"""
-        memories_str = "\n".join(self.rag_manager.list_history())
-        
-        full_prompt = f"""
-{self.initial_context}
-
---- 游戏记忆（最近的对话历史）---
-{memories_str or "无"}
----------------------------------
-
---- 你当前的任务 ---
-{task_prompt}
-"""
-        return full_prompt
-
-    def _call_api(self, messages: List[Dict[str, str]]) -> str:
-        """通用的 API 调用方法"""
-        data = {
-            "model": self.model,
-            "messages": messages
-        }
+        """构建当前任务的用户提示（记忆以独立的对话轮次放在它之前）。"""
+        return f"""--- 你当前的任务 ---
+{task_prompt}"""
+
+    async def _request(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                       call_type: Optional[str] = None, **extra: Any) -> str:
+        """发送请求并返回模型输出，失败时抛出 LLMError。call_type 决定该调用能否命中响应缓存。"""
+        route = get_router().route(call_type)
+        url, headers, model = route.resolve(self.api_url, self.headers, self.model)
+        return await get_llm_client().chat(url, headers, model, messages, timeout=timeout,
+                                           call_type=call_type, agent="dm", route=route.name, **extra)
+
+    async def _call_api(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                        call_type: Optional[str] = None) -> str:
+        """通用的 API 调用方法（异步，复用共享连接池）；失败时返回空字符串，不编造回复。"""
         try:
-            response = requests.post(self.api_url, headers=self.headers, data=json.dumps(data))
-            response.raise_for_status()  # 如果响应状态码不是 2xx，则抛出异常
-            result = response.json()
-            # 假设返回结构与 OpenAI 兼容
-            return result['choices'][0]['message']['content']
-        except requests.exceptions.RequestException as e:
-            print(f"DM Agent API 请求错误: {e}")
-            return "抱歉，我现在无法连接到服务器。"
-        except (KeyError, IndexError) as e:
-            print(f"DM Agent 解析响应错误: {e} - 响应内容: {response.text}")
-            return "抱歉，我收到了一个无法理解的回复。"
-
-    def handle_external_message(self, prompt: str, should_respond: bool = True):
+            return await self._request(messages, timeout=timeout, call_type=call_type)
+        except LLMError as e:
+            logger.error("DM Agent API 请求错误: %s", e)
+            return ""
+
+    async def _stream_api(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                          call_type: Optional[str] = None) -> AsyncIterator[str]:
+        """流式 API 调用：逐段产出模型输出；失败时停止产出（已产出的部分保留）。"""
+        route = get_router().route(call_type)
+        url, headers, model = route.resolve(self.api_url, self.headers, self.model)
+        try:
+            async for delta in get_llm_client().stream_chat(url, headers, model, messages, timeout=timeout,
+                                                            call_type=call_type, agent="dm", route=route.name):
+                yield delta
+        except LLMError as e:
+            logger.error("DM Agent API 流式请求错误: %s", e)
+
+    async def _build_messages(self, task_prompt: str) -> List[Dict[str, str]]:
+        """静态前缀 -> 追加式的记忆轮次 -> 当前任务，变化的部分始终在最后。先等待已入队的发言写入记忆。"""
+        await self.memory.sync()
+        return [
+            {"role": "system", "content": self.static_prompt},
+            *self.memory.as_messages(),
+            {"role": "user", "content": self._build_full_prompt(task_prompt)}
+        ]
+
+    def _build_whisper_prompt(self, player_id: str, message: str) -> str:
+        return f"玩家 {player_id}向你询问：{message}，请根据剧本内容和玩家的身份，给出合理的回复。请注意，这个回复是私聊内容，其他玩家看不到。"
+
+    async def handle_external_message(self, prompt: str, should_respond: bool = True, timeout: Optional[float] = None,
+                                      call_type: str = "dm_response"):
         ''' 接收消息，并生成回应与否。'''
         if not should_respond:
             return None
         
-        full_user_prompt = self._build_full_prompt(prompt)
+        messages = await self._build_messages(prompt)
+        return await self._call_api(messages, timeout=timeout, call_type=call_type)
+
+    async def handle_structured_message(self, prompt: str, schema: Dict[str, Any], call_type: str,
+                                        check: Optional[Check] = None) -> Optional[Dict[str, Any]]:
+        """要求 DM 给出符合 schema 的 JSON 决策（如发言顺序）；最终失败时返回 None。"""
+        messages = await self._build_messages(prompt)
+        return await generate_structured(
+            lambda msgs, **extra: self._request(msgs, call_type=call_type, **extra),
+            messages, schema, call_type, check)
+
+    async def handle_external_message_stream(self, prompt: str, timeout: Optional[float] = None,
+                                             call_type: str = "narration") -> AsyncIterator[str]:
+        """handle_external_message 的流式版本，用于 DM 公告等较长的叙述。"""
+        messages = await self._build_messages(prompt)
+        async for delta in self._stream_api(messages, timeout=timeout, call_type=call_type):
+            yield delta
+
+    async def summarize(self, stage_label: str, history: List[str]) -> Optional[str]:
+        """
+        把某个阶段的对话压缩成摘要，供之后的提示词复用；失败时返回 None。
+        """
+        conversation = "\n".join(history)
         messages = [
-            {"role": "system", "content": self.system_prompt},
-            {"role": "user", "content": full_user_prompt}
+            {"role": "system", "content": "你是剧本杀游戏的记录员，负责把一段对话整理成简洁、客观的摘要。"},
+            {"role": "user", "content": f"""以下是“{stage_label}”阶段的全部对话：
+{conversation}
+
+请用不超过300字概括这一阶段：每位角色的关键陈述、公开的线索、相互之间的怀疑与指控。
+只保留事实，不要推测，不要加入对话中没有的信息。"""}
         ]
-        return self._call_api(messages)
+        try:
+            return await self._request(messages, call_type="summary")
+        except LLMError as e:
+            logger.warning("DM Agent 摘要生成失败: %s", e)
+            return None
 
-    def whisper(self, player_id: str, message: str):
+    async def whisper(self, player_id: str, message: str, timeout: Optional[float] = None):
         """
         私聊某个玩家，返回私聊内容
         """
-        task_prompt = f"玩家 {player_id}向你询问：{message}，请根据剧本内容和玩家的身份，给出合理的回复。请注意，这个回复是私聊内容，其他玩家看不到。"
-        full_user_prompt = self._build_full_prompt(task_prompt)
-        messages = [
-            {"role": "system", "content": self.system_prompt},
-            {"role": "user", "content": full_user_prompt}
-        ]
-        return self._call_api(messages)
+        messages = await self._build_messages(self._build_whisper_prompt(player_id, message))
+        return await self._call_api(messages, timeout=timeout, call_type="whisper")
+
+    async def whisper_stream(self, player_id: str, message: str, timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """
+        私聊的流式版本，逐段产出回复内容
+        """
+        messages = await self._build_messages(self._build_whisper_prompt(player_id, message))
+        async for delta in self._stream_api(messages, timeout=timeout, call_type="whisper"):
+            yield delta
 
 if __name__ == "__main__":
     # 示例：获取DM的响应
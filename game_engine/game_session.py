@@ -0,0 +1,420 @@
+import asyncio
+import functools
+import os
+import re
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dm_agent import DMAgent
+from journal import JOURNAL_ENABLED, SessionJournal, find_journals, load_journal
+from memory_context import MemoryContext
+from message_history import MessageHistory
+from metrics import EMIT_BYTES, EMITS, SESSIONS_EVICTED
+from outbound import Outbox
+from state_log import StateLog
+from player_agent import AIPlayerAgent
+from rag_ingest import RagIngestQueue
+from scheduler import SessionScheduler
+from speculation import Speculator
+from turn_order import new_seed
+from script_content import CHARACTERS
+from wire_format import WireFormat, json_size
+from structured_log import get_logger
+
+logger = get_logger("session")
+
+# 客户端未指定房间时使用的默认房间
+DEFAULT_ROOM_ID = "default"
+# 房间号会被拼进记忆目录路径，只允许安全字符
+ROOM_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# 各局游戏的长时记忆根目录
+RAG_ROOT = "rag_dbs"
+
+# ----------------- 对局回收配置 -----------------
+# 已结算的对局在最后一个连接离开后释放；未结算的对局在没有任何连接满 IDLE_TTL 秒后释放。
+# 释放未结算的对局时保留会话目录与对局日志，同一房间再有人连接时从日志恢复
+SESSION_IDLE_TTL = float(os.environ.get("JUBENSHA_SESSION_IDLE_TTL", "1800"))
+# 检查可回收对局的间隔（秒）
+SESSION_REAP_INTERVAL = float(os.environ.get("JUBENSHA_SESSION_REAP_INTERVAL", "30"))
+
+
+def import_rag_manager():
+    """导入记忆模块（依赖较重）。服务启动后由预热任务在后台线程中先导入一次，之后的对局直接复用。"""
+    from submodule.memory_rag.memory import RAGmanager
+    return RAGmanager
+
+
+def open_rag_manager(session_dir: str):
+    """构建或加载某一局的记忆索引。耗时较长，由 RagIngestQueue 在线程池中调用。"""
+    rag_manager = import_rag_manager()(save_path=session_dir)
+    rag_manager.build_index()
+    return rag_manager
+
+
+def is_valid_room_id(room_id: Optional[str]) -> bool:
+    return bool(room_id) and bool(ROOM_ID_PATTERN.match(room_id))
+
+
+def shard_for_room(room_id: str, num_shards: int) -> int:
+    """房间号到 worker 序号的稳定映射（与进程无关）。分片模式下 router 与各 worker 据此对恢复出的对局归属达成一致。"""
+    return zlib.crc32(room_id.encode("utf-8")) % num_shards
+
+
+def find_restorable(root: Optional[str] = None) -> Dict[str, Tuple[str, int, dict]]:
+    """
+    扫描 root（默认 RAG_ROOT）下的对局日志，返回需要恢复的对局：{房间号: (会话目录, 日志序号, 状态)}。
+    同一房间有多个日志时取最新的；尚未开始或已经结算的对局不恢复。
+    """
+    latest: Dict[str, Tuple[str, int, dict]] = {}
+    for session_dir in find_journals(root or RAG_ROOT):
+        try:
+            loaded = load_journal(session_dir)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("对局日志读取失败: %s", e, extra={"session_dir": session_dir})
+            continue
+        if loaded is None:
+            continue
+        n, state = loaded
+        room_id = state.get("room_id")
+        if is_valid_room_id(room_id):
+            latest[room_id] = (session_dir, n, state)
+    return {room_id: entry for room_id, entry in latest.items()
+            if not entry[2].get("finished")
+            and entry[2].get("game_state.stage", "waiting_for_players") != "waiting_for_players"}
+
+
+def new_game_state() -> dict:
+    """返回一局新游戏的初始状态。"""
+    return {
+        "stage": "waiting_for_players",
+        "players": {},
+        "turn_order": [],
+        "current_speaker_index": 0,
+        "clues": {}, # Changed to dict for easier access
+        "statements": {},
+        "votes": {},
+        "vote_history": [],     # 已结束的各轮投票，按轮次顺序
+        "turn_order_seed": new_seed(),  # 本局发言顺序的随机种子，随状态写入日志
+        "accusations": {},
+        "public_clues": [],
+        "pending_action": None
+    }
+
+
+class GameSession:
+    """
+    一张游戏桌：持有一局游戏的全部状态、玩家连接、长时记忆、DM/AI Agent，
+    以及对应的 socketio 房间。所有广播都限定在本房间内。
+    """
+
+    def __init__(self, room_id: str, sio, session_dir: Optional[str] = None):
+        self.room_id = room_id
+        self.room = f"game:{room_id}"
+        self.sio = sio
+        self.game_state = new_game_state()
+        # 当前阶段的开始时间（time.monotonic），用于统计阶段时长
+        self.stage_started_at = time.monotonic()
+        # 带版本号的状态事件日志，用于断线重连时增量补发
+        self.state_log = StateLog()
+        # Maps player_id to their socket_id (sid)
+        self.player_sids: Dict[str, str] = {}
+        # 每个连接的出站队列：本局的所有事件都经由它发送
+        self.outboxes: Dict[str, Outbox] = {}
+        # 最后一个连接离开的时间（time.monotonic）；有连接时为 None，用于回收无人连接的对局
+        self.idle_since: Optional[float] = time.monotonic()
+
+        # 为每一局游戏创建独立的记忆目录（按房间号与时间戳区分）；从日志恢复时沿用原来的目录
+        self.session_dir = session_dir or os.path.join(RAG_ROOT, f"game_{room_id}_{int(time.time())}")
+        os.makedirs(self.session_dir, exist_ok=True)
+        # 公共聊天记录：全部写入会话目录，内存中只保留最近的消息
+        self.messages = MessageHistory(self.session_dir)
+        # 对局日志：状态变化以增量形式追加，进程重启后据此恢复
+        self.journal = SessionJournal(self.session_dir) if JOURNAL_ENABLED else None
+        # 结算完成后置为 True，已结束的对局不再恢复
+        self.finished = False
+
+        # 聊天记录经由写入队列成批写入 RAGmanager，不阻塞广播路径；
+        # RAGmanager 与索引不在这里构建，而是在预热（warmup）或第一次用到时于线程池中构建
+        self.rag_ingest = RagIngestQueue(functools.partial(open_rag_manager, self.session_dir), room_id)
+
+        # DM 与 AI 玩家共享同一份有界上下文（阶段摘要只生成一次）
+        self.memory = MemoryContext(ingest=self.rag_ingest)
+
+        # DM 与 AI 玩家在第一次用到时才创建（见 dm_agent / ai_agents）
+        self._dm_agent: Optional[DMAgent] = None
+        self._ai_agents: Optional[Dict[str, AIPlayerAgent]] = None
+        # 从日志恢复、但 Agent 尚未创建时暂存的已获得线索，创建 Agent 时再写入
+        self._restored_clues: Dict[str, List[str]] = {}
+        # 流程调度器：同一局的推进步骤串行执行，后台任务统一登记
+        self.scheduler = SessionScheduler(room_id)
+        # 下一位 AI 发言人的预生成草稿；chat_count / human_chat_count 为已产生的（真人玩家）聊天消息数，用来判断草稿是否过期
+        self.speculator = Speculator(self.spawn)
+        self.chat_count = 0
+        self.human_chat_count = 0
+        self.initialize_game()
+
+    def initialize_game(self):
+        """Initializes the game state. AI agents are created on first use."""
+        for player_id, player_info in CHARACTERS.items():
+            self.game_state["players"][player_id] = {
+                "id": player_id,
+                "name": player_info["name"],
+                "is_ai": player_info["is_ai"],
+                "clues": []
+            }
+
+        logger.info("对局初始化完成", extra={"room_id": self.room_id, "players": list(self.game_state["players"])})
+
+    @property
+    def dm_agent(self) -> DMAgent:
+        if self._dm_agent is None:
+            self._dm_agent = DMAgent(memory=self.memory)
+        return self._dm_agent
+
+    @property
+    def ai_agents(self) -> Dict[str, AIPlayerAgent]:
+        if self._ai_agents is None:
+            self._ai_agents = {
+                player_id: AIPlayerAgent(player_id=player_id, role_name=player_info["name"], memory=self.memory)
+                for player_id, player_info in CHARACTERS.items()
+                if player_info["is_ai"] and player_id != 'dm'
+            }
+            for player_id, clues in self._restored_clues.items():
+                if player_id in self._ai_agents:
+                    self._ai_agents[player_id].knowledge_base["clues_obtained"] = clues
+            self._restored_clues = {}
+            logger.info("AI 玩家 Agent 已创建", extra={"room_id": self.room_id, "ai_agents": list(self._ai_agents)})
+        return self._ai_agents
+
+    async def warmup(self):
+        """在后台提前构建记忆索引与 Agent，让第一位 AI 发言时不必等待。"""
+        await self.rag_ingest.open()
+        # 属性在第一次访问时创建 Agent
+        agents = [self.dm_agent, *self.ai_agents.values()]
+        logger.info("对局预热完成", extra={"room_id": self.room_id, "agents": len(agents)})
+
+    async def emit(self, event: str, data, to: Optional[str] = None, size: Optional[int] = None):
+        """
+        向本房间的所有连接广播；指定 to（某个 sid）时只发给该连接。事件进入各连接的出站队列，稍后合并发送。
+        size 为负载编码后的字节数（用于指标与出站队列上限），调用方能廉价算出时传入，否则在这里序列化一次来计算。
+        """
+        if size is None:
+            size = json_size(data)
+        EMITS.inc(event=event)
+        EMIT_BYTES.inc(size, event=event)
+        if to is not None:
+            outbox = self.outboxes.get(to)
+            if outbox is not None:
+                outbox.put(event, data, size)
+            else:
+                await self.sio.emit(event, data, room=to)
+            return
+        for outbox in list(self.outboxes.values()):
+            outbox.put(event, data, size)
+
+    def attach(self, player_id: str, sid: str, wire: Optional[WireFormat] = None):
+        """把玩家的连接加入本局；同一玩家的旧连接不再接收事件。wire 为该连接协商出的打包格式。"""
+        old_sid = self.player_sids.get(player_id)
+        if old_sid and old_sid != sid:
+            self.detach_sid(old_sid)
+        self.player_sids[player_id] = sid
+        self.outboxes[sid] = Outbox(self.sio, sid, on_overflow=self._drop_slow_client, wire=wire)
+        self.idle_since = None
+
+    def detach_sid(self, sid: str):
+        outbox = self.outboxes.pop(sid, None)
+        if outbox is not None:
+            outbox.close()
+        if not self.outboxes:
+            self.idle_since = time.monotonic()
+
+    def _drop_slow_client(self, sid: str):
+        """出站队列溢出：断开该连接，客户端重连时会带上版本号补齐错过的事件。"""
+        self.outboxes.pop(sid, None)
+        self.spawn(self.sio.disconnect(sid))
+
+    async def publish(self, event: str, data: dict):
+        """向本房间广播一条状态事件：先记入状态日志并附上版本号，重连的客户端可以据此补齐。"""
+        payload = self.state_log.append(event, data)
+        self.checkpoint()
+        await self.emit(event, payload)
+
+    async def patch(self, *ops: dict):
+        """以 state_patch 事件广播若干条增量操作（见 state_log 中的 set_op / merge_op / append_op）。"""
+        await self.publish('state_patch', {"ops": list(ops)})
+
+    # ----------------- 持久化与恢复 -----------------
+    def export_state(self) -> dict:
+        """需要写入对局日志的全部状态：游戏状态、AI 玩家已获得的线索、阶段摘要与状态版本号。"""
+        state = {f"game_state.{key}": value for key, value in self.game_state.items()}
+        state["room_id"] = self.room_id
+        state["finished"] = self.finished
+        state["state_version"] = self.state_log.version
+        # 不必为了导出而创建 Agent：尚未创建时导出恢复时暂存的线索
+        if self._ai_agents is None:
+            state["agents"] = {pid: {"clues_obtained": clues} for pid, clues in self._restored_clues.items()}
+        else:
+            state["agents"] = {pid: {"clues_obtained": agent.knowledge_base["clues_obtained"]}
+                               for pid, agent in self._ai_agents.items()}
+        state["memory"] = {"summaries": self.memory.summaries, "summarized_upto": self.memory.summarized_upto}
+        return state
+
+    def restore_state(self, state: dict):
+        """把 export_state() 的结果应用到刚创建的 session 上。"""
+        for key, value in state.items():
+            if key.startswith("game_state."):
+                self.game_state[key[len("game_state."):]] = value
+        self.finished = state.get("finished", False)
+        self.state_log.version = state.get("state_version", 0)
+        # 只暂存线索，Agent 仍在第一次用到时才创建（见 ai_agents）
+        self._restored_clues = {pid: list(agent_state["clues_obtained"])
+                                for pid, agent_state in state.get("agents", {}).items()}
+        memory_state = state.get("memory") or {}
+        self.memory.summaries = [tuple(item) for item in memory_state.get("summaries", [])]
+        self.memory.summarized_upto = memory_state.get("summarized_upto", 0)
+        self.messages.load()
+
+    def checkpoint(self):
+        """把自上次以来变化的状态追加到对局日志。增量同步计算（中间不会插入其他协程的修改），落盘在写入线程中进行。"""
+        if self.journal is not None:
+            self.journal.record(self.export_state())
+
+    def spawn(self, coro) -> asyncio.Task:
+        """启动一个后台任务并登记到调度器，避免被提前回收，结束对局时一并取消。"""
+        return self.scheduler.spawn(coro)
+
+    def close(self):
+        """从内存中释放本局：写入最后一次状态，关闭出站队列与消息文件，取消推进步骤、草稿与记忆写入等后台任务。"""
+        self.checkpoint()
+        for outbox in self.outboxes.values():
+            outbox.close()
+        self.outboxes.clear()
+        self.messages.close()
+        self.speculator.discard_all()
+        self.scheduler.cancel()
+        self.rag_ingest.cancel()
+
+    def player_id_for_sid(self, sid: str) -> Optional[str]:
+        for pid, psid in self.player_sids.items():
+            if psid == sid:
+                return pid
+        return None
+
+
+class SessionManager:
+    """
+    按房间号管理所有 GameSession，并记录每个 sid 所属的房间。
+    已结束或长时间无人连接的对局由 reap() 释放；从日志恢复出对局时调用 on_restore（由服务端安排继续推进）。
+    """
+
+    def __init__(self, sio, on_restore: Optional[Callable[[GameSession], None]] = None):
+        self.sio = sio
+        self.on_restore = on_restore
+        self.sessions: Dict[str, GameSession] = {}
+        self.sid_rooms: Dict[str, str] = {}
+        # 因无人连接被释放、但尚未结算的对局：房间号 -> 会话目录，再有人进入该房间时从日志恢复
+        self._evicted: Dict[str, str] = {}
+
+    def get(self, room_id: str) -> Optional[GameSession]:
+        return self.sessions.get(room_id)
+
+    def get_or_create(self, room_id: str) -> GameSession:
+        session = self.sessions.get(room_id)
+        if session is None and room_id in self._evicted:
+            session = self._restore_evicted(room_id)
+        if session is None:
+            session = GameSession(room_id, self.sio)
+            self.sessions[room_id] = session
+            session.spawn(session.warmup())
+        return session
+
+    def restore(self, root: Optional[str] = None, shard: Optional[Tuple[int, int]] = None) -> list:
+        """
+        从 root（默认 RAG_ROOT）下的对局日志重建进行中的对局（见 find_restorable），返回恢复出的 session 列表。
+        分片模式下传入 shard=(本 worker 序号, worker 总数)：所有 worker 共用同一个目录，
+        每局只由 shard_for_room 指定的那一个 worker 恢复，router 也把该房间的连接转发到这个 worker。
+        """
+        restored = []
+        for room_id, (session_dir, n, state) in find_restorable(root).items():
+            if shard is not None and shard_for_room(room_id, shard[1]) != shard[0]:
+                continue
+            if room_id in self.sessions:
+                continue
+            restored.append(self._restore(room_id, session_dir, n, state))
+        return restored
+
+    def _restore(self, room_id: str, session_dir: str, n: int, state: dict) -> GameSession:
+        session = GameSession(room_id, self.sio, session_dir=session_dir)
+        session.restore_state(state)
+        if session.journal is not None:
+            session.journal.resume_from(n, session.export_state())
+        self.sessions[room_id] = session
+        self._evicted.pop(room_id, None)
+        session.spawn(session.warmup())
+        logger.info("已从对局日志恢复对局", extra={"room_id": room_id, "stage": session.game_state["stage"],
+                                                            "session_dir": session_dir, "journal_seq": n})
+        if self.on_restore is not None:
+            self.on_restore(session)
+        return session
+
+    def _restore_evicted(self, room_id: str) -> Optional[GameSession]:
+        session_dir = self._evicted.pop(room_id)
+        try:
+            loaded = load_journal(session_dir)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("对局日志读取失败: %s", e, extra={"session_dir": session_dir})
+            return None
+        if loaded is None:
+            return None
+        return self._restore(room_id, session_dir, *loaded)
+
+    def reap(self, now: Optional[float] = None) -> List[str]:
+        """
+        释放没有任何连接的对局：已结算的立即释放，未结算的在无人连接满 SESSION_IDLE_TTL 秒后释放；
+        正在执行推进步骤的对局留到下一次检查。返回被释放的房间号。
+        """
+        now = time.monotonic() if now is None else now
+        evicted = []
+        for room_id, session in list(self.sessions.items()):
+            if session.outboxes or session.idle_since is None or session.scheduler.running is not None:
+                continue
+            if session.finished:
+                reason = "finished"
+            elif now - session.idle_since >= SESSION_IDLE_TTL:
+                reason = "idle"
+                if session.journal is not None and session.game_state["stage"] != "waiting_for_players":
+                    self._evicted[room_id] = session.session_dir
+            else:
+                continue
+            del self.sessions[room_id]
+            session.close()
+            SESSIONS_EVICTED.inc(reason=reason)
+            evicted.append(room_id)
+            logger.info("对局已从内存中释放", extra={"room_id": room_id, "reason": reason,
+                                                  "stage": session.game_state["stage"]})
+        return evicted
+
+    def bind_sid(self, sid: str, session: GameSession, player_id: str, wire: Optional[WireFormat] = None):
+        session.attach(player_id, sid, wire)
+        self.sid_rooms[sid] = session.room_id
+
+    def unbind_sid(self, sid: str) -> Tuple[Optional[GameSession], Optional[str]]:
+        """断开连接时调用，返回 (session, player_id)；未知 sid 返回 (None, None)。"""
+        room_id = self.sid_rooms.pop(sid, None)
+        session = self.sessions.get(room_id) if room_id else None
+        if session is None:
+            return None, None
+        player_id = session.player_id_for_sid(sid)
+        if player_id:
+            del session.player_sids[player_id]
+        session.detach_sid(sid)
+        return session, player_id
+
+    def lookup(self, sid: str) -> Tuple[Optional[GameSession], Optional[str]]:
+        """根据 sid 找到所在的 session 与 player_id。"""
+        room_id = self.sid_rooms.get(sid)
+        session = self.sessions.get(room_id) if room_id else None
+        if session is None:
+            return None, None
+        return session, session.player_id_for_sid(sid)
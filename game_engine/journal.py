@@ -0,0 +1,173 @@
+import json
+import os
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from structured_log import get_logger
+
+logger = get_logger("journal")
+
+# ----------------- 日志（WAL）配置 -----------------
+# 设为 0 关闭对局日志：进程退出后无法恢复进行中的对局
+JOURNAL_ENABLED = os.environ.get("JUBENSHA_JOURNAL", "1") != "0"
+# 每追加多少条增量记录生成一次完整快照，并清空增量日志
+SNAPSHOT_EVERY = int(os.environ.get("JUBENSHA_JOURNAL_SNAPSHOT_EVERY", "100"))
+JOURNAL_FILE = "journal.jsonl"
+SNAPSHOT_FILE = "snapshot.json"
+
+
+class JournalWriter:
+    """
+    所有对局日志共用的唯一写入线程：追加、写快照与 fsync 都按提交顺序在这里执行，不占用事件循环。
+    同一局的写入顺序与 record() 的调用顺序一致。
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[Callable[[], None]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, write: Callable[[], None]):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+                self._thread.start()
+        self._queue.put(write)
+
+    def _run(self):
+        while True:
+            write = self._queue.get()
+            try:
+                write()
+            except OSError as e:
+                logger.error("对局日志写入失败: %s", e)
+            finally:
+                self._queue.task_done()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def join(self):
+        """阻塞到此前提交的写入全部落盘。服务关闭与测试时使用；事件循环中请用 asyncio.to_thread 调用。"""
+        self._queue.join()
+
+
+JOURNAL_WRITER = JournalWriter()
+
+
+class SessionJournal:
+    """
+    一局游戏的预写日志：每次状态变化只追加发生变化的顶层字段（{"n": 序号, "set": {字段: 新值}}），
+    每隔 SNAPSHOT_EVERY 条写一次完整快照（先写临时文件再原子替换）并清空增量日志。
+    增量在调用方（事件循环）上计算并编码，文件写入与 fsync 交给 JOURNAL_WRITER 在后台线程中完成。
+    恢复时读取快照，再按序重放序号更大的增量记录；进程在写到一半时退出留下的残缺行会被忽略。
+    """
+
+    def __init__(self, session_dir: str, snapshot_every: int = SNAPSHOT_EVERY,
+                 writer: Optional[JournalWriter] = None):
+        self.journal_path = os.path.join(session_dir, JOURNAL_FILE)
+        self.snapshot_path = os.path.join(session_dir, SNAPSHOT_FILE)
+        self.snapshot_every = max(1, snapshot_every)
+        self.writer = writer or JOURNAL_WRITER
+        self.n = 0
+        self._since_snapshot = 0
+        # 每个顶层字段最近一次写入日志时的 JSON 文本，用于计算增量
+        self._written: Dict[str, str] = {}
+
+    def resume_from(self, n: int, state: Dict[str, Any]):
+        """从磁盘恢复后调用：之后的记录接着已有的序号，增量以恢复出的状态为基准。"""
+        self.n = n
+        self._written = {key: json.dumps(value, ensure_ascii=False, sort_keys=True) for key, value in state.items()}
+
+    def record(self, state: Dict[str, Any]) -> bool:
+        """
+        把 state 中相对上次有变化的字段交给写入线程追加到日志；没有变化时不写入，返回是否写入。
+        返回时写入可能尚未落盘，需要确认时调用 JOURNAL_WRITER.join()。
+        """
+        changed = {}
+        for key, value in state.items():
+            encoded = json.dumps(value, ensure_ascii=False, sort_keys=True)
+            if self._written.get(key) != encoded:
+                changed[key] = encoded
+                self._written[key] = encoded
+        if not changed:
+            return False
+
+        self.n += 1
+        self._since_snapshot += 1
+        if self._since_snapshot >= self.snapshot_every:
+            self.snapshot(state)
+            return True
+        # 直接拼接已编码的字段，不再把整个增量序列化一遍
+        line = f'{{"n": {self.n}, "set": {self._encode_fields(changed)}}}\n'
+        self.writer.submit(lambda: self._append(line))
+        return True
+
+    def snapshot(self, state: Dict[str, Any]):
+        """写入完整快照并清空增量日志（快照落盘之后才截断，中途退出也能恢复）。"""
+        for key, value in state.items():
+            if key not in self._written:
+                self._written[key] = json.dumps(value, ensure_ascii=False, sort_keys=True)
+        body = f'{{"n": {self.n}, "state": {self._encode_fields({key: self._written[key] for key in state})}}}'
+        self.writer.submit(lambda: self._write_snapshot(body))
+        self._since_snapshot = 0
+
+    @staticmethod
+    def _encode_fields(encoded: Dict[str, str]) -> str:
+        return "{" + ", ".join(f"{json.dumps(key, ensure_ascii=False)}: {value}" for key, value in encoded.items()) + "}"
+
+    # 以下两个方法在写入线程中执行
+    def _append(self, line: str):
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def _write_snapshot(self, body: str):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        open(self.journal_path, "w").close()
+
+
+def load_journal(session_dir: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """读取快照并重放增量日志，返回 (最后的序号, 状态)；目录中没有日志时返回 None。"""
+    snapshot_path = os.path.join(session_dir, SNAPSHOT_FILE)
+    journal_path = os.path.join(session_dir, JOURNAL_FILE)
+    n, state = 0, {}
+    found = False
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        n, state = snapshot["n"], snapshot["state"]
+        found = True
+    if os.path.exists(journal_path):
+        found = True
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("忽略残缺的对局日志记录", extra={"session_dir": session_dir})
+                    break
+                if entry["n"] <= n:
+                    continue
+                n = entry["n"]
+                state.update(entry["set"])
+    return (n, state) if found and state else None
+
+
+def find_journals(root: str) -> List[str]:
+    """列出 root 下所有带有对局日志的会话目录，按修改时间从旧到新排序。"""
+    if not os.path.isdir(root):
+        return []
+    dirs = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        marker = [p for p in (os.path.join(path, SNAPSHOT_FILE), os.path.join(path, JOURNAL_FILE)) if os.path.exists(p)]
+        if marker:
+            dirs.append((max(os.path.getmtime(p) for p in marker), path))
+    return [path for _, path in sorted(dirs)]
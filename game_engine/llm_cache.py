@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# ----------------- 缓存配置 -----------------
+# 内存 LRU 的条目上限
+CACHE_MAX_ENTRIES = int(os.environ.get("JUBENSHA_LLM_CACHE_SIZE", "512"))
+# 缓存有效期（秒）
+CACHE_TTL = float(os.environ.get("JUBENSHA_LLM_CACHE_TTL", str(24 * 3600)))
+# 持久化文件（SQLite）；为空时只使用内存缓存
+CACHE_PATH = os.environ.get("JUBENSHA_LLM_CACHE_PATH", "")
+# 允许缓存的调用类型。发言类（statement、clue_sharing）以及投票、指认默认不缓存，以保持多样性
+CACHEABLE_CALL_TYPES = {
+    t.strip() for t in os.environ.get(
+        "JUBENSHA_LLM_CACHE_TYPES", "introduction,whisper,turn_order,summary"
+    ).split(",") if t.strip()
+}
+
+
+def cache_key(model: str, messages: List[Dict[str, str]], **extra: Any) -> str:
+    """按模型、消息列表与其他请求参数计算内容寻址的缓存键。"""
+    material = json.dumps({"model": model, "messages": messages, "extra": extra},
+                          ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class _DiskStore:
+    """基于 SQLite 的持久化存储，所有访问在线程池中执行，不阻塞事件循环。"""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put(self, key: str, value: str, expires_at: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at),
+            )
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+
+class LLMCache:
+    """
+    LLM 响应缓存：内存 LRU（条目数有上限）+ 可选的磁盘持久化，条目带 TTL。
+    只缓存 cacheable_types 中的调用类型，并按调用类型统计命中与未命中次数。
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL,
+                 path: str = CACHE_PATH, cacheable_types=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cacheable_types = set(CACHEABLE_CALL_TYPES if cacheable_types is None else cacheable_types)
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._disk = _DiskStore(path) if path else None
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+        self.evictions = 0
+
+    def enabled_for(self, call_type: Optional[str]) -> bool:
+        return bool(call_type) and call_type in self.cacheable_types and self.max_entries > 0
+
+    async def get(self, key: str, call_type: str) -> Optional[str]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits[call_type] += 1
+                return value
+            del self._entries[key]
+
+        if self._disk is not None:
+            row = await asyncio.to_thread(self._disk.get, key)
+            if row is not None:
+                value, expires_at = row
+                if expires_at > now:
+                    self._remember(key, value, expires_at)
+                    self.hits[call_type] += 1
+                    return value
+                await asyncio.to_thread(self._disk.delete, key)
+
+        self.misses[call_type] += 1
+        return None
+
+    async def put(self, key: str, value: str):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.put, key, value, expires_at)
+
+    def _remember(self, key: str, value: str, expires_at: float):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        call_types = sorted(set(self.hits) | set(self.misses))
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+            "persistent": self._disk is not None,
+            "by_call_type": {
+                t: {"hits": self.hits[t], "misses": self.misses[t]} for t in call_types
+            },
+        }
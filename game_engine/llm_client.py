@@ -0,0 +1,491 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+
+from llm_cache import LLMCache, cache_key
+from llm_resilience import (MAX_ATTEMPTS, CircuitBreaker, LatencyTracker, backoff_delay, deadline_for,
+                            endpoint_label)
+from memory_context import estimate_tokens
+from metrics import LLM_BREAKER_REJECTED, LLM_DEADLINE_EXCEEDED, LLM_HEDGES, LLM_RETRIES
+from structured_log import get_logger
+
+logger = get_logger("llm")
+
+# ----------------- 连接池配置 -----------------
+# 所有 Agent 共用一个 ClientSession，复用 keep-alive 连接，避免每次调用都重新握手。
+POOL_LIMIT = 100            # 全局最大并发连接数
+POOL_LIMIT_PER_HOST = 50    # 单个 LLM 服务端点的最大并发连接数
+KEEPALIVE_TIMEOUT = 60      # 空闲连接保留时间（秒）
+DEFAULT_TIMEOUT = 60.0      # 未单独配置截止时间的调用类型使用的超时时间（秒），见 llm_resilience.CALL_DEADLINES
+NARRATIVE_TIMEOUT = 120.0   # 真相揭晓、结算等长文本生成的超时时间（秒）
+CONNECT_TIMEOUT = 10.0      # 建立连接的超时时间（秒）
+# 流式调用中（含首 token 之前）超过该时长没有收到任何数据即视为连接挂起，放弃本次尝试并重试
+STREAM_STALL_TIMEOUT = float(os.environ.get("JUBENSHA_LLM_STALL_TIMEOUT", "20"))
+
+# ----------------- LLM 服务端点 -----------------
+# 任何兼容 OpenAI chat/completions 协议的服务都可以使用，包括本地的 mock_llm_server.py
+LLM_API_URL = os.environ.get("JUBENSHA_LLM_API_URL", "https://api.xi-ai.cn/v1/chat/completions")
+LLM_API_KEY = os.environ.get("OPENAI_API_KEY", "")
+
+
+def default_headers(api_key: str = LLM_API_KEY) -> Dict[str, str]:
+    """构建请求头；密钥从环境变量读取，不写在代码里。"""
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+
+
+# 调用观察者：每次调用结束（成功、失败或命中缓存）后收到一条调用记录，用于基准测试与统计
+CallObserver = Callable[[Dict[str, Any]], None]
+
+
+class LLMError(Exception):
+    """
+    LLM 调用失败（网络错误、超时、非 2xx 响应、无法解析的返回或端点熔断）。
+    reason 是用于指标的简短原因；retryable 表示换一次请求可能成功（超时、网络错误、429、5xx）。
+    非 2xx 响应时 status 与 body 为响应状态码与响应体。
+    """
+
+    def __init__(self, message: str, reason: str = "error", retryable: bool = False,
+                 status: Optional[int] = None, body: str = ""):
+        super().__init__(message)
+        self.reason = reason
+        self.retryable = retryable
+        self.status = status
+        self.body = body
+
+
+# 计入熔断器连续失败次数的原因：说明端点本身不可用。429 与无法解析的返回不算
+BREAKER_FAILURE_REASONS = {"timeout", "network", "http_5xx"}
+
+
+def _http_error(status: int, body: str) -> LLMError:
+    if status == 429:
+        reason = "http_429"
+    elif status >= 500:
+        reason = "http_5xx"
+    else:
+        reason = "http_4xx"
+    return LLMError(f"HTTP {status}: {body[:200]}", reason=reason, retryable=status in (408, 429) or status >= 500,
+                    status=status, body=body)
+
+
+# 服务端不支持结构化输出参数时，400/422 响应体中会提到的字段名
+RESPONSE_FORMAT_MARKERS = ("response_format", "json_schema", "json_object")
+
+
+def rejects_response_format(error: LLMError) -> bool:
+    """该错误是否表示服务端不接受 response_format（而不是鉴权、限流、上下文过长等其他 4xx）。"""
+    body = error.body.lower()
+    return error.status in (400, 422) and any(marker in body for marker in RESPONSE_FORMAT_MARKERS)
+
+
+class LLMClient:
+    """
+    基于 aiohttp 的异步 LLM 客户端，兼容 OpenAI chat/completions 协议。
+    一个进程内共享一个实例，调用方在事件循环中 await，不会阻塞其他对局。
+    每次调用有按调用类型确定的截止时间，期间对可重试的失败做带抖动的退避重试（见 llm_resilience）；
+    非流式调用可选对冲请求；每个端点一个熔断器，端点持续故障时直接失败，不再让每局都等满超时。
+    """
+
+    def __init__(self,
+                 limit: int = POOL_LIMIT,
+                 limit_per_host: int = POOL_LIMIT_PER_HOST,
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+                 default_timeout: float = DEFAULT_TIMEOUT,
+                 cache: Optional[LLMCache] = None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.default_timeout = default_timeout
+        self.cache = cache if cache is not None else LLMCache()
+        self.observers: List[CallObserver] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+        self.latency = LatencyTracker()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        # 明确拒绝过 response_format 的（端点, 模型）：之后发往它们的请求不再带该参数，其他端点与模型不受影响
+        self.format_rejected: Set[Tuple[str, str]] = set()
+
+    def add_observer(self, observer: CallObserver):
+        self.observers.append(observer)
+
+    def remove_observer(self, observer: CallObserver):
+        if observer in self.observers:
+            self.observers.remove(observer)
+
+    def _start_record(self, model: str, messages: List[Dict[str, str]], call_type: Optional[str],
+                      agent: Optional[str], route: Optional[str], stream: bool) -> Optional[Dict[str, Any]]:
+        """没有观察者时返回 None，避免无谓地估算提示词大小。"""
+        if not self.observers:
+            return None
+        prompt = "".join(m.get("content", "") for m in messages)
+        return {
+            "call_type": call_type,
+            "agent": agent,
+            "route": route,
+            "model": model,
+            "stream": stream,
+            "cached": False,
+            "started": time.perf_counter(),
+            "prompt_chars": len(prompt),
+            "prompt_tokens": estimate_tokens(prompt),
+            "completion_chars": 0,
+            "completion_tokens": 0,
+            "first_token": None,
+            "attempts": 0,
+            "hedged": False,
+            "error": None,
+        }
+
+    def _finish_record(self, record: Optional[Dict[str, Any]]):
+        if record is None:
+            return
+        record["duration"] = time.perf_counter() - record["started"]
+        for observer in list(self.observers):
+            try:
+                observer(record)
+            except Exception as e:
+                logger.error("调用观察者出错: %s", e)
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """惰性创建 ClientSession，保证它绑定在当前运行的事件循环上。"""
+        if self._session is not None and not self._session.closed:
+            return self._session
+        async with self._lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                )
+                self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def chat(self, url: str, headers: Dict[str, str], model: str,
+                   messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                   call_type: Optional[str] = None, agent: Optional[str] = None, route: Optional[str] = None,
+                   **extra: Any) -> str:
+        """
+        发送一次 chat/completions 请求并返回 choices[0].message.content。
+        timeout 为整次调用（含重试与对冲）的截止时长，默认按 call_type 取值；最终失败时抛出 LLMError。
+        call_type 标识调用类型；对允许缓存的类型，相同模型与消息的请求直接返回缓存结果，空白回复不写入缓存。
+        agent 标识发起调用的 Agent（dm、ai_player_N），route 是选中的模型档位（见 model_routing），只用于统计。
+        端点以 400/422 明确拒绝 response_format 时记住该（端点, 模型），抛出 reason 为 response_format_rejected
+        的 LLMError；之后对它的调用自动去掉该参数。
+        """
+        target = (endpoint_label(url), model)
+        if "response_format" in extra and target in self.format_rejected:
+            extra = {k: v for k, v in extra.items() if k != "response_format"}
+        record = self._start_record(model, messages, call_type, agent, route, stream=False)
+        try:
+            key = None
+            if self.cache.enabled_for(call_type):
+                key = cache_key(model, messages, **extra)
+                cached = await self.cache.get(key, call_type)
+                if cached is not None:
+                    if record is not None:
+                        record.update(cached=True, completion_chars=len(cached))
+                    return cached
+
+            content = await self._post_with_retries(url, headers, model, messages, timeout, call_type,
+                                                    record, **extra)
+            if record is not None:
+                record["completion_chars"] = len(content)
+                record["completion_tokens"] = estimate_tokens(content)
+            # 空回复多半是失败的生成，不能缓存：否则之后相同的请求在整个有效期内都会拿到它
+            if key is not None and content.strip():
+                await self.cache.put(key, content)
+            return content
+        except LLMError as e:
+            if record is not None:
+                record["error"] = str(e)
+            if "response_format" in extra and rejects_response_format(e):
+                self.format_rejected.add(target)
+                logger.warning("端点拒绝 response_format，之后对该模型的调用不再携带: %s", e,
+                               extra={"endpoint": target[0], "model": model, "call_type": call_type})
+                raise LLMError(str(e), reason="response_format_rejected", status=e.status, body=e.body) from e
+            raise
+        finally:
+            self._finish_record(record)
+
+    # ----------------- 截止时间、重试、对冲与熔断 -----------------
+    def _breaker(self, url: str) -> CircuitBreaker:
+        endpoint = endpoint_label(url)
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = self.breakers[endpoint] = CircuitBreaker(endpoint)
+        return breaker
+
+    def _deadline(self, timeout: Optional[float], call_type: Optional[str]) -> float:
+        return time.monotonic() + (timeout or deadline_for(call_type, self.default_timeout))
+
+    @staticmethod
+    def _remaining(deadline: float) -> float:
+        return max(0.01, deadline - time.monotonic())
+
+    @staticmethod
+    def _admit(breaker: CircuitBreaker):
+        if not breaker.allow():
+            LLM_BREAKER_REJECTED.inc(endpoint=breaker.endpoint)
+            raise LLMError(f"LLM 端点 {breaker.endpoint} 暂时不可用（熔断中）", reason="circuit_open")
+
+    @staticmethod
+    def _record_failure(breaker: CircuitBreaker, error: LLMError):
+        if error.reason in BREAKER_FAILURE_REASONS:
+            breaker.record_failure()
+        else:
+            breaker.release()
+
+    def _retry_delay(self, breaker: CircuitBreaker, error: LLMError, tries: int, deadline: float,
+                     call_type: Optional[str]) -> Optional[float]:
+        """记录一次失败的尝试；应当重试时返回退避时长，不可重试、次数用尽或来不及在截止时间前重试时返回 None。"""
+        self._record_failure(breaker, error)
+        delay = backoff_delay(tries)
+        out_of_time = time.monotonic() + delay >= deadline
+        if not error.retryable or tries >= MAX_ATTEMPTS or out_of_time:
+            if error.retryable and out_of_time:
+                LLM_DEADLINE_EXCEEDED.inc(call_type=call_type or "unknown")
+            return None
+        LLM_RETRIES.inc(call_type=call_type or "unknown", reason=error.reason)
+        logger.warning("LLM 调用失败，%.2fs 后重试: %s", delay, error,
+                       extra={"call_type": call_type, "attempt": tries, "endpoint": breaker.endpoint})
+        return delay
+
+    async def _post_with_retries(self, url: str, headers: Dict[str, str], model: str,
+                                 messages: List[Dict[str, str]], timeout: Optional[float],
+                                 call_type: Optional[str], record: Optional[Dict[str, Any]],
+                                 **extra: Any) -> str:
+        deadline = self._deadline(timeout, call_type)
+        breaker = self._breaker(url)
+        tries = 0
+        while True:
+            self._admit(breaker)
+            tries += 1
+            if record is not None:
+                record["attempts"] = tries
+            started = time.monotonic()
+            try:
+                content = await self._hedged_post(url, headers, model, messages, deadline, call_type,
+                                                  record, **extra)
+            except LLMError as e:
+                delay = self._retry_delay(breaker, e, tries, deadline, call_type)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            self.latency.observe(call_type, time.monotonic() - started)
+            return content
+
+    async def _hedged_post(self, url: str, headers: Dict[str, str], model: str,
+                           messages: List[Dict[str, str]], deadline: float, call_type: Optional[str],
+                           record: Optional[Dict[str, Any]], **extra: Any) -> str:
+        """
+        发送请求；超过该类调用近期延迟的高分位仍未返回时，再发一份相同的请求，取先成功的一份，另一份取消。
+        未开启对冲、样本不足或剩余时间不够时退化为普通请求。
+        """
+        hedge_after = self.latency.hedge_delay(call_type)
+        remaining = self._remaining(deadline)
+        if hedge_after is None or hedge_after >= remaining:
+            return await self._post(url, headers, model, messages, remaining, **extra)
+
+        primary = asyncio.create_task(self._post(url, headers, model, messages, remaining, **extra))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                LLM_HEDGES.inc(call_type=call_type or "unknown", outcome="launched")
+                if record is not None:
+                    record["hedged"] = True
+                tasks.add(asyncio.create_task(
+                    self._post(url, headers, model, messages, self._remaining(deadline), **extra)))
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            LLM_HEDGES.inc(call_type=call_type or "unknown", outcome="won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _stream_with_retries(self, url: str, headers: Dict[str, str], model: str,
+                                   messages: List[Dict[str, str]], timeout: Optional[float],
+                                   call_type: Optional[str], record: Optional[Dict[str, Any]],
+                                   **extra: Any) -> AsyncIterator[str]:
+        """流式调用的重试：已经产出的片段已推送给前端、无法撤回，所以只在产出第一段之前失败时重试。"""
+        deadline = self._deadline(timeout, call_type)
+        breaker = self._breaker(url)
+        tries = 0
+        while True:
+            self._admit(breaker)
+            tries += 1
+            if record is not None:
+                record["attempts"] = tries
+            emitted = False
+            try:
+                async for delta in self._stream_post(url, headers, model, messages, self._remaining(deadline),
+                                                     **extra):
+                    emitted = True
+                    yield delta
+            except LLMError as e:
+                if emitted:
+                    self._record_failure(breaker, e)
+                    raise
+                delay = self._retry_delay(breaker, e, tries, deadline, call_type)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            return
+
+    def resilience_stats(self) -> dict:
+        """各端点的熔断状态，供 /load 展示。"""
+        return {endpoint: breaker.stats() for endpoint, breaker in self.breakers.items()}
+
+    async def _post(self, url: str, headers: Dict[str, str], model: str,
+                    messages: List[Dict[str, str]], timeout: Optional[float],
+                    **extra: Any) -> str:
+        payload = {"model": model, "messages": messages, **extra}
+        client_timeout = aiohttp.ClientTimeout(
+            total=timeout or self.default_timeout,
+            connect=CONNECT_TIMEOUT,
+        )
+        session = await self._get_session()
+        try:
+            async with session.post(url, headers=headers, data=json.dumps(payload),
+                                    timeout=client_timeout) as response:
+                body = await response.text()
+                if response.status >= 400:
+                    raise _http_error(response.status, body)
+        except asyncio.TimeoutError as e:
+            raise LLMError(f"请求超时（{client_timeout.total:.1f}s）", reason="timeout", retryable=True) from e
+        except aiohttp.ClientError as e:
+            raise LLMError(f"请求错误: {e}", reason="network", retryable=True) from e
+
+        try:
+            result = json.loads(body)
+            # 假设返回结构与 OpenAI 兼容
+            return result['choices'][0]['message']['content']
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise LLMError(f"解析响应错误: {e} - 响应内容: {body[:200]}", reason="bad_response") from e
+
+    async def stream_chat(self, url: str, headers: Dict[str, str], model: str,
+                          messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                          call_type: Optional[str] = None, agent: Optional[str] = None,
+                          route: Optional[str] = None, **extra: Any) -> AsyncIterator[str]:
+        """
+        以 stream=True 调用 chat/completions，按到达顺序逐段产出 delta.content。
+        服务端以 SSE 格式返回（"data: {...}" 行，以 "data: [DONE]" 结束）。
+        timeout 同样是整次流式调用的截止时长；只在尚未产出任何内容时重试，不做对冲。
+        命中缓存时一次性产出完整文本；未命中时在流正常结束后写入缓存（空白回复不缓存）。
+        """
+        record = self._start_record(model, messages, call_type, agent, route, stream=True)
+        try:
+            key = None
+            if self.cache.enabled_for(call_type):
+                key = cache_key(model, messages, **extra)
+                cached = await self.cache.get(key, call_type)
+                if cached is not None:
+                    if record is not None:
+                        record.update(cached=True, completion_chars=len(cached))
+                    yield cached
+                    return
+
+            parts = []
+            async for delta in self._stream_with_retries(url, headers, model, messages, timeout, call_type,
+                                                         record, **extra):
+                if record is not None:
+                    if record["first_token"] is None:
+                        record["first_token"] = time.perf_counter() - record["started"]
+                    record["completion_chars"] += len(delta)
+                parts.append(delta)
+                yield delta
+            text = "".join(parts)
+            if record is not None:
+                record["completion_tokens"] = estimate_tokens(text)
+            if key is not None and text.strip():
+                await self.cache.put(key, text)
+        except LLMError as e:
+            if record is not None:
+                record["error"] = str(e)
+            raise
+        finally:
+            self._finish_record(record)
+
+    async def _stream_post(self, url: str, headers: Dict[str, str], model: str,
+                           messages: List[Dict[str, str]], timeout: Optional[float],
+                           **extra: Any) -> AsyncIterator[str]:
+        payload = {"model": model, "messages": messages, "stream": True, **extra}
+        client_timeout = aiohttp.ClientTimeout(
+            total=timeout or self.default_timeout,
+            connect=CONNECT_TIMEOUT,
+            sock_read=STREAM_STALL_TIMEOUT,
+        )
+        session = await self._get_session()
+        try:
+            async with session.post(url, headers=headers, data=json.dumps(payload),
+                                    timeout=client_timeout) as response:
+                if response.status >= 400:
+                    body = await response.text()
+                    raise _http_error(response.status, body)
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8", errors="ignore").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                        delta = chunk['choices'][0].get('delta', {}).get('content')
+                    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                        continue
+                    if delta:
+                        yield delta
+        except asyncio.TimeoutError as e:
+            raise LLMError(f"请求超时（总时长 {client_timeout.total:.1f}s 或 {STREAM_STALL_TIMEOUT:.0f}s 内没有数据）",
+                           reason="timeout", retryable=True) from e
+        except aiohttp.ClientError as e:
+            raise LLMError(f"请求错误: {e}", reason="network", retryable=True) from e
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+_shared_client: Optional[LLMClient] = None
+
+
+def get_llm_client() -> LLMClient:
+    """返回进程内共享的 LLMClient 实例。"""
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = LLMClient()
+    return _shared_client
+
+
+async def close_llm_client(app=None):
+    """关闭共享连接池，可直接挂到 aiohttp 的 on_cleanup 上。"""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.close()
+        _shared_client = None
@@ -0,0 +1,154 @@
+import os
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+from urllib.parse import urlparse
+
+from metrics import LLM_BREAKER_STATE
+from structured_log import get_logger
+
+logger = get_logger("llm")
+
+# ----------------- 调用可靠性配置 -----------------
+# 各调用类型的截止时间（秒）：整次调用（含重试）必须在此之前结束，调用方显式传入的 timeout 优先。
+# 可用 JUBENSHA_LLM_DEADLINES="vote=20,accuse=30" 覆盖其中的若干项
+DEFAULT_DEADLINES = {
+    "introduction": 45.0,
+    "statement": 45.0,
+    "clue_sharing": 45.0,
+    "vote": 30.0,
+    "accuse": 45.0,
+    "turn_order": 20.0,
+    "summary": 60.0,
+    "whisper": 30.0,
+    "dm_response": 30.0,
+    "announcement": 10.0,
+    "narration": 120.0,
+}
+# 每次调用最多尝试的次数（含第一次）
+MAX_ATTEMPTS = int(os.environ.get("JUBENSHA_LLM_MAX_ATTEMPTS", "3"))
+# 重试退避：第 n 次重试前等待 [0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2^n)) 之间的随机时长（full jitter）
+RETRY_BASE_DELAY = float(os.environ.get("JUBENSHA_LLM_RETRY_BASE", "0.5"))
+RETRY_MAX_DELAY = float(os.environ.get("JUBENSHA_LLM_RETRY_MAX", "5"))
+# 设为 1 开启对冲请求：非流式调用超过该调用类型近期延迟的 HEDGE_PERCENTILE 分位仍未返回时，再发一份相同的请求，先返回者胜出
+HEDGE_ENABLED = os.environ.get("JUBENSHA_LLM_HEDGE", "0") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("JUBENSHA_LLM_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 20      # 样本少于该数量时不对冲，分位数不可靠
+HEDGE_MIN_DELAY = 0.2       # 对冲等待时间的下限（秒）
+LATENCY_WINDOW = 200        # 每种调用类型保留的最近延迟样本数
+# 熔断：同一端点连续失败 BREAKER_THRESHOLD 次后打开，BREAKER_COOLDOWN 秒内的调用直接失败，之后放行一次试探
+BREAKER_THRESHOLD = int(os.environ.get("JUBENSHA_LLM_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.environ.get("JUBENSHA_LLM_BREAKER_COOLDOWN", "30"))
+
+
+def _parse_deadlines(spec: str) -> Dict[str, float]:
+    deadlines = dict(DEFAULT_DEADLINES)
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            deadlines[name.strip()] = float(value)
+    return deadlines
+
+
+CALL_DEADLINES = _parse_deadlines(os.environ.get("JUBENSHA_LLM_DEADLINES", ""))
+
+
+def deadline_for(call_type: Optional[str], default: float) -> float:
+    """某类调用的截止时长（秒）；未配置的类型使用 default。"""
+    return CALL_DEADLINES.get(call_type or "", default)
+
+
+def backoff_delay(retry: int) -> float:
+    """第 retry 次重试（从 1 开始）前的等待时长，带完全随机抖动，避免多局同时重试形成尖峰。"""
+    return random.uniform(0.0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** retry)))
+
+
+def endpoint_label(url: str) -> str:
+    """指标与日志中使用的端点名（host:port），不包含路径与查询参数。"""
+    return urlparse(url).netloc or url
+
+
+class LatencyTracker:
+    """按调用类型保留最近一段成功调用的延迟，用于计算对冲请求的触发时间。"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def observe(self, call_type: Optional[str], seconds: float):
+        samples = self._samples.get(call_type or "")
+        if samples is None:
+            samples = self._samples[call_type or ""] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, call_type: Optional[str], q: float) -> Optional[float]:
+        samples = self._samples.get(call_type or "")
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100.0))]
+
+    def hedge_delay(self, call_type: Optional[str]) -> Optional[float]:
+        """发出对冲请求前等待的时长；未开启或样本不足时返回 None。"""
+        if not HEDGE_ENABLED:
+            return None
+        threshold = self.percentile(call_type, HEDGE_PERCENTILE)
+        return None if threshold is None else max(HEDGE_MIN_DELAY, threshold)
+
+
+class CircuitBreaker:
+    """
+    单个 LLM 端点的熔断器：closed 时正常放行；连续失败达到阈值后 open，冷却期内的调用直接失败；
+    冷却结束后进入 half_open，只放行一次试探调用，成功则恢复 closed，失败则重新 open。
+    """
+
+    STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, endpoint: str, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._set_state("closed")
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning("熔断器状态 %s -> %s", self.state, state,
+                           extra={"endpoint": self.endpoint, "failures": self.failures})
+        self.state = state
+        LLM_BREAKER_STATE.set(self.STATE_VALUES[state], endpoint=self.endpoint)
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self._set_state("half_open")
+        if self.state == "half_open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != "closed":
+            self._set_state("closed")
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self._set_state("open")
+
+    def release(self):
+        """试探调用既没有成功也不算端点故障（如被取消、被限流）时，让出试探名额。"""
+        self._probing = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures}
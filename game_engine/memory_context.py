@@ -0,0 +1,144 @@
+import asyncio
+import math
+import os
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from structured_log import get_logger
+
+logger = get_logger("memory")
+
+# ----------------- 上下文预算配置 -----------------
+# 每次构建提示词时，游戏记忆部分允许占用的 token 上限（估算值）
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("JUBENSHA_CONTEXT_TOKENS", "3000"))
+# 原文保留的最近消息条数上限（当前阶段内）
+RECENT_WINDOW = int(os.environ.get("JUBENSHA_RECENT_MESSAGES", "20"))
+# 单个阶段摘要的 token 上限，LLM 摘要失败时的截断兜底也使用该上限
+SUMMARY_TOKEN_LIMIT = 400
+
+# 中日韩文字、全角标点：大多数分词器下约 1 个字符 1 个 token
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估算 token 数：中文按字计数，其余字符约 4 个算 1 个 token。"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    return cjk + math.ceil(other / 4)
+
+
+def truncate_to_tokens(text: str, limit: int) -> str:
+    """把文本截断到大约 limit 个 token 以内。"""
+    if estimate_tokens(text) <= limit:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + "……"
+
+
+# 摘要函数：输入（阶段名, 该阶段的对话记录），返回摘要文本；失败时返回 None
+Summarizer = Callable[[str, List[str]], Awaitable[Optional[str]]]
+
+
+class MemoryContext:
+    """
+    会话级的有界对话上下文。
+    已结束阶段的对话在阶段切换时压缩成摘要（只生成一次，之后复用）；
+    当前阶段保留最近若干条原文；整体按 token 预算截断。
+    """
+
+    def __init__(self, rag_manager=None, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 recent_window: int = RECENT_WINDOW, ingest=None):
+        self.rag_manager = rag_manager
+        # 写入队列（RagIngestQueue）：给出时历史从它的快照读取（此时可以不传 rag_manager），sync() 保证读到已入队的消息
+        self.ingest = ingest
+        self.token_budget = token_budget
+        self.recent_window = recent_window
+        # [(阶段名, 摘要)]，按时间顺序
+        self.summaries: List[Tuple[str, str]] = []
+        # list_history() 中已被摘要覆盖的条目数
+        self.summarized_upto = 0
+        self._lock = asyncio.Lock()
+
+    def history(self) -> List[str]:
+        return (self.ingest or self.rag_manager).list_history()
+
+    async def sync(self):
+        """等待已入队的对话写入记忆；构建提示词前调用，保证看到刚刚发生的发言。"""
+        if self.ingest is not None:
+            await self.ingest.flush()
+
+    async def close_stage(self, stage_label: str, summarizer: Optional[Summarizer] = None):
+        """阶段结束时调用：把尚未摘要的对话压缩成该阶段的摘要。"""
+        async with self._lock:
+            await self.sync()
+            history = self.history()
+            upto = len(history)
+            pending = history[self.summarized_upto:upto]
+            if not pending:
+                return
+            summary = None
+            if summarizer is not None:
+                try:
+                    summary = await summarizer(stage_label, pending)
+                except Exception as e:
+                    logger.warning("阶段摘要生成失败（%s）: %s", stage_label, e)
+            if not summary:
+                # 兜底：直接拼接原文，下面再截断到摘要上限
+                summary = "\n".join(pending)
+            self.summaries.append((stage_label, truncate_to_tokens(summary.strip(), SUMMARY_TOKEN_LIMIT)))
+            self.summarized_upto = upto
+
+    def _select(self) -> Tuple[List[str], List[str], int]:
+        """按预算挑选要放进提示词的 (阶段摘要, 最近原文, 最近原文中第一条相对窗口起点的位置)。"""
+        history = self.history()
+        budget = self.token_budget
+
+        summary_lines = [f"【{label}摘要】{text}" for label, text in self.summaries]
+        # 摘要最多占一半预算，超出时丢弃最早的阶段摘要
+        while summary_lines and sum(estimate_tokens(s) for s in summary_lines) > budget // 2:
+            summary_lines.pop(0)
+        budget -= sum(estimate_tokens(s) for s in summary_lines)
+
+        # 窗口起点按半个窗口的步长整体前移，而不是每来一条就滑动一条，
+        # 这样相邻几次调用的历史前缀保持一致，便于服务端的前缀缓存命中
+        tail = history[self.summarized_upto:]
+        step = max(1, self.recent_window // 2)
+        start = 0
+        while len(tail) - start > self.recent_window:
+            start += step
+
+        recent: List[str] = []
+        for line in reversed(tail[start:]):
+            cost = estimate_tokens(line)
+            if cost > budget:
+                break
+            recent.append(line)
+            budget -= cost
+        recent.reverse()
+        return summary_lines, recent, len(tail) - start - len(recent)
+
+    def as_messages(self) -> List[Dict[str, str]]:
+        """
+        以追加式的对话轮次返回记忆：阶段摘要作为一条消息（阶段内不变），
+        最近原文按窗口步长（半个窗口）分块，每块一条消息。分块与窗口起点对齐，
+        写满的块在之后的调用中逐字节不变，新发言只会追加到最后一块；
+        同一角色的连续消息最多只有几条，不会逐行展开成几十轮。
+        """
+        summary_lines, recent, offset = self._select()
+        messages = []
+        if summary_lines:
+            messages.append({"role": "user", "content": "--- 之前阶段的摘要 ---\n" + "\n".join(summary_lines)})
+        chunk = max(1, self.recent_window // 2)
+        # 第一块可能因预算截断而不满，之后的块与窗口起点对齐
+        first = chunk - offset % chunk
+        blocks = [recent[:first]] + [recent[i:i + chunk] for i in range(first, len(recent), chunk)]
+        messages.extend({"role": "user", "content": "\n".join(block)} for block in blocks if block)
+        return messages
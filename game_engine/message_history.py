@@ -0,0 +1,129 @@
+import asyncio
+import json
+import os
+from collections import deque
+from typing import IO, Any, Deque, Dict, List, Optional, Tuple
+
+from journal import JOURNAL_WRITER, JournalWriter
+
+# ----------------- 消息历史配置 -----------------
+# 每局在内存中保留的最近消息条数；全部消息都写入会话目录下的 messages.jsonl，更早的从文件读取
+MESSAGE_RING_SIZE = int(os.environ.get("JUBENSHA_MESSAGE_RING_SIZE", "200"))
+# 连接时随 initial_state 下发的最近消息条数，更早的由前端按需拉取
+INITIAL_MESSAGES = int(os.environ.get("JUBENSHA_INITIAL_MESSAGES", "50"))
+# fetch_messages 单次最多返回的条数
+MAX_FETCH_LIMIT = 100
+MESSAGES_FILE = "messages.jsonl"
+
+
+class MessageHistory:
+    """
+    一局游戏的公共聊天记录：每条消息追加写入会话目录下的 messages.jsonl，内存中只保留最近的有界环形缓冲，
+    更早的消息按需从磁盘读取。每条消息带一个从 1 递增的 seq 作为分页游标，
+    before(cursor, limit) 返回游标之前的若干条。进程重启后可以用 load() 从文件恢复。
+    文件写入交给对局日志的写入线程（JOURNAL_WRITER）按序执行，磁盘分页在线程池中读取，都不占用事件循环；
+    尚未写入文件的消息不会被挤出内存缓冲，从磁盘读取的范围总是已经写完的部分。
+    """
+
+    def __init__(self, session_dir: str, max_recent: int = MESSAGE_RING_SIZE, writer: Optional[JournalWriter] = None):
+        self.path = os.path.join(session_dir, MESSAGES_FILE)
+        self.writer = writer or JOURNAL_WRITER
+        self.seq = 0
+        self._recent: Deque[Dict[str, Any]] = deque()
+        self._max_recent = max(1, max_recent)
+        # 每条消息在文件中的字节偏移，下标为 seq - 1；偏移按已提交的字节数在事件循环上计算
+        self._offsets: List[int] = []
+        self._size = 0
+        # 已经写入文件的最大 seq，由写入线程更新
+        self._written_seq = 0
+        # 只在写入线程中使用的追加句柄
+        self._file: Optional[IO[bytes]] = None
+
+    def __len__(self) -> int:
+        return self.seq
+
+    def append(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """追加一条消息并为其分配 seq；写入交给写入线程，缓冲区满时丢弃内存中最旧的、已经写入文件的消息。"""
+        self.seq += 1
+        message["seq"] = self.seq
+        line = (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+        self._offsets.append(self._size)
+        self._size += len(line)
+        self.writer.submit(lambda seq=self.seq: self._write(line, seq))
+        self._recent.append(message)
+        self._trim()
+        return message
+
+    def _write(self, line: bytes, seq: int):
+        """在写入线程中执行：追加一行并刷新到文件。"""
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        self._file.write(line)
+        self._file.flush()
+        self._written_seq = seq
+
+    def _trim(self):
+        while len(self._recent) > self._max_recent and self._recent[0]["seq"] <= self._written_seq:
+            self._recent.popleft()
+
+    def close(self):
+        """关闭追加句柄（在写入线程中，排在此前的写入之后）。"""
+        self.writer.submit(self._close_file)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def load(self):
+        """从 messages.jsonl 恢复消息与偏移；进程中途退出留下的残缺末行会被截掉。"""
+        if not os.path.exists(self.path):
+            return
+        valid_end = 0
+        with open(self.path, "rb") as f:
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    break
+                self._offsets.append(valid_end)
+                valid_end += len(line)
+                self._recent.append(message)
+                if len(self._recent) > self._max_recent:
+                    self._recent.popleft()
+        if valid_end < os.path.getsize(self.path):
+            os.truncate(self.path, valid_end)
+        self.seq = self._written_seq = len(self._offsets)
+        self._size = valid_end
+
+    def _read_from_disk(self, start_seq: int, end_seq: int) -> List[Dict[str, Any]]:
+        """从磁盘读取 seq 在 [start_seq, end_seq) 之间的消息。"""
+        if start_seq >= end_seq:
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self._offsets[start_seq - 1])
+            return [json.loads(f.readline()) for _ in range(end_seq - start_seq)]
+
+    def recent(self, limit: int = INITIAL_MESSAGES) -> List[Dict[str, Any]]:
+        """内存缓冲中最近的 limit 条消息（不读磁盘）。"""
+        return list(self._recent)[-limit:] if limit > 0 else []
+
+    async def before(self, cursor: Optional[int], limit: int) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        返回 seq 小于 cursor 的最近 limit 条消息（按时间正序）以及更早是否还有消息。
+        cursor 为 None 时从最新一条开始。内存缓冲之外的部分在线程池中从磁盘读取。
+        """
+        limit = max(0, min(limit, MAX_FETCH_LIMIT))
+        end = self.seq + 1 if cursor is None else max(1, min(cursor, self.seq + 1))
+        start = max(1, end - limit)
+
+        # 先在事件循环上取出内存中的部分，等待读盘期间新追加的消息不影响本页
+        first_recent = self._recent[0]["seq"] if self._recent else self.seq + 1
+        cached = [m for m in self._recent if start <= m["seq"] < end]
+        page = []
+        if start < min(end, first_recent):
+            page = await asyncio.to_thread(self._read_from_disk, start, min(end, first_recent))
+        page.extend(cached)
+        return page, start > 1
@@ -0,0 +1,275 @@
+import asyncio
+import bisect
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# ----------------- 指标配置 -----------------
+# LLM 调用延迟的直方图分桶（秒）
+LLM_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+# 阶段时长的分桶（秒）：包含等待人类玩家的时间，所以跨度较大
+STAGE_DURATION_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 1800.0)
+# 事件循环延迟的分桶（秒）
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LOOP_LAG_INTERVAL = 0.5     # 事件循环延迟采样间隔（秒）
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """取值在抓取时由回调函数计算，适合会话数、连接数这类可以直接读出的量。"""
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._function = function
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield f"{self.name} {_format_value(self._function())}"
+            return
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets: Sequence[float] = LLM_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：[各分桶计数..., 总次数, 总和]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * len(self.buckets) + [0, 0.0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def samples(self):
+        for key, series in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {series[-2]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-2]}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(series[-1])}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """按 Prometheus 文本格式（0.0.4）输出所有指标。"""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+LLM_LATENCY = REGISTRY.register(Histogram(
+    "jubensha_llm_call_duration_seconds", "LLM 调用耗时（含排队与流式输出）",
+    ("agent", "call_type"), LLM_LATENCY_BUCKETS))
+LLM_CALLS = REGISTRY.register(Counter(
+    "jubensha_llm_calls_total", "LLM 调用次数，status 为 ok / error / cached",
+    ("agent", "call_type", "status")))
+LLM_PROMPT_TOKENS = REGISTRY.register(Counter(
+    "jubensha_llm_prompt_tokens_total", "发送给 LLM 的提示词 token 数（本地估算）",
+    ("agent", "call_type")))
+LLM_ROUTE_LATENCY = REGISTRY.register(Histogram(
+    "jubensha_llm_route_duration_seconds", "按模型路由（档位与模型）划分的 LLM 调用耗时，不含缓存命中",
+    ("route", "model"), LLM_LATENCY_BUCKETS))
+LLM_ROUTE_TOKENS = REGISTRY.register(Counter(
+    "jubensha_llm_route_tokens_total", "按模型路由划分的 token 数（本地估算），kind 为 prompt / completion",
+    ("route", "model", "kind")))
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "jubensha_stage_duration_seconds", "各游戏阶段从进入到离开的时长",
+    ("stage",), STAGE_DURATION_BUCKETS))
+ACTIVE_SESSIONS = REGISTRY.register(Gauge(
+    "jubensha_active_sessions", "当前进程内的对局（房间）数"))
+SESSIONS_EVICTED = REGISTRY.register(Counter(
+    "jubensha_sessions_evicted_total", "从内存中释放的对局数，reason 为 finished（已结算）或 idle（长时间无人连接）",
+    ("reason",)))
+CONNECTED_SIDS = REGISTRY.register(Gauge(
+    "jubensha_connected_sids", "当前已绑定到对局的 socket 连接数"))
+SCHEDULER_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "jubensha_scheduler_queue_depth", "所有对局的调度队列中排队等待执行的推进步骤数"))
+LOOP_LAG = REGISTRY.register(Histogram(
+    "jubensha_event_loop_lag_seconds", "事件循环延迟：定时唤醒比预期晚的时长",
+    (), LOOP_LAG_BUCKETS))
+EMITS = REGISTRY.register(Counter(
+    "jubensha_socket_emits_total", "socket 事件发送次数", ("event",)))
+EMIT_BYTES = REGISTRY.register(Counter(
+    "jubensha_socket_emit_bytes_total", "socket 事件负载的字节数（JSON 编码后）", ("event",)))
+
+OUTBOUND_QUEUED = REGISTRY.register(Gauge(
+    "jubensha_outbound_queued_frames", "所有连接的出站队列中等待发送的帧数"))
+OUTBOUND_COALESCED = REGISTRY.register(Counter(
+    "jubensha_outbound_coalesced_total", "出站队列中被合并进上一帧的事件数", ("event",)))
+OUTBOUND_DROPPED = REGISTRY.register(Counter(
+    "jubensha_outbound_dropped_total", "出站队列中因重复或被抵消而丢弃的事件数", ("event",)))
+SLOW_CLIENT_DISCONNECTS = REGISTRY.register(Counter(
+    "jubensha_slow_client_disconnects_total", "出站队列超出上限而被断开的连接数"))
+
+WIRE_BYTES = REGISTRY.register(Counter(
+    "jubensha_wire_bytes_total", "出站队列实际发出的负载字节数，format 为 json / packed（JSON 为估算值）",
+    ("event", "format")))
+WIRE_BYTES_SAVED = REGISTRY.register(Counter(
+    "jubensha_wire_bytes_saved_total", "使用打包格式（msgpack + deflate）相对 JSON 节省的字节数（估算）", ("event",)))
+
+LLM_RETRIES = REGISTRY.register(Counter(
+    "jubensha_llm_retries_total", "LLM 调用的重试次数，reason 为失败原因（timeout / network / http_5xx / http_429 等）",
+    ("call_type", "reason")))
+LLM_HEDGES = REGISTRY.register(Counter(
+    "jubensha_llm_hedges_total", "对冲请求：launched 为发出的次数，won 为对冲请求先返回的次数", ("call_type", "outcome")))
+LLM_DEADLINE_EXCEEDED = REGISTRY.register(Counter(
+    "jubensha_llm_deadline_exceeded_total", "在截止时间内（含重试）仍未成功的 LLM 调用次数", ("call_type",)))
+LLM_BREAKER_STATE = REGISTRY.register(Gauge(
+    "jubensha_llm_breaker_state", "LLM 端点的熔断状态：0 closed / 1 half_open / 2 open", ("endpoint",)))
+LLM_BREAKER_REJECTED = REGISTRY.register(Counter(
+    "jubensha_llm_breaker_rejected_total", "熔断打开期间被直接拒绝的 LLM 调用次数", ("endpoint",)))
+
+STRUCTURED_OUTPUT = REGISTRY.register(Counter(
+    "jubensha_structured_output_total", "结构化输出（投票、指认、发言顺序等）的最终结果：ok / repaired / failed",
+    ("call_type", "outcome")))
+STRUCTURED_PARSE_FAILURES = REGISTRY.register(Counter(
+    "jubensha_structured_parse_failures_total", "结构化输出解析或校验失败的次数，reason 为 no_json / schema / check",
+    ("call_type", "reason")))
+
+SPECULATION = REGISTRY.register(Counter(
+    "jubensha_speculation_total", "AI 发言预生成的结果：started / hit / stale / discarded / failed", ("outcome",)))
+SPECULATION_SAVED = REGISTRY.register(Counter(
+    "jubensha_speculation_saved_seconds_total", "采用预生成草稿而省下的等待时间（秒）"))
+
+RAG_INGEST_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "jubensha_rag_ingest_queue_depth", "所有对局中已入队、尚未写入 RAG 记忆的聊天消息数"))
+RAG_INGEST_COMMIT_SECONDS = REGISTRY.register(Histogram(
+    "jubensha_rag_ingest_commit_seconds", "RAG 记忆每批写入（在线程池中执行）的耗时",
+    (), LOOP_LAG_BUCKETS))
+RAG_INGEST_FAILURES = REGISTRY.register(Counter(
+    "jubensha_rag_ingest_failures_total", "写入 RAG 记忆失败的聊天消息数"))
+
+
+STARTUP_PHASE_SECONDS = REGISTRY.register(Gauge(
+    "jubensha_startup_phase_seconds", "最近一次启动各阶段的耗时：imports / app_setup / startup_hooks / listen，"
+    "以及监听之后的后台预热（warmup_ 前缀）", ("phase",)))
+
+
+def observe_llm_call(record: Dict) -> None:
+    """LLMClient 的调用观察者：把每次调用记入延迟直方图与计数器。"""
+    agent = record.get("agent") or "unknown"
+    call_type = record.get("call_type") or "unknown"
+    if record.get("error"):
+        status = "error"
+    elif record.get("cached"):
+        status = "cached"
+    else:
+        status = "ok"
+    LLM_CALLS.inc(agent=agent, call_type=call_type, status=status)
+    LLM_LATENCY.observe(record["duration"], agent=agent, call_type=call_type)
+    LLM_PROMPT_TOKENS.inc(record.get("prompt_tokens", 0), agent=agent, call_type=call_type)
+    if status != "cached":
+        route = record.get("route") or "unrouted"
+        model = record.get("model") or "unknown"
+        LLM_ROUTE_LATENCY.observe(record["duration"], route=route, model=model)
+        LLM_ROUTE_TOKENS.inc(record.get("prompt_tokens", 0), route=route, model=model, kind="prompt")
+        LLM_ROUTE_TOKENS.inc(record.get("completion_tokens", 0), route=route, model=model, kind="completion")
+
+
+class LoopLagMonitor:
+    """后台任务：每隔 interval 秒 sleep 一次，把实际唤醒的延迟记入直方图。"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+    async def start(self, app=None):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, app=None):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
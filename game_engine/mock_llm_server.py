@@ -0,0 +1,260 @@
+import argparse
+import ast
+import asyncio
+import json
+import random
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+# ----------------- 延迟配置 -----------------
+# 预设的延迟档位：首 token 延迟的分布（毫秒）与流式输出速度（token/秒）
+LATENCY_PRESETS = {
+    "instant": {"dist": "fixed", "latency_ms": 0, "jitter_ms": 0, "tokens_per_sec": 0},
+    "fast": {"dist": "lognormal", "latency_ms": 300, "jitter_ms": 100, "tokens_per_sec": 200},
+    "realistic": {"dist": "lognormal", "latency_ms": 1500, "jitter_ms": 700, "tokens_per_sec": 40},
+    "slow": {"dist": "lognormal", "latency_ms": 4000, "jitter_ms": 2000, "tokens_per_sec": 15},
+}
+STREAM_CHUNK_CHARS = 4      # 流式输出时每个 delta 的字符数（约等于 1 个 token 的若干倍）
+
+# 发言类请求的模板回复
+SPEECH_TEMPLATES = [
+    "案发时我一直在甲板上看烟花，好几个人都能为我作证。",
+    "我和死者平时交集不多，只在工作上打过几次交道。",
+    "我注意到有人在八点左右离开过人群，这一点值得大家留意。",
+    "这条线索说明凶手对船上的结构非常熟悉，我们应该从这个方向去想。",
+    "我不认同刚才的说法，时间线上有明显的矛盾。",
+]
+
+
+@dataclass
+class MockConfig:
+    dist: str = "fixed"                 # fixed | uniform | normal | lognormal
+    latency_ms: float = 0.0             # 首 token 延迟的均值（lognormal 为中位数）
+    jitter_ms: float = 0.0              # 分布宽度：uniform 为半宽，normal/lognormal 为标准差
+    tokens_per_sec: float = 0.0         # 流式输出速度，0 表示不限速
+    error_rate: float = 0.0             # 返回 500 的概率
+    rate_limit_rate: float = 0.0        # 返回 429 的概率
+    stall_rate: float = 0.0             # 请求卡住（额外等待 stall_ms 才响应）的概率，模拟挂起的连接
+    stall_ms: float = 60000.0
+    max_concurrency: int = 0            # 同时处理的请求上限，超出返回 429；0 表示不限
+    seed: Optional[int] = None
+    script: List[Dict[str, str]] = field(default_factory=list)  # [{"match": 子串, "response": 回复}]
+
+    @classmethod
+    def from_preset(cls, name: str, **overrides) -> "MockConfig":
+        values = dict(LATENCY_PRESETS[name])
+        values.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(**values)
+
+
+class MockLLMServer:
+    """
+    本地的 OpenAI chat/completions 兼容服务，用于离线压测与基准测试。
+    根据提示词识别调用类型，返回模板或脚本化的回复（投票、指认、发言顺序返回合法 JSON），
+    并按配置注入延迟、500 错误、429 限流与卡住的请求。
+    """
+
+    def __init__(self, config: Optional[MockConfig] = None):
+        self.config = config or MockConfig()
+        self.rng = random.Random(self.config.seed)
+        self.in_flight = 0
+        self.requests: Counter = Counter()
+        self.errors = 0
+        self.rate_limited = 0
+        self.stalled = 0
+        self.started_at = time.time()
+
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.handle_chat)
+        self.app.router.add_get("/stats", self.handle_stats)
+
+    # ----------------- 延迟与故障注入 -----------------
+    def sample_latency(self) -> float:
+        """按配置的分布采样一次首 token 延迟（秒）。"""
+        c = self.config
+        if c.latency_ms <= 0:
+            return 0.0
+        if c.dist == "uniform":
+            ms = self.rng.uniform(c.latency_ms - c.jitter_ms, c.latency_ms + c.jitter_ms)
+        elif c.dist == "normal":
+            ms = self.rng.gauss(c.latency_ms, c.jitter_ms)
+        elif c.dist == "lognormal":
+            sigma = (c.jitter_ms / c.latency_ms) if c.jitter_ms else 0.0
+            ms = c.latency_ms * self.rng.lognormvariate(0.0, sigma)
+        else:
+            ms = c.latency_ms
+        return max(0.0, ms) / 1000.0
+
+    def _chunk_delay(self) -> float:
+        if self.config.tokens_per_sec <= 0:
+            return 0.0
+        return STREAM_CHUNK_CHARS / self.config.tokens_per_sec
+
+    # ----------------- 回复生成 -----------------
+    def classify(self, messages: List[Dict[str, str]]) -> str:
+        system = messages[0].get("content", "") if messages else ""
+        last = messages[-1].get("content", "") if messages else ""
+        if '"trust"' in last and '"suspect"' in last:
+            return "vote"
+        if '"accused"' in last:
+            return "accuse"
+        if '"turn_order"' in last:
+            return "turn_order"
+        if "记录员" in system:
+            return "summary"
+        if "向你询问" in last:
+            return "whisper"
+        return "speech"
+
+    def respond(self, call_type: str, messages: List[Dict[str, str]]) -> str:
+        everything = "\n".join(m.get("content", "") for m in messages)
+        for rule in self.config.script:
+            if rule.get("match", "") in everything:
+                return rule["response"]
+
+        last = messages[-1].get("content", "") if messages else ""
+        if call_type in ("vote", "accuse"):
+            names = self._candidate_names(last)
+            if len(names) >= 2:
+                picked = self.rng.sample(names, 2)
+                if call_type == "vote":
+                    return json.dumps({"trust": picked[0], "suspect": picked[1],
+                                       "statement": f"我更相信{picked[0]}，而{picked[1]}的说法前后不一。"},
+                                      ensure_ascii=False)
+                return json.dumps({"accused": picked[1],
+                                   "statement": f"综合所有线索，我认为凶手就是{picked[1]}。"},
+                                  ensure_ascii=False)
+        if call_type == "turn_order":
+            match = re.search(r"玩家列表 \(id: 姓名\): (\{.*?\})", last)
+            player_ids = list(json.loads(match.group(1)).keys()) if match else []
+            self.rng.shuffle(player_ids)
+            return json.dumps({"turn_order": player_ids,
+                               "announcement": "本轮发言顺序已经确定，请各位依次发言。"},
+                              ensure_ascii=False)
+        if call_type == "summary":
+            return "本阶段各角色陈述了自己的行踪，彼此之间仍有怀疑。"
+        if call_type == "whisper":
+            return "这个问题我可以告诉你：请留意案发时间前后仓库附近的动静。"
+        return self.rng.choice(SPEECH_TEMPLATES)
+
+    @staticmethod
+    def _candidate_names(prompt: str) -> List[str]:
+        # 正常的投票/指认提示词列出候选姓名；结构化输出的修复提示词只带 schema，从其中的 enum 读取
+        match = re.search(r"可供选择的玩家姓名列表：(\[.*?\])", prompt) or re.search(r'"enum": (\[.*?\])', prompt)
+        if not match:
+            return []
+        try:
+            return list(ast.literal_eval(match.group(1)))
+        except (ValueError, SyntaxError):
+            return []
+
+    # ----------------- 请求处理 -----------------
+    async def handle_chat(self, request: web.Request) -> web.StreamResponse:
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            return web.json_response({"error": {"message": "invalid JSON body"}}, status=400)
+        messages = body.get("messages") or []
+        call_type = self.classify(messages)
+        self.requests[call_type] += 1
+
+        c = self.config
+        if (c.max_concurrency and self.in_flight >= c.max_concurrency) or self.rng.random() < c.rate_limit_rate:
+            self.rate_limited += 1
+            return web.json_response({"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+                                     status=429, headers={"Retry-After": "1"})
+
+        self.in_flight += 1
+        try:
+            latency = self.sample_latency()
+            if self.rng.random() < c.stall_rate:
+                self.stalled += 1
+                latency += c.stall_ms / 1000.0
+            await asyncio.sleep(latency)
+            if self.rng.random() < c.error_rate:
+                self.errors += 1
+                return web.json_response({"error": {"message": "Injected server error", "type": "server_error"}},
+                                         status=500)
+            text = self.respond(call_type, messages)
+            if body.get("stream"):
+                return await self._stream(request, text)
+            prompt_tokens = sum(len(m.get("content", "")) for m in messages)
+            return web.json_response({
+                "id": f"mock-{self.rng.getrandbits(32):08x}",
+                "object": "chat.completion",
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(text),
+                          "total_tokens": prompt_tokens + len(text)},
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, text: str) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        delay = self._chunk_delay()
+        for i in range(0, len(text), STREAM_CHUNK_CHARS):
+            chunk = {"choices": [{"index": 0, "delta": {"content": text[i:i + STREAM_CHUNK_CHARS]}}]}
+            await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            if delay:
+                await asyncio.sleep(delay)
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "uptime": time.time() - self.started_at,
+            "in_flight": self.in_flight,
+            "requests": dict(self.requests),
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "stalled": self.stalled,
+        })
+
+
+def build_config(args) -> MockConfig:
+    config = MockConfig.from_preset(
+        args.profile,
+        dist=args.dist, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        tokens_per_sec=args.tokens_per_sec,
+    )
+    config.error_rate = args.error_rate
+    config.rate_limit_rate = args.rate_limit_rate
+    config.stall_rate = args.stall_rate
+    config.max_concurrency = args.max_concurrency
+    config.seed = args.seed
+    if args.script:
+        with open(args.script, "r", encoding="utf-8") as f:
+            config.script = json.load(f)
+    return config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟的 LLM 服务（OpenAI chat/completions 兼容）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9911)
+    parser.add_argument("--profile", choices=sorted(LATENCY_PRESETS), default="fast",
+                        help="延迟预设，下面的参数可以单独覆盖")
+    parser.add_argument("--dist", choices=["fixed", "uniform", "normal", "lognormal"], default=None)
+    parser.add_argument("--latency-ms", type=float, default=None, help="首 token 延迟（毫秒）")
+    parser.add_argument("--jitter-ms", type=float, default=None, help="延迟抖动（毫秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=None, help="流式输出速度，0 表示不限速")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的概率")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回 429 的概率")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="请求卡住一分钟才响应的概率")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="并发上限，超出的请求返回 429")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--script", default=None,
+                        help='脚本化回复的 JSON 文件：[{"match": "提示词中的子串", "response": "回复"}]')
+    args = parser.parse_args()
+
+    server = MockLLMServer(build_config(args))
+    print(f"Mock LLM server on http://{args.host}:{args.port}/v1/chat/completions (profile={args.profile})")
+    web.run_app(server.app, host=args.host, port=args.port, print=None)
@@ -0,0 +1,143 @@
+import os
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from llm_client import default_headers
+
+# ----------------- 模型路由配置 -----------------
+# 每种调用类型交给哪一档模型：fast 用于简短的结构化决策与一两句话的回复，strong 用于较长的叙述与推理发言。
+# 可用 JUBENSHA_LLM_ROUTES="whisper=fast,vote=strong" 覆盖其中的若干项，档位名可以自定义
+DEFAULT_ROUTE_TIERS = {
+    "turn_order": "fast",
+    "vote": "fast",
+    "accuse": "fast",
+    "clue_sharing": "fast",
+    "summary": "fast",
+    "announcement": "fast",
+    "introduction": "strong",
+    "statement": "strong",
+    "whisper": "strong",
+    "dm_response": "strong",
+    "narration": "strong",
+}
+DEFAULT_TIER = "strong"     # 未列出的调用类型
+# 每一档的模型、端点与密钥分别由 JUBENSHA_LLM_<档位>_MODEL / _URL / _API_KEY 配置，
+# 未配置的项沿用 Agent 自己的设置（model_name、JUBENSHA_LLM_API_URL、OPENAI_API_KEY）
+ROUTE_ENV_PREFIX = "JUBENSHA_LLM_"
+ROUTE_STATS_WINDOW = 200    # 每条路由保留的最近延迟样本数，用于 /llm_routes 中的分位数
+
+
+def _parse_tiers(spec: str) -> Dict[str, str]:
+    tiers = dict(DEFAULT_ROUTE_TIERS)
+    for item in spec.split(","):
+        call_type, _, tier = item.partition("=")
+        if call_type.strip() and tier.strip():
+            tiers[call_type.strip()] = tier.strip().lower()
+    return tiers
+
+
+@dataclass
+class Route:
+    """一档模型：为 None 的字段表示沿用调用方 Agent 自己的设置。"""
+    name: str
+    model: Optional[str] = None
+    url: Optional[str] = None
+    headers: Optional[Dict[str, str]] = None
+
+    @classmethod
+    def from_env(cls, name: str) -> "Route":
+        prefix = f"{ROUTE_ENV_PREFIX}{name.upper()}_"
+        api_key = os.environ.get(prefix + "API_KEY")
+        return cls(
+            name=name,
+            model=os.environ.get(prefix + "MODEL") or None,
+            url=os.environ.get(prefix + "URL") or None,
+            headers=default_headers(api_key) if api_key else None,
+        )
+
+    def resolve(self, url: str, headers: Dict[str, str], model: str) -> Tuple[str, Dict[str, str], str]:
+        """用本档的配置覆盖调用方的默认 (端点, 请求头, 模型)。"""
+        return self.url or url, self.headers or headers, self.model or model
+
+    def describe(self) -> Dict[str, Any]:
+        return {"model": self.model, "url": self.url}
+
+
+class ModelRouter:
+    """按调用类型选择模型档位；每一档的配置在第一次用到时从环境变量读取。"""
+
+    def __init__(self, tiers: Optional[Dict[str, str]] = None):
+        self.tiers = tiers if tiers is not None else _parse_tiers(os.environ.get("JUBENSHA_LLM_ROUTES", ""))
+        self._routes: Dict[str, Route] = {}
+
+    def route(self, call_type: Optional[str]) -> Route:
+        return self.route_by_name(self.tiers.get(call_type or "", DEFAULT_TIER))
+
+    def describe(self) -> Dict[str, Any]:
+        names = sorted(set(self.tiers.values()) | {DEFAULT_TIER})
+        return {
+            "call_types": dict(sorted(self.tiers.items())),
+            "routes": {name: self.route_by_name(name).describe() for name in names},
+        }
+
+    def route_by_name(self, name: str) -> Route:
+        route = self._routes.get(name)
+        if route is None:
+            route = self._routes[name] = Route.from_env(name)
+        return route
+
+
+class RouteStats:
+    """
+    LLMClient 的调用观察者：按（路由, 模型）统计调用次数、失败次数、延迟分位数与 token 数（本地估算），
+    用于在速度与成本之间调整路由表。缓存命中不计入延迟。
+    """
+
+    def __init__(self, window: int = ROUTE_STATS_WINDOW):
+        self.window = window
+        self._stats: Dict[tuple, Dict[str, Any]] = {}
+
+    def observe(self, record: Dict[str, Any]):
+        key = (record.get("route") or "unrouted", record.get("model") or "unknown")
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = {"calls": 0, "cached": 0, "errors": 0, "prompt_tokens": 0,
+                                        "completion_tokens": 0, "latencies": deque(maxlen=self.window)}
+        stats["calls"] += 1
+        if record.get("error"):
+            stats["errors"] += 1
+        if record.get("cached"):
+            stats["cached"] += 1
+            return
+        stats["prompt_tokens"] += record.get("prompt_tokens", 0)
+        stats["completion_tokens"] += record.get("completion_tokens", 0)
+        stats["latencies"].append(record["duration"])
+
+    @staticmethod
+    def _percentile(ordered, q: float) -> Optional[float]:
+        if not ordered:
+            return None
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q / 100.0))], 3)
+
+    def report(self) -> Dict[str, Any]:
+        report: Dict[str, Any] = {}
+        for (route, model), stats in sorted(self._stats.items()):
+            ordered = sorted(stats["latencies"])
+            report.setdefault(route, {})[model] = {
+                **{k: v for k, v in stats.items() if k != "latencies"},
+                "latency_p50": self._percentile(ordered, 50),
+                "latency_p95": self._percentile(ordered, 95),
+            }
+        return report
+
+
+_shared_router: Optional[ModelRouter] = None
+
+
+def get_router() -> ModelRouter:
+    """返回进程内共享的路由表。"""
+    global _shared_router
+    if _shared_router is None:
+        _shared_router = ModelRouter()
+    return _shared_router
@@ -0,0 +1,157 @@
+import asyncio
+import os
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from metrics import OUTBOUND_COALESCED, OUTBOUND_DROPPED, SLOW_CLIENT_DISCONNECTS, WIRE_BYTES
+from structured_log import get_logger
+from wire_format import JSON_PACKET_OVERHEAD, PACKED_EVENT, WireFormat
+
+logger = get_logger("outbound")
+
+# ----------------- 出站队列配置 -----------------
+# 同一连接上的事件先缓冲这么久（毫秒）再发送，期间连续的状态更新合并成一帧
+OUTBOUND_TICK = int(os.environ.get("JUBENSHA_OUTBOUND_TICK_MS", "15")) / 1000.0
+# 单个连接排队的帧数 / 字节数上限，超出即视为慢客户端并断开（客户端重连后通过 sync 补齐）
+OUTBOUND_MAX_FRAMES = int(os.environ.get("JUBENSHA_OUTBOUND_MAX_FRAMES", "500"))
+OUTBOUND_MAX_BYTES = int(os.environ.get("JUBENSHA_OUTBOUND_MAX_BYTES", str(1024 * 1024)))
+# 底层传输（engine.io）尚未写出的包超过该数量时暂停发送，让事件留在本队列中继续合并
+TRANSPORT_HIGH_WATER = int(os.environ.get("JUBENSHA_TRANSPORT_HIGH_WATER", "64"))
+
+TYPING_EVENTS = {"player_typing": True, "player_done_typing": False}
+
+
+def _versioned(data) -> bool:
+    return isinstance(data, dict) and "version" in data
+
+
+def _merge(event: str, last: Any, data: Any) -> Optional[Any]:
+    """尝试把 data 合并进同类的上一帧，返回合并后的新负载；不能合并时返回 None。不修改原对象（它们被多个连接共享）。"""
+    if not isinstance(last, dict) or not isinstance(data, dict) or _versioned(last) != _versioned(data):
+        return None
+    if event == "game_state_update":
+        return {**last, **data}
+    if event == "state_patch":
+        return {**last, **data, "ops": last["ops"] + data["ops"]}
+    if event == "message_delta" and last.get("stream_id") == data.get("stream_id"):
+        return {**last, "delta": last["delta"] + data["delta"]}
+    return None
+
+
+class Outbox:
+    """
+    单个连接的出站缓冲：事件按顺序排队，每隔一个 tick 统一发送。
+    排队期间连续的 game_state_update / state_patch / 同一流的 message_delta 合并成一帧，
+    同一玩家排队中的“正在输入”状态被新状态取代，重复的状态直接丢弃。
+    底层传输积压时暂停发送；本队列超过上限则断开该连接，防止一个慢客户端拖高服务端内存。
+    协商了打包格式的连接每次把排队的全部帧编码成一个二进制包发送（见 wire_format）。
+    """
+
+    def __init__(self, sio, sid: str, on_overflow: Optional[Callable[[str], None]] = None,
+                 wire: Optional[WireFormat] = None):
+        self.sio = sio
+        self.sid = sid
+        self.on_overflow = on_overflow
+        # 连接时协商出的打包格式；None 表示发送普通 JSON 事件
+        self.wire = wire
+        # 每帧为 [event, data, 估算字节数]
+        self._frames: Deque[List[Any]] = deque()
+        self._bytes = 0
+        # 每位玩家最近一次入队的输入状态
+        self._typing: Dict[str, bool] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self.closed = False
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def put(self, event: str, data: Any, size: int):
+        if self.closed:
+            return
+        if event in TYPING_EVENTS and isinstance(data, dict) and self._put_typing(event, data):
+            return
+
+        last = self._frames[-1] if self._frames else None
+        merged = _merge(event, last[1], data) if last is not None and last[0] == event else None
+        if merged is not None:
+            last[1] = merged
+            last[2] += size
+            OUTBOUND_COALESCED.inc(event=event)
+        else:
+            self._frames.append([event, data, size])
+        self._bytes += size
+
+        if len(self._frames) > OUTBOUND_MAX_FRAMES or self._bytes > OUTBOUND_MAX_BYTES:
+            self._overflow()
+            return
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+
+    def _put_typing(self, event: str, data: Dict[str, Any]) -> bool:
+        """处理输入状态事件，返回 True 表示该事件是重复的，无需入队。"""
+        player_id = data.get("player_id")
+        typing = TYPING_EVENTS[event]
+        # 与最近一次入队的状态相同（如发言结束后 finally 中重复的 player_done_typing）：直接丢弃。
+        # 新连接上还不知道客户端的状态（它可能保留着断线前的“正在输入”），第一次总是发送
+        if self._typing.get(player_id) == typing:
+            OUTBOUND_DROPPED.inc(event=event)
+            return True
+        self._typing[player_id] = typing
+        # 该玩家之前的输入状态还没发出去：已被新状态取代，从队列中移除
+        for i in range(len(self._frames) - 1, -1, -1):
+            frame = self._frames[i]
+            if frame[0] in TYPING_EVENTS and isinstance(frame[1], dict) and frame[1].get("player_id") == player_id:
+                del self._frames[i]
+                self._bytes -= frame[2]
+                OUTBOUND_DROPPED.inc(event=frame[0])
+                break
+        return False
+
+    def _transport_backlog(self) -> int:
+        """底层 engine.io 连接中尚未写出的包数；拿不到时（如测试替身）返回 0。"""
+        try:
+            eio_sid = self.sio.manager.eio_sid_from_sid(self.sid, "/")
+            socket = self.sio.eio.sockets.get(eio_sid)
+            return socket.queue.qsize() if socket is not None else 0
+        except AttributeError:
+            return 0
+
+    async def _flush(self):
+        await asyncio.sleep(OUTBOUND_TICK)
+        while self._frames and not self.closed:
+            if self._transport_backlog() > TRANSPORT_HIGH_WATER:
+                await asyncio.sleep(OUTBOUND_TICK)
+                continue
+            if self.wire is not None:
+                # 打包格式：把当前排队的全部帧编码成一个二进制包
+                frames = list(self._frames)
+                self._frames.clear()
+                self._bytes = 0
+                await self._emit(PACKED_EVENT, lambda: self.wire.encode_batch(frames))
+                continue
+            event, data, size = self._frames.popleft()
+            self._bytes -= size
+            WIRE_BYTES.inc(size + len(event) + JSON_PACKET_OVERHEAD, event=event, format="json")
+            await self._emit(event, lambda: data)
+
+    async def _emit(self, event: str, build: Callable[[], Any]):
+        try:
+            await self.sio.emit(event, build(), room=self.sid)
+        except Exception as e:
+            logger.warning("事件发送失败: %s", e, extra={"sid": self.sid, "event": event})
+
+    def _overflow(self):
+        logger.warning("出站队列溢出，断开慢客户端",
+                       extra={"sid": self.sid, "frames": len(self._frames), "bytes": self._bytes})
+        SLOW_CLIENT_DISCONNECTS.inc()
+        self.close()
+        if self.on_overflow is not None:
+            self.on_overflow(self.sid)
+
+    def close(self):
+        self.closed = True
+        self._frames.clear()
+        self._bytes = 0
+        if self._flusher is not None and self._flusher is not asyncio.current_task():
+            self._flusher.cancel()
+        self._flusher = None
@@ -1,25 +1,35 @@
 import os
-import json
-import requests
-from typing import Dict, Any, List, Optional
+import logging
+from typing import TYPE_CHECKING, Dict, Any, AsyncIterator, List, Optional
 from script_content import PLAYER_SCRIPTS , CHARACTERS,CLUES,INITIAL_PROMPTS
-from submodule.memory_rag.memory import RAGmanager
+from llm_client import LLM_API_URL, LLMError, default_headers, get_llm_client
+from memory_context import MemoryContext
+from model_routing import get_router
+from structured_output import Check, generate_structured
+from structured_log import get_logger
 import random
 
+if TYPE_CHECKING:
+    # 记忆模块依赖较重，只在类型检查时导入；运行时由 GameSession 在后台按需加载
+    from submodule.memory_rag.memory import RAGmanager
+
+logger = get_logger("player_agent")
+
 
 class AIPlayerAgent:
-    def __init__(self, player_id: str, role_name: str, rag_manager: RAGmanager, model_name: str = "gemini-2.5-flash"):
+    def __init__(self, player_id: str, role_name: str, rag_manager: Optional["RAGmanager"] = None, model_name: str = "gemini-2.5-flash",
+                 memory: Optional[MemoryContext] = None):
         self.player_id = player_id
         self.role_name = role_name
         self.rag_manager = rag_manager
+        # 有界的对话上下文：阶段摘要 + 最近消息，按 token 预算截断
+        self.memory = memory or MemoryContext(rag_manager)
         self.model = model_name
 
-        self.api_url = "https://api.xi-ai.cn/v1/chat/completions"
-        # 警告：为了测试，密钥暂时硬编码。在生产环境中，请务必使用环境变量或安全的密钥管理方式。
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer "
-        }
+        # 端点与密钥由环境变量 JUBENSHA_LLM_API_URL / OPENAI_API_KEY 配置；
+        # 它们与 model_name 是默认值，具体调用类型可由路由表（model_routing）改用其他模型或端点
+        self.api_url = LLM_API_URL
+        self.headers = default_headers()
 
         self.name = CHARACTERS[player_id]["name"]
         self.profession = CHARACTERS[player_id]["character_name"]
@@ -37,8 +47,10 @@ class AIPlayerAgent:
             "memories": [],
         }
         self.receive_initial_knowledge()
+        # 角色设定、秘密与人物关系在整局游戏中不变：只构建一次，作为逐字节相同的提示词前缀
+        self.system_prompt = self._build_system_prompt()
 
-        print(f"AI Player Agent '{self.player_id}' 初始化成功，角色名：{self.name}，职业：{self.profession}")
+        logger.debug("AI Player Agent 初始化成功", extra={"player_id": self.player_id, "profession": self.profession})
 
     def receive_initial_knowledge(self):
         """
@@ -69,25 +81,44 @@ class AIPlayerAgent:
         else:
             self.base_persona["secrets"] = [self.secrets]
 
-        print(f"AI Player Agent '{self.player_id}': 接收初始角色知识。")
+        logger.debug("AI Player Agent 接收初始角色知识", extra={"player_id": self.player_id})
         
-    def _call_api(self, messages: List[Dict[str, str]]) -> str:
-        """通用的 API 调用方法"""
-        data = {
-            "model": self.model,
-            "messages": messages
-        }
+    async def _request(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                       call_type: Optional[str] = None, **extra: Any) -> str:
+        """发送请求并返回模型输出，失败时抛出 LLMError。call_type 决定该调用能否命中响应缓存。"""
+        route = get_router().route(call_type)
+        url, headers, model = route.resolve(self.api_url, self.headers, self.model)
+        return await get_llm_client().chat(url, headers, model, messages, timeout=timeout,
+                                           call_type=call_type, agent=self.player_id, route=route.name, **extra)
+
+    async def _call_api(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                        call_type: Optional[str] = None) -> str:
+        """通用的 API 调用方法（异步，复用共享连接池）；失败时返回空字符串。"""
+        try:
+            return await self._request(messages, timeout=timeout, call_type=call_type)
+        except LLMError as e:
+            logger.error("Player Agent API 请求错误: %s", e, extra={"player_id": self.player_id})
+            return ""
+
+    async def _structured(self, messages: List[Dict[str, str]], schema: Dict[str, Any], call_type: str,
+                          check: Optional[Check] = None) -> Optional[Dict[str, Any]]:
+        """请求符合 schema 的 JSON 决策（投票、指认），必要时做一次修复调用；最终失败时返回 None。"""
+        return await generate_structured(
+            lambda msgs, **extra: self._request(msgs, call_type=call_type, **extra),
+            messages, schema, call_type, check)
+
+    async def _stream_api(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                          call_type: Optional[str] = None) -> AsyncIterator[str]:
+        """流式 API 调用：逐段产出模型输出；失败时停止产出（已产出的部分保留）。"""
+        route = get_router().route(call_type)
+        url, headers, model = route.resolve(self.api_url, self.headers, self.model)
         try:
-            response = requests.post(self.api_url, headers=self.headers, data=json.dumps(data))
-            response.raise_for_status()
-            result = response.json()
-            return result['choices'][0]['message']['content']
-        except requests.exceptions.RequestException as e:
-            print(f"Player Agent '{self.player_id}' API 请求错误: {e}")
-            return "对不起，我现在无法连接到服务器。"
-        except (KeyError, IndexError) as e:
-            print(f"Player Agent '{self.player_id}' 解析响应错误: {e} - 响应内容: {response.text}")
-            return "对不起，我收到了一个无法理解的回复。"
+            async for delta in get_llm_client().stream_chat(url, headers, model, messages,
+                                                            timeout=timeout, call_type=call_type,
+                                                            agent=self.player_id, route=route.name):
+                yield delta
+        except LLMError as e:
+            logger.error("Player Agent API 流式请求错误: %s", e, extra={"player_id": self.player_id})
 
     def _build_system_prompt(self) -> str:
         """
@@ -135,18 +166,14 @@ class AIPlayerAgent:
 
     def _build_user_prompt(self, player_input: str) -> str:
         """
-        构建包含当前记忆、线索和指令的用户输入部分。
+        构建包含当前线索和指令的用户输入部分（记忆以独立的对话轮次放在它之前）。
         """
-        memories_str = "\n".join(self.rag_manager.list_history())
         clues_str = "\n".join(self.knowledge_base.get("clues_obtained", []))
 
         user_prompt = f"""
         --- 游戏当前状态 ---
         已获线索：
         {clues_str or "无"}
-
-        游戏记忆（最近的对话历史）：
-        {memories_str or "无"}
         --------------------
 
         DM或真人玩家对你说："{player_input}"
@@ -155,17 +182,32 @@ class AIPlayerAgent:
         """
         return user_prompt
 
+    async def _build_messages(self, player_input: str) -> List[Dict[str, str]]:
+        """静态角色前缀 -> 追加式的记忆轮次 -> 线索与当前任务，变化的部分始终在最后。先等待已入队的发言写入记忆。"""
+        await self.memory.sync()
+        return [
+            {"role": "system", "content": self.system_prompt},
+            *self.memory.as_messages(),
+            {"role": "user", "content": self._build_user_prompt(player_input)}
+        ]
+
+    # 发言阶段 -> 调用类型（用于响应缓存与统计）
+    PHASE_CALL_TYPES = {
+        "Introduction": "introduction",
+        "Discussion": "statement",
+        "Sharing Clue": "clue_sharing",
+    }
+
     def receive_clue(self, clue: str):
         """
         接收线索并存储到知识库中。
         """
+        if clue in self.knowledge_base["clues_obtained"]:
+            return
         self.knowledge_base["clues_obtained"].append(clue)
-        print(f"AI Player Agent '{self.player_id}': 接收私有线索: {clue}")
+        logger.debug("AI Player Agent 接收私有线索: %s", clue, extra={"player_id": self.player_id})
 
-    def state(self, phase: str) -> str:
-        """
-        轮到自己发言，根据记忆和线索进行推理和陈述。
-        """
+    async def _build_state_messages(self, phase: str) -> List[Dict[str, str]]:
         prompt_instruction = ""
         if phase == "Introduction":
             prompt_instruction = "根据你的核心目标，向大家作出自我介绍。当前游戏进入第一阶段————阐述不在场证明，请根据你自己的经历，做一下自我介绍，描述一下对死者印象并进行不在场证明的陈述，以证明自己的清白。此阶段不应当过度暴露自己信息，字数尽量控制在150字以内"
@@ -174,18 +216,32 @@ class AIPlayerAgent:
         elif phase == "Sharing Clue":
             prompt_instruction = "现在是分享线索环节，请根据你已知的信息进行推断，说出你希望分享的线索。"
         
-        system_prompt = self._build_system_prompt()
-        user_prompt = self._build_user_prompt(prompt_instruction)
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        response = self._call_api(messages)
+        return await self._build_messages(prompt_instruction)
+
+    async def state(self, phase: str) -> str:
+        """
+        轮到自己发言，根据记忆和线索进行推理和陈述。
+        """
+        messages = await self._build_state_messages(phase)
+        response = await self._call_api(messages, call_type=self.PHASE_CALL_TYPES.get(phase))
 
-        print(f"[{self.name}] State Response ({phase}): {response}")
+        logger.debug("AI 发言回复: %s", response, extra={"player_id": self.player_id, "phase": phase})
         return response
 
-    def vote(self) -> Dict[str, str]:
+    async def state_stream(self, phase: str) -> AsyncIterator[str]:
+        """
+        state 的流式版本：边生成边产出发言片段。
+        """
+        messages = await self._build_state_messages(phase)
+        parts = []
+        async for delta in self._stream_api(messages, call_type=self.PHASE_CALL_TYPES.get(phase)):
+            parts.append(delta)
+            yield delta
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("AI 发言回复（流式）: %s", "".join(parts), extra={"player_id": self.player_id, "phase": phase})
+
+    async def vote(self) -> Dict[str, str]:
         """
         处理投票阶段的逻辑，生成结构化的投票结果。
         返回一个包含 'trust_id', 'suspect_id', 'statement' 的字典。
@@ -205,46 +261,42 @@ class AIPlayerAgent:
         可供选择的玩家姓名列表：{list(all_player_ids.keys())}
         请确保你选择的姓名严格来自此列表。
         """
-        system_prompt = self._build_system_prompt()
-        user_prompt = self._build_user_prompt(prompt_instruction)
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        
-        raw_response = self._call_api(messages)
-        print(f"[{self.name}] Raw Vote Response: {raw_response}")
+        messages = await self._build_messages(prompt_instruction)
+        names = list(all_player_ids.keys())
+        schema = {
+            "type": "object",
+            "properties": {
+                "trust": {"type": "string", "enum": names},
+                "suspect": {"type": "string", "enum": names},
+                "statement": {"type": "string", "minLength": 1},
+            },
+            "required": ["trust", "suspect", "statement"],
+            "additionalProperties": False,
+        }
+        vote_data = await self._structured(
+            messages, schema, "vote",
+            check=lambda d: "trust 与 suspect 不能是同一位玩家" if d["trust"] == d["suspect"] else None)
+        logger.debug("AI 投票回复: %s", vote_data, extra={"player_id": self.player_id})
 
-        try:
-            # 尝试解析 AI 返回的 JSON
-            vote_data = json.loads(raw_response.strip())
-            trust_name = vote_data.get("trust")
-            suspect_name = vote_data.get("suspect")
-            statement = vote_data.get("statement", "我根据我的判断做出了投票。")
-
-            trust_id = all_player_ids.get(trust_name)
-            suspect_id = all_player_ids.get(suspect_name)
-
-            if not trust_id or not suspect_id or trust_id == suspect_id:
-                raise ValueError("Invalid player name or trust/suspect are the same.")
-
-            return {"trust_id": trust_id, "suspect_id": suspect_id, "statement": statement}
-
-        except (json.JSONDecodeError, ValueError, KeyError) as e:
-            print(f"AI vote parsing for {self.name} failed: {e}. Falling back to random vote.")
-            # 如果解析失败，执行随机投票作为后备方案
-            other_ids = list(all_player_ids.values())
-            trust_id = random.choice(other_ids)
-            suspect_id = random.choice([x for x in other_ids if x != trust_id])
-            
-            trust_name = CHARACTERS[trust_id]['name']
-            suspect_name = CHARACTERS[suspect_id]['name']
-            statement = f"我仔细想了想，还是决定信任 {trust_name}，同时，我对 {suspect_name} 抱有一些怀疑。"
-            
-            return {"trust_id": trust_id, "suspect_id": suspect_id, "statement": statement}
-
-
-    def accuse(self) -> Dict[str, str]:
+        if vote_data is not None:
+            return {"trust_id": all_player_ids[vote_data["trust"]],
+                    "suspect_id": all_player_ids[vote_data["suspect"]],
+                    "statement": vote_data["statement"]}
+
+        # 调用失败或修复后仍不合格时，执行随机投票作为最后的后备方案
+        logger.warning("AI 投票不可用，改为随机投票", extra={"player_id": self.player_id})
+        other_ids = list(all_player_ids.values())
+        trust_id = random.choice(other_ids)
+        suspect_id = random.choice([x for x in other_ids if x != trust_id])
+
+        trust_name = CHARACTERS[trust_id]['name']
+        suspect_name = CHARACTERS[suspect_id]['name']
+        statement = f"我仔细想了想，还是决定信任 {trust_name}，同时，我对 {suspect_name} 抱有一些怀疑。"
+
+        return {"trust_id": trust_id, "suspect_id": suspect_id, "statement": statement}
+
+
+    async def accuse(self) -> Dict[str, str]:
         """
         处理指控阶段的逻辑，生成结构化的指控结果。
         返回一个包含 'accused_id', 'statement' 的字典。
@@ -263,48 +315,40 @@ class AIPlayerAgent:
         可供选择的玩家姓名列表：{list(all_player_ids.keys())}
         请确保你选择的姓名严格来自此列表。
         """
-        system_prompt = self._build_system_prompt()
-        user_prompt = self._build_user_prompt(prompt_instruction)
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        
-        raw_response = self._call_api(messages)
-        print(f"[{self.name}] Raw Accuse Response: {raw_response}")
-
-        try:
-            accuse_data = json.loads(raw_response.strip())
-            accused_name = accuse_data.get("accused")
-            statement = accuse_data.get("statement", "经过深思熟虑，我指认的凶手就是你。")
+        messages = await self._build_messages(prompt_instruction)
+        schema = {
+            "type": "object",
+            "properties": {
+                "accused": {"type": "string", "enum": list(all_player_ids.keys())},
+                "statement": {"type": "string", "minLength": 1},
+            },
+            "required": ["accused", "statement"],
+            "additionalProperties": False,
+        }
+        accuse_data = await self._structured(messages, schema, "accuse")
+        logger.debug("AI 指认回复: %s", accuse_data, extra={"player_id": self.player_id})
 
-            accused_id = all_player_ids.get(accused_name)
+        if accuse_data is not None:
+            return {"accused_id": all_player_ids[accuse_data["accused"]], "statement": accuse_data["statement"]}
 
-            if not accused_id:
-                raise ValueError("Invalid player name provided.")
+        logger.warning("AI 指认不可用，改为随机指认", extra={"player_id": self.player_id})
+        other_ids = list(all_player_ids.values())
+        accused_id = random.choice(other_ids)
 
-            return {"accused_id": accused_id, "statement": statement}
+        accused_name = CHARACTERS[accused_id]['name']
+        statement = f"所有的线索都指向了一个人……我最终决定指认的凶手是 {accused_name}。"
 
-        except (json.JSONDecodeError, ValueError, KeyError) as e:
-            print(f"AI accuse parsing for {self.name} failed: {e}. Falling back to random accusation.")
-            other_ids = list(all_player_ids.values())
-            accused_id = random.choice(other_ids)
-            
-            accused_name = CHARACTERS[accused_id]['name']
-            statement = f"所有的线索都指向了一个人……我最终决定指认的凶手是 {accused_name}。"
-            
-            return {"accused_id": accused_id, "statement": statement}
+        return {"accused_id": accused_id, "statement": statement}
 
-    
-    def act_and_respond(self, signal, external_input: str) -> Optional[str]:
+    async def act_and_respond(self, signal, external_input: str) -> Optional[str]:
         """
         AI Player Agent 的主入口，处理外部输入并生成回应。
         """
         if signal == "Introduction":
-            return self.state("Introduction")
+            return await self.state("Introduction")
 
         if signal == "Discussion":
-            return self.state("Discussion")
+            return await self.state("Discussion")
 
         # 更新公开信息/线索
         if signal == "public_clue_receive":
@@ -314,21 +358,33 @@ class AIPlayerAgent:
         # 私聊 (假设私聊后需要回应)
         if signal == "private_conversation":
             self.receive_clue(external_input)
-            return self.state("Sharing Clue")
+            return await self.state("Sharing Clue")
 
         if signal == "Sharing Clue":
-            return self.state("Sharing Clue")
+            return await self.state("Sharing Clue")
 
         # 信任阶段
         if signal == "trust_vote" or signal == "suspect_vote":
-            return self.vote()
+            return await self.vote()
 
         # 投票阶段
         if signal == "accuse":
-            return self.accuse()
+            return await self.accuse()
         
         return None
 
+    async def act_and_respond_stream(self, signal, external_input: str) -> AsyncIterator[str]:
+        """
+        act_and_respond 中发言类信号（自我介绍、讨论、分享线索）的流式版本。
+        """
+        if signal == "private_conversation":
+            self.receive_clue(external_input)
+            signal = "Sharing Clue"
+
+        if signal not in ("Introduction", "Discussion", "Sharing Clue"):
+            return
+        async for delta in self.state_stream(signal):
+            yield delta
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import time
+from typing import Any, Callable, List, Optional
+
+from metrics import RAG_INGEST_COMMIT_SECONDS, RAG_INGEST_FAILURES
+from structured_log import bind_room, get_logger
+
+logger = get_logger("rag_ingest")
+
+# ----------------- 记忆写入配置 -----------------
+# 聊天消息先进入队列，由后台任务成批写入 RAGmanager（在线程池中执行，不阻塞事件循环）。
+# 第一条消息入队后最多等待 BATCH_DELAY 秒凑批；有人读取记忆（flush）时立即提交
+INGEST_BATCH_DELAY = float(os.environ.get("JUBENSHA_RAG_BATCH_DELAY", "0.05"))
+# 单批最多写入的消息条数
+INGEST_BATCH_SIZE = int(os.environ.get("JUBENSHA_RAG_BATCH_SIZE", "32"))
+
+
+class RagIngestQueue:
+    """
+    单局的 RAG 记忆写入队列。add_message 只负责入队，不再在广播路径上同步做向量化与索引更新。
+    RAGmanager 由 open_rag 在线程池中按需构建（首次写入、首次 flush 或预热时），不占用对局创建与服务启动的时间。
+    写入由唯一的后台任务串行执行，RAGmanager 不会被并发访问；每批写入后在同一线程内取一次
+    list_history() 快照，事件循环上的读取只读快照。
+    读己之写：flush() 返回时，此前入队的消息都已写入并反映在 list_history() 中。
+    """
+
+    def __init__(self, open_rag: Callable[[], Any], room_id: str = ""):
+        self._open_rag = open_rag
+        self.rag_manager = None
+        self.room_id = room_id
+        self._opening: Optional[asyncio.Task] = None
+        self._pending: List[dict] = []
+        self._history: List[str] = []
+        # 已入队 / 已写入（含失败）的消息序号，flush 据此判断是否追上
+        self._submitted = 0
+        self._committed = 0
+        self._wakeup = asyncio.Event()
+        self._urgent = asyncio.Event()
+        self._progress = asyncio.Condition()
+        self._worker: Optional[asyncio.Task] = None
+        self.batches = 0
+
+    @property
+    def depth(self) -> int:
+        """已入队但尚未写入的消息数（含正在写入的一批）。"""
+        return self._submitted - self._committed
+
+    def submit(self, conversation_text: str, round_number: int, speakers: List[str], timestamp: str):
+        """入队一条对话，参数与 RAGmanager.add_conversation_single 相同。"""
+        self._pending.append({"conversation_text": conversation_text, "round_number": round_number,
+                              "speakers": speakers, "timestamp": timestamp})
+        self._submitted += 1
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    def list_history(self) -> List[str]:
+        """最近一次写入后的历史快照；需要包含刚入队的消息时先 await flush()。"""
+        return self._history
+
+    async def open(self):
+        """构建或加载记忆索引；可以重复调用，只执行一次。构建失败时记忆保持为空，之后的写入计为失败。"""
+        if self._opening is None:
+            self._opening = asyncio.create_task(self._open())
+        await asyncio.shield(self._opening)
+
+    async def _open(self):
+        started = time.monotonic()
+        try:
+            self.rag_manager, self._history = await asyncio.to_thread(self._open_in_thread)
+        except Exception as e:
+            logger.error("[RAG] 记忆索引构建失败: %s", e)
+            return
+        logger.info("[RAG] 记忆索引已就绪", extra={"room_id": self.room_id, "entries": len(self._history),
+                                              "seconds": round(time.monotonic() - started, 3)})
+
+    def _open_in_thread(self):
+        rag_manager = self._open_rag()
+        return rag_manager, list(rag_manager.list_history())
+
+    async def flush(self):
+        """立即提交排队中的消息，并等待此前入队的消息全部写入。"""
+        await self.open()
+        target = self._submitted
+        if self._committed >= target:
+            return
+        self._urgent.set()
+        async with self._progress:
+            await self._progress.wait_for(lambda: self._committed >= target)
+
+    async def _run(self):
+        bind_room(self.room_id)
+        await self.open()
+        while True:
+            await self._wakeup.wait()
+            if not self._urgent.is_set() and len(self._pending) < INGEST_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self._urgent.wait(), INGEST_BATCH_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self._pending = self._pending[:INGEST_BATCH_SIZE], self._pending[INGEST_BATCH_SIZE:]
+            if not self._pending:
+                self._wakeup.clear()
+                self._urgent.clear()
+            started = time.monotonic()
+            try:
+                self._history = await asyncio.to_thread(self._commit, batch)
+            except Exception as e:
+                logger.error("[RAG] 读取对话历史失败: %s", e)
+            RAG_INGEST_COMMIT_SECONDS.observe(time.monotonic() - started)
+            self.batches += 1
+            async with self._progress:
+                self._committed += len(batch)
+                self._progress.notify_all()
+
+    def _commit(self, batch: List[dict]) -> List[str]:
+        """在线程池中执行：逐条写入本批消息，返回写入后的历史快照。单条失败不影响其余消息。"""
+        if self.rag_manager is None:
+            RAG_INGEST_FAILURES.inc(len(batch))
+            return self._history
+        for item in batch:
+            try:
+                self.rag_manager.add_conversation_single(**item)
+            except Exception as e:
+                RAG_INGEST_FAILURES.inc()
+                logger.error("[RAG] 记录对话失败: %s", e)
+        return list(self.rag_manager.list_history())
+
+    def stats(self) -> dict:
+        return {"open": self.rag_manager is not None, "depth": self.depth, "committed": self._committed,
+                "batches": self.batches}
+
+    def cancel(self):
+        if self._worker is not None:
+            self._worker.cancel()
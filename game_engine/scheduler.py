@@ -0,0 +1,94 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from structured_log import bind_room, get_logger
+
+logger = get_logger("scheduler")
+
+Step = Callable[[], Awaitable[None]]
+
+
+class SessionScheduler:
+    """
+    单局游戏的流程调度器：所有推进游戏的步骤（开局、advance_game、恢复）都放进同一个队列，
+    由唯一的消费者任务依次执行，保证同一局在任一时刻只有一个驱动者在修改状态。
+    同名步骤尚在排队时不会重复入队（推进步骤本身根据当前状态决定做什么，合并不会丢失信息）。
+    步骤内部派生的后台任务通过 spawn 登记，cancel() 时一并取消。
+    """
+
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self._queue: "asyncio.Queue[tuple]" = asyncio.Queue()
+        self._pending: Dict[str, int] = {}
+        self._worker: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.running: Optional[str] = None
+        self.steps_run = 0
+
+    @property
+    def depth(self) -> int:
+        """排队中（尚未开始执行）的步骤数。"""
+        return self._queue.qsize()
+
+    def submit(self, name: str, step: Step) -> bool:
+        """把一个步骤放进队列；同名步骤已在排队时直接合并，返回是否入队。"""
+        if self._pending.get(name):
+            return False
+        self._pending[name] = self._pending.get(name, 0) + 1
+        self._queue.put_nowait((name, step))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return True
+
+    async def _run(self):
+        bind_room(self.room_id)
+        while True:
+            name, step = await self._queue.get()
+            self._pending[name] -= 1
+            self.running = name
+            try:
+                await step()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("推进步骤执行失败: %s", e, extra={"step": name})
+            finally:
+                self.running = None
+                self.steps_run += 1
+                self._queue.task_done()
+
+    def spawn(self, coro) -> asyncio.Task:
+        """启动一个后台任务并登记，避免被提前回收，也便于取消。"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def join(self):
+        """等待队列中的步骤全部执行完（不含之后新入队的）。"""
+        await self._queue.join()
+
+    async def wait_background(self):
+        """等待当前登记的后台任务（如阶段摘要）全部结束，忽略其中的异常。"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def cancel(self):
+        """取消正在执行的步骤、排队中的步骤以及所有登记的后台任务。"""
+        while not self._queue.empty():
+            self._queue.get_nowait()
+            self._queue.task_done()
+        self._pending.clear()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._tasks):
+            task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth,
+            "running": self.running,
+            "background_tasks": len(self._tasks),
+            "steps_run": self.steps_run,
+        }
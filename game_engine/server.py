@@ -1,54 +1,60 @@
 import asyncio
 import json
+import logging
+import signal
+import time
+import uuid
+from urllib.parse import parse_qsl
+from startup import STARTUP  # 启动计时从这里开始，需早于其他较重的导入
 import socketio
 from aiohttp import web
-from dm_agent import DMAgent
-from player_agent import AIPlayerAgent
-# ----------------- RAG 长时记忆初始化 -----------------
-import os, time
-from submodule.memory_rag.memory import RAGmanager
-
-# 为每一局游戏创建独立的记忆目录（按时间戳区分）
-_session_dir = os.path.join("rag_dbs", f"game_{int(time.time())}")
-os.makedirs(_session_dir, exist_ok=True)
-
-# 初始化 RAGmanager，并立即构建/加载索引
-rag_manager = RAGmanager(save_path=_session_dir)
-rag_manager.build_index()
-
-# ----------------- Agents 初始化 -----------------
-dm_agent = DMAgent(rag_manager=rag_manager)
-ai_agents: dict[str, AIPlayerAgent] = {}
+from llm_client import NARRATIVE_TIMEOUT, close_llm_client, get_llm_client
+from model_routing import RouteStats, get_router
+from journal import JOURNAL_WRITER
+from game_session import (DEFAULT_ROOM_ID, SESSION_REAP_INTERVAL, GameSession, SessionManager, import_rag_manager,
+                          is_valid_room_id)
+import metrics
+from message_history import INITIAL_MESSAGES
+from state_log import append_op, merge_op
+from structured_log import bind_room, get_logger, setup_logging
+from turn_order import ANNOUNCE_BUDGET, TURN_ORDER_POLICY, compute_turn_order
+from wire_format import json_size, json_str_size, negotiate as negotiate_wire
+import os
 
 from script_content import CHARACTERS, CLUES, INITIAL_PROMPTS
 
+STARTUP.mark("imports")
 
 # ----------------- AI Notification Helper (DEPRECATED) -----------------
 # The new agent-based logic does not require broadcasting messages to AI players.
 # They will fetch memories from the RAG manager when needed.
 
+# ----------------- Logging -----------------
+# 日志写入内存队列，由后台线程输出；级别与格式由 JUBENSHA_LOG_LEVEL / JUBENSHA_LOG_FORMAT 控制
+setup_logging()
+logger = get_logger("server")
+
 # ----------------- Socket.IO Server Setup -----------------
 sio = socketio.AsyncServer(async_mode='aiohttp', cors_allowed_origins='*')
 app = web.Application()
 sio.attach(app)
-
-# ----------------- Game State Management -----------------
-game_state = {
-    "stage": "waiting_for_players",
-    "players": {},
-    "turn_order": [],
-    "current_speaker_index": 0,
-    "clues": {}, # Changed to dict for easier access
-    "statements": {},
-    "votes": {},
-    "accusations": {},
-    "public_clues": [],
-    "messages": [], # To store chat history
-    "pending_action": None
-}
-
-# Maps player_id to their socket_id (sid)
-player_sids = {}
+# 进程退出时关闭共享的 LLM 连接池
+app.on_cleanup.append(close_llm_client)
+
+# ----------------- Metrics -----------------
+# LLM 调用记入延迟直方图；事件循环延迟由后台任务定期采样
+get_llm_client().add_observer(metrics.observe_llm_call)
+# 按模型路由统计延迟与 token，供 /llm_routes 查看
+route_stats = RouteStats()
+get_llm_client().add_observer(route_stats.observe)
+loop_lag_monitor = metrics.LoopLagMonitor()
+app.on_startup.append(loop_lag_monitor.start)
+app.on_cleanup.append(loop_lag_monitor.stop)
+
+# ----------------- Game Session Management -----------------
+# 每个房间（room query 参数）对应一个独立的 GameSession：状态、Agent、记忆与 socketio 房间。
+# 从对局日志恢复出的对局（服务重启或被回收后有人重新进入）在后台继续推进
+sessions = SessionManager(sio, on_restore=lambda session: schedule_resume(session))
 
 # ----------------- 阶段中文映射 -----------------
 STAGE_LABELS = {
@@ -73,7 +79,9 @@ def stage_update_dict(stage_code: str):
 
 # ----------------- Helper: generate public game state -----------------
 # 供前端刷新/重连时一次性同步当前公共信息
-def build_public_game_state():
+def build_public_game_state(session: GameSession):
+    game_state = session.game_state
+    player_sids = session.player_sids
     current_player_id = (
         game_state["turn_order"][game_state["current_speaker_index"]]
         if game_state["turn_order"] and game_state["current_speaker_index"] < len(game_state["turn_order"]) else None
@@ -103,36 +111,31 @@ def build_public_game_state():
                 "public_info": {"character_name": pinfo.get("character_name", pinfo["name"]), "status": "存活"}
             }
             for pid, pinfo in CHARACTERS.items()
-        ]
+        ],
+        "public_clues": game_state["public_clues"],
+        "votes": game_state["votes"],
+        "accusations": game_state["accusations"],
     }
     return public_state
 
-def initialize_game():
-    """Initializes the game state and AI agents."""
-    global ai_agents
-    for player_id, player_info in CHARACTERS.items():
-        game_state["players"][player_id] = {
-            "id": player_id,
-            "name": player_info["name"],
-            "is_ai": player_info["is_ai"],
-            "clues": []
-        }
-        if player_info["is_ai"] and player_id != 'dm':
-             ai_agents[player_id] = AIPlayerAgent(
-                 player_id=player_id,
-                 role_name=player_info["name"],
-                 rag_manager=rag_manager
-             )
-
-    print("Game initialized with players:", game_state["players"])
-    print("AI agents initialized:", list(ai_agents.keys()))
+# LLM 暂时不可用时代替空发言的系统提示
+LLM_UNAVAILABLE_TEXT = "{name} 暂时无法发言（AI 服务连接失败）。"
+WHISPER_UNAVAILABLE_TEXT = "抱歉，我现在无法连接到服务器，请稍后再问。"
 
-
-def add_message(text, msg_type="system", author="系统", author_id="system"):
-    """Adds a message to the game state, prints it to the console, and returns it."""
+def add_message(session: GameSession, text, msg_type="system", author="系统", author_id="system", stream_id=None,
+                remember=False):
+    """
+    Adds a message to the game state, prints it to the console, and returns it.
+    聊天消息总会写入 RAG 记忆；其他类型的消息只有 remember=True 时才写入（如公布的发言顺序）。
+    """
+    game_state = session.game_state
 
     import datetime
 
+    # LLM 调用最终失败时发言为空：改记为系统提示，不计入聊天，也不写入 RAG 记忆
+    if msg_type == "chat" and not text:
+        text, msg_type = LLM_UNAVAILABLE_TEXT.format(name=author), "system"
+
     # Frontend 期望的字段：from_id, from_name, content, type, timestamp
     message = {
         "from_id": author_id,
@@ -141,113 +144,352 @@ def add_message(text, msg_type="system", author="系统", author_id="system"):
         "type": msg_type,
         "timestamp": datetime.datetime.utcnow().isoformat()
     }
-    game_state["messages"].append(message)
-    # Print messages for debugging purposes
-    print("--- MESSAGES UPDATED ---")
-    # Pretty print the last 5 messages
-    import json
-    print(json.dumps(game_state["messages"][-5:], indent=2, ensure_ascii=False))
-    print("------------------------")
+    # 流式消息在结束时带上 stream_id，前端据此把草稿替换为正式消息
+    if stream_id:
+        message["stream_id"] = stream_id
+    session.messages.append(message)
+    if msg_type == "chat":
+        session.chat_count += 1
+        if not CHARACTERS.get(author_id, {}).get("is_ai", True):
+            session.human_chat_count += 1
+    # 最近 5 条消息的调试输出：只有开启 DEBUG 级别时才序列化
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("消息已更新，最近的消息:\n%s", json.dumps(session.messages.recent(5), indent=2, ensure_ascii=False))
 
     # -------- 将聊天内容写入 RAG 长时记忆 --------
-    if msg_type == "chat":
-        try:
-            # 根据当前阶段推断轮次（0 代表尚未开始）
-            round_num = 1 if "1" in game_state["stage"] else (2 if "2" in game_state["stage"] else 0)
-
-            # 使用线程池避免阻塞事件循环
-            # This is already async, no need to wrap in another task
-            rag_manager.add_conversation_single(
-                conversation_text=text,
-                round_number=round_num,
-                speakers=[author],
-                timestamp=message["timestamp"]
-            )
-            print(rag_manager.list_history())
-        except Exception as e:
-            print(f"[RAG] 记录对话失败: {e}")
+    # 只入队：向量化与索引更新由写入队列在线程池中成批完成，Agent 构建提示词前会等待其写入
+    if msg_type == "chat" or remember:
+        # 根据当前阶段推断轮次（0 代表尚未开始）
+        round_num = 1 if "1" in game_state["stage"] else (2 if "2" in game_state["stage"] else 0)
+        session.rag_ingest.submit(
+            conversation_text=text,
+            round_number=round_num,
+            speakers=[author],
+            timestamp=message["timestamp"]
+        )
 
     return message
 
+async def enter_stage(session: GameSession, next_stage: str, extra_updates=None):
+    """切换到下一阶段并广播；刚结束的阶段的对话在后台压缩成摘要，供之后的提示词复用。"""
+    game_state = session.game_state
+    previous_stage = game_state["stage"]
+    game_state["stage"] = next_stage
+    now = time.monotonic()
+    metrics.STAGE_DURATION.observe(now - session.stage_started_at, stage=previous_stage)
+    session.stage_started_at = now
+
+    # 上一阶段未用上的预生成草稿作废
+    session.speculator.discard_all()
+
+    update = stage_update_dict(next_stage)
+    if extra_updates:
+        update.update(extra_updates)
+    await session.publish('game_state_update', update)
+    # 阶段切换时立即提交排队中的发言，阶段摘要与下一阶段的提示词都基于完整的记录
+    await session.rag_ingest.flush()
+
+    if previous_stage != "waiting_for_players":
+        session.spawn(session.memory.close_stage(translate_stage(previous_stage), session.dm_agent.summarize))
+
 # No longer need give_clue_to_player, it's handled in the investigation stage directly
 
+# ----------------- Streaming Helpers -----------------
+# 开启后，AI/DM 的发言以 message_delta 事件逐段推送，结束时再发送带 stream_id 的 new_message
+STREAMING_ENABLED = os.environ.get("JUBENSHA_STREAMING", "1") != "0"
+
+# 流程中刻意的停顿（秒）：取证结束后、公布真相与结算之间。基准测试可以把它们设为 0
+INVESTIGATION_PAUSE = 2
+REVEAL_PAUSE = 5
+
+
+async def _single_chunk(coro):
+    """把一次性返回整段文本的协程包装成只有一段的流。"""
+    text = await coro
+    if text:
+        yield text
+
+
+async def _text_chunks(text):
+    """把固定文本包装成只有一段的流（用于兜底发言）。"""
+    yield text
+
+
+def ai_speech(agent, signal):
+    """返回 AI 玩家发言的增量输出；关闭流式模式时退化为一次性返回整段文本。"""
+    if STREAMING_ENABLED:
+        return agent.act_and_respond_stream(signal, "")
+    return _single_chunk(agent.act_and_respond(signal, ""))
+
+
+def dm_speech(session: GameSession, prompt, timeout=None):
+    """返回 DM 叙述（真相揭晓、结算等）的增量输出。"""
+    dm_agent = session.dm_agent
+    if STREAMING_ENABLED:
+        return dm_agent.handle_external_message_stream(prompt, timeout=timeout)
+    return _single_chunk(dm_agent.handle_external_message(prompt, timeout=timeout))
+
+
+async def relay_stream(session: GameSession, chunks, stream_id, author, author_id, msg_type="chat", to=None):
+    """把增量输出逐段以 message_delta 推送给前端，返回拼接后的完整文本。"""
+    parts = []
+    header = {
+        "stream_id": stream_id,
+        "from_id": author_id,
+        "from_name": author,
+        "type": msg_type,
+    }
+    # 同一条流的各段只有 delta 不同：其余字段的编码大小只算一次，不必为统计逐段序列化
+    header_size = json_size({**header, "delta": ""}) - json_str_size("")
+    async for delta in chunks:
+        if not delta:
+            continue
+        parts.append(delta)
+        await session.emit('message_delta', {**header, "delta": delta}, to=to,
+                           size=header_size + json_str_size(delta))
+    return "".join(parts)
+
+
+async def stream_message(session: GameSession, chunks, msg_type="chat", author="系统", author_id="system"):
+    """流式推送一条公共消息，结束后写入消息历史与 RAG 记忆并广播 new_message。"""
+    stream_id = uuid.uuid4().hex
+    text = await relay_stream(session, chunks, stream_id, author, author_id, msg_type)
+    message = add_message(session, text, msg_type=msg_type, author=author, author_id=author_id, stream_id=stream_id)
+    await session.publish('new_message', message)
+    return message
+
+
+_STREAM_END = object()
+
+
+def buffer_stream(session: GameSession, chunks):
+    """
+    立即在后台开始消费 chunks 并缓存，返回按原顺序产出这些片段的流。
+    用于并发生成、按序播出：轮到某人之前生成的片段先缓存，轮到他时一次补发，之后边生成边推送。
+    生成过程中的异常在流的末尾重新抛出。
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for delta in chunks:
+                queue.put_nowait(delta)
+        finally:
+            queue.put_nowait(_STREAM_END)
+
+    task = session.spawn(pump())
+
+    async def drain():
+        while True:
+            delta = await queue.get()
+            if delta is _STREAM_END:
+                break
+            yield delta
+        await task
+
+    return drain()
+
+
+def ai_share_clues(session: GameSession, player_id, player_clues):
+    """把本轮线索交给 AI 玩家，并在后台开始生成其分享线索的发言，返回缓存好的发言流。"""
+    agent = session.ai_agents.get(player_id)
+    if not agent:
+        return _text_chunks("我获得了一些线索，正在分析中。")
+    for clue in player_clues:
+        agent.receive_clue(clue)
+    return buffer_stream(session, ai_speech(agent, "Sharing Clue"))
+
+def speculate_next_speaker(session: GameSession, signal):
+    """当前发言人说话（或等待人类玩家输入）的同时，在后台预生成下一位 AI 发言人的发言。"""
+    game_state = session.game_state
+    next_index = game_state["current_speaker_index"] + 1
+    if next_index >= len(game_state["turn_order"]):
+        return
+    next_id = game_state["turn_order"][next_index]
+    agent = session.ai_agents.get(next_id)
+    if agent is None:
+        return
+    # 当前发言人的发言一定在草稿开始之后才到来，预先计入快照，否则草稿永远会被判为过期
+    current_id = game_state["turn_order"][game_state["current_speaker_index"]]
+    own_human = 0 if CHARACTERS.get(current_id, {}).get("is_ai", True) else 1
+    session.speculator.prefetch(game_state["stage"], next_id, session.chat_count + 1,
+                                lambda: agent.act_and_respond(signal, ""),
+                                human_count=session.human_chat_count + own_human)
+
+
+async def ai_turn_speech(session: GameSession, player_id, signal):
+    """AI 发言人的发言流：有可用的预生成草稿时直接采用，否则现场生成。"""
+    draft = await session.speculator.take(session.game_state["stage"], player_id, session.chat_count,
+                                          human_count=session.human_chat_count)
+    if draft:
+        return _text_chunks(draft)
+    return ai_speech(session.ai_agents[player_id], signal)
+
+async def dm_turn_order(session: GameSession, dm_prompt, fallback_announcement):
+    """让 DM 以结构化输出决定发言顺序与宣布词，返回 (turn_order, announcement)；失败时按座位顺序兜底。"""
+    game_state = session.game_state
+    player_ids = [pid for pid in game_state["players"] if pid != 'dm']
+    schema = {
+        "type": "object",
+        "properties": {
+            "turn_order": {"type": "array", "items": {"type": "string", "enum": player_ids},
+                           "minItems": len(player_ids), "maxItems": len(player_ids), "uniqueItems": True},
+            "announcement": {"type": "string", "minLength": 1},
+        },
+        "required": ["turn_order", "announcement"],
+        "additionalProperties": False,
+    }
+    dm_data = await session.dm_agent.handle_structured_message(dm_prompt, schema, "turn_order")
+    if dm_data is not None:
+        return dm_data["turn_order"], dm_data["announcement"]
+    logger.warning("DM 发言顺序生成失败，改用默认顺序", extra={"stage": game_state["stage"]})
+    order_text = " -> ".join(game_state["players"][pid]["name"] for pid in player_ids)
+    return player_ids, fallback_announcement.format(order=order_text)
+
+
+async def set_turn_order(session: GameSession, dm_prompt, announcement_prefix):
+    """
+    决定并公布本阶段的发言顺序。默认由本地策略立即算出（见 turn_order），首位发言人不必等待 LLM；
+    DM 风格的宣布词在后台生成。JUBENSHA_TURN_ORDER=dm 时沿用旧方式，阻塞等待 DM 决定。
+    """
+    game_state = session.game_state
+    if TURN_ORDER_POLICY == "dm":
+        order, announcement = await dm_turn_order(session, dm_prompt, announcement_prefix + "{order}")
+        order_message = add_message(session, announcement, msg_type="chat", author="DM", author_id="dm")
+    else:
+        player_ids = [pid for pid in game_state["players"] if pid != 'dm']
+        order = compute_turn_order(TURN_ORDER_POLICY, player_ids, game_state["turn_order_seed"], game_state["stage"],
+                                   game_state["vote_history"])
+        order_text = " -> ".join(game_state["players"][pid]["name"] for pid in order)
+        # 与旧方式一样写入记忆，AI 玩家发言时知道自己排在谁的前后
+        order_message = add_message(session, announcement_prefix + order_text, remember=True)
+        if ANNOUNCE_BUDGET > 0:
+            session.spawn(announce_turn_order(session, order))
+
+    game_state["turn_order"] = order
+    game_state["current_speaker_index"] = 0
+    await session.publish('game_state_update', {"turn_order": game_state["turn_order"]})
+    await session.publish('new_message', order_message)
+    logger.info("发言顺序已确定", extra={"turn_order": order, "policy": TURN_ORDER_POLICY})
+
+
+async def announce_turn_order(session: GameSession, order):
+    """后台生成 DM 对发言顺序的宣布词；超出 ANNOUNCE_BUDGET 或阶段已切换时放弃。"""
+    game_state = session.game_state
+    stage = game_state["stage"]
+    names = "、".join(game_state["players"][pid]["name"] for pid in order)
+    prompt = f"现在进入“{translate_stage(stage)}”。本阶段的发言顺序是：{names}。请用DM的口吻，用一两句话向所有玩家宣布这个顺序并营造气氛，只输出宣布词。"
+    try:
+        text = await asyncio.wait_for(session.dm_agent.handle_external_message(prompt, call_type="announcement"),
+                                      ANNOUNCE_BUDGET)
+    except asyncio.TimeoutError:
+        logger.info("发言顺序宣布超出时间预算，已跳过", extra={"stage": stage})
+        return
+    if not text or game_state["stage"] != stage:
+        return
+    # 只是气氛描写：不计入聊天也不写入 RAG 记忆（"turn" 类型留给结算叙述，前端据此判断游戏结束）
+    message = add_message(session, text.strip(), msg_type="narration", author="DM", author_id="dm")
+    await session.publish('new_message', message)
+
 # ----------------- Game Flow and Logic -----------------
-async def advance_game():
+# 推进游戏的步骤都经由本局的调度器串行执行：同一时刻只有一个 advance_game 在修改状态，
+# 排队中的重复请求会被合并：advance_game 根据当前状态决定下一步，需要继续时会再次请求，合并不会漏掉推进
+def schedule_advance(session: GameSession):
+    session.scheduler.submit("advance", lambda: advance_game(session))
+
+
+def schedule_start(session: GameSession):
+    session.scheduler.submit("start", lambda: start_game_flow(session))
+
+
+def schedule_resume(session: GameSession):
+    session.scheduler.submit("resume", lambda: resume_session(session))
+
+
+async def advance_game(session: GameSession):
     """Drives the game forward based on the current state."""
+    game_state = session.game_state
+    player_sids = session.player_sids
+    dm_agent = session.dm_agent
+    ai_agents = session.ai_agents
     stage = game_state["stage"]
-    print(f"Advancing game, current stage: {stage}")
+    bind_room(session.room_id)
+    logger.info("推进游戏", extra={"stage": stage})
+    # 每次推进前记录一次状态（如发言人序号的变化），进程在推进途中退出也能从这里恢复
+    session.checkpoint()
 
     # The erroneous example code is now completely removed.
 
     if stage == "alibi":
         if game_state["current_speaker_index"] >= len(game_state["turn_order"]):
             # This is the correct place to transition the stage
-            game_state["stage"] = "investigation_1"
-            await sio.emit('game_state_update', stage_update_dict("investigation_1"))
-            message = add_message("不在场证明陈述结束，进入现场取证阶段。")
-            await sio.emit('new_message', message)
-            asyncio.create_task(advance_game())
+            await enter_stage(session, "investigation_1")
+            message = add_message(session, "不在场证明陈述结束，进入现场取证阶段。")
+            await session.publish('new_message', message)
+            schedule_advance(session)
             return
         
         player_id = game_state["turn_order"][game_state["current_speaker_index"]]
         player = game_state["players"][player_id]
         
         # FIX: Add the missing state update for the current player
-        await sio.emit('game_state_update', {"current_player_id": player_id})
+        await session.publish('game_state_update', {"current_player_id": player_id})
         
-        message = add_message(f"现在轮到 {player['name']} 发言。", msg_type="system", author_id=player_id)
-        await sio.emit('new_message', message)
+        message = add_message(session, f"现在轮到 {player['name']} 发言。", msg_type="system", author_id=player_id)
+        await session.publish('new_message', message)
+        speculate_next_speaker(session, "Introduction")
 
         if player["is_ai"]:
             try:
                 # --- 发送正在输入状态 ---
-                await sio.emit('player_typing', {'player_id': player_id, 'player_name': player['name']})
-                print(f"--- Waiting for AI response from {player['name']} ({player_id}) for Introduction ---")
+                await session.emit('player_typing', {'player_id': player_id, 'player_name': player['name']})
+                logger.debug("等待 AI 回复", extra={"player_id": player_id, "signal": "Introduction"})
                 
                 agent = ai_agents.get(player_id)
                 if agent:
-                    statement = agent.act_and_respond("Introduction", "")
+                    chunks = await ai_turn_speech(session, player_id, "Introduction")
                 else: # Fallback for DM or misconfigured agent
-                    statement = f"轮到你了，{player['name']}。请陈述你的不在场证明。"
+                    chunks = _text_chunks(f"轮到你了，{player['name']}。请陈述你的不在场证明。")
 
-                print(f"--- Received AI response from {player['name']} ({player_id}) ---")
+                msg = await stream_message(session, chunks, msg_type="chat", author=player["name"], author_id=player_id)
+                logger.debug("收到 AI 回复", extra={"player_id": player_id})
 
-                game_state["statements"][player_id] = statement
-                
-                msg = add_message(statement, msg_type="chat", author=player["name"], author_id=player_id)
-                await sio.emit('new_message', msg)
+                game_state["statements"][player_id] = msg["content"]
                 # --- FIX: 清除正在输入状态 ---
-                await sio.emit('player_done_typing', {'player_id': player_id})
+                await session.emit('player_done_typing', {'player_id': player_id})
                 
                 game_state["current_speaker_index"] += 1
-                asyncio.create_task(advance_game())
+                schedule_advance(session)
             finally:
                 # --- 保证无论如何都清除状态，以防中途出错 ---
-                await sio.emit('player_done_typing', {'player_id': player_id})
+                await session.emit('player_done_typing', {'player_id': player_id})
         else:
             # For human players, set both state updates at once for atomicity
             game_state["pending_action"] = f"statement_{player_id}"
-            await sio.emit('game_state_update', {
+            await session.publish('game_state_update', {
                 "current_player_id": player_id,
                 "pendingAction": game_state["pending_action"]
             })
 
     elif stage.startswith("investigation"):
         round_num_str = stage.split('_')[1] # "1" or "2"
-        print(f"Starting investigation stage, round {round_num_str}...")
+        logger.info("进入现场取证阶段", extra={"round": round_num_str})
         
         round_clues_data = CLUES.get(f"round_{round_num_str}", {})
         if not round_clues_data:
-            print(f"No clues found for round {round_num_str}.")
+            logger.warning("本轮没有可发放的线索", extra={"round": round_num_str})
             # TODO: Handle this case
             return
 
         # Inform DM of all available clues this round
         all_clues_for_dm = [clue for clues_list in round_clues_data.values() for clue in clues_list]
         clues_summary = f"第 {round_num_str} 轮可公布的线索如下：\n" + "\n".join(all_clues_for_dm)
-        dm_agent.handle_external_message(f"给 DM 的信息：\n{clues_summary}", should_respond=False)
+        await dm_agent.handle_external_message(f"给 DM 的信息：\n{clues_summary}", should_respond=False)
 
         # Distribute clues to each player based on their character name key
+        # AI 玩家之间的分享发言互不依赖，先并发发起生成，再按玩家顺序依次推送：
+        # 排在后面的玩家已生成的片段先缓存，轮到他时才发出，前端的消息顺序与消息历史一致
+        ai_share_streams = []
         for player_id, player_info in game_state["players"].items():
             # Extract the key (first char of name, or full name)
             # e.g., '洪子廉 (你)' -> '洪'
@@ -256,64 +498,62 @@ async def advance_game():
             player_clues = round_clues_data.get(char_name_key, [])
             
             if not player_clues:
-                print(f"No clues found for player {player_id} with key '{char_name_key}' in round {round_num_str}")
+                logger.warning("该玩家本轮没有线索", extra={"player_id": player_id, "key": char_name_key, "round": round_num_str})
                 continue
 
-            game_state["players"][player_id]["clues"].extend(player_clues)
+            # 从日志恢复后会重跑本阶段：已经发过的线索不再重复记录
+            held_clues = game_state["players"][player_id]["clues"]
+            held_clues.extend(clue for clue in player_clues if clue not in held_clues)
             
             if player_info["is_ai"]:
-                try:
-                    await sio.emit('player_typing', {'player_id': player_id, 'player_name': player_info['name']})
-                    print(f"--- Waiting for AI response from {player_info['name']} ({player_id}) for Sharing Clue ---")
-                    agent = ai_agents.get(player_id)
-                    if agent:
-                        for clue in player_clues:
-                            agent.receive_clue(clue)
-                        
-                        response = agent.act_and_respond("Sharing Clue", "")
-                    else:
-                        response = "我获得了一些线索，正在分析中。"
-                    
-                    print(f"--- Received AI response from {player_info['name']} ({player_id}) ---")
-                    # 直接把 AI 的回复作为聊天气泡广播
-                    chat_msg = add_message(response, msg_type="chat", author=player_info["name"], author_id=player_id)
-                    await sio.emit('new_message', chat_msg)
-                    # --- FIX: 清除正在输入状态 ---
-                    await sio.emit('player_done_typing', {'player_id': player_id})
-
-                    # 如果 AI 提到了“公开”，则把整段回复当作公开信息，存入 public_clues，
-                    # 让前端在 other_info 中呈现
-                    if response and "公开" in response:
-                        game_state["public_clues"].append({
-                            "publisher_id": player_id,
-                            "publisher_name": player_info["name"],
-                            "content": response
-                        })
-                        await sio.emit('game_state_update', {"public_clues": game_state["public_clues"]})
-                finally:
-                    # --- 保证无论如何都清除状态，以防中途出错 ---
-                    await sio.emit('player_done_typing', {'player_id': player_id})
+                await session.emit('player_typing', {'player_id': player_id, 'player_name': player_info['name']})
+                logger.debug("等待 AI 回复", extra={"player_id": player_id, "signal": "Sharing Clue"})
+                ai_share_streams.append((player_id, player_info, ai_share_clues(session, player_id, player_clues)))
             else:
                 # It's a human player, send them their batch of clues
                 if player_id in player_sids:
-                    await sio.emit('discovered_clues', {'clues': player_clues}, room=player_sids[player_id])
+                    await session.emit('discovered_clues', {'clues': player_clues}, to=player_sids[player_id])
 
                     # 发送系统消息提示该玩家
                     sys_content = "你获得了以下线索：\n" + "\n".join([f"- {cl}" for cl in player_clues])
-                    sys_msg = add_message(sys_content, msg_type="system")
-                    await sio.emit('new_message', sys_msg, room=player_sids[player_id])
+                    sys_msg = add_message(session, sys_content, msg_type="system")
+                    await session.emit('new_message', sys_msg, to=player_sids[player_id])
 
-        await asyncio.sleep(2)
+        for player_id, player_info, chunks in ai_share_streams:
+            try:
+                stream_id = uuid.uuid4().hex
+                response = await relay_stream(session, chunks, stream_id, player_info["name"], player_id)
+                logger.debug("收到 AI 回复", extra={"player_id": player_id})
+                # 直接把 AI 的回复作为聊天气泡广播
+                chat_msg = add_message(session, response, msg_type="chat", author=player_info["name"], author_id=player_id, stream_id=stream_id)
+                await session.publish('new_message', chat_msg)
+
+                # 如果 AI 提到了“公开”，则把整段回复当作公开信息，存入 public_clues，
+                # 让前端在 other_info 中呈现
+                if response and "公开" in response:
+                    clue = {
+                        "publisher_id": player_id,
+                        "publisher_name": player_info["name"],
+                        "content": response
+                    }
+                    game_state["public_clues"].append(clue)
+                    await session.patch(append_op("public_clues", clue))
+            except Exception as e:
+                logger.error("AI 分享线索出错: %s", e, extra={"player_id": player_id})
+            finally:
+                # --- 保证无论如何都清除状态，以防中途出错 ---
+                await session.emit('player_done_typing', {'player_id': player_id})
+
+        await asyncio.sleep(INVESTIGATION_PAUSE)
         # 更新内部阶段并广播
         next_stage = f"discussion_{round_num_str}"
-        game_state["stage"] = next_stage
-        await sio.emit('game_state_update', stage_update_dict(next_stage))
-        message = add_message(f"第 {round_num_str} 轮现场取证结束，进入推理陈述阶段。")
-        await sio.emit('new_message', message)
+        await enter_stage(session, next_stage)
+        message = add_message(session, f"第 {round_num_str} 轮现场取证结束，进入推理陈述阶段。")
+        await session.publish('new_message', message)
         game_state["turn_order"] = []
         game_state["current_speaker_index"] = 0
         game_state["statements"] = {}
-        asyncio.create_task(advance_game())
+        schedule_advance(session)
 
     elif stage.startswith("discussion"):
         round_num = stage.split('_')[1]
@@ -329,142 +569,111 @@ async def advance_game():
               "turn_order": ["玩家ID_1", "玩家ID_2", ...],
               "announcement": "用你作为DM的口吻，向所有玩家宣布你为本轮推理制定的发言顺序。"
             }}
-            请确保 "turn_order" 数组中的ID来自给定的玩家列表。
+            请确保 "turn_order" 数组包含给定列表中的每一个玩家ID，且每个只出现一次。
             """
             
-            new_turn_order = []
-            announcement_message = ""
-            try:
-                dm_response = dm_agent.handle_external_message(dm_prompt).strip()
-                json_start = dm_response.find('{')
-                json_end = dm_response.rfind('}') + 1
-                if json_start != -1 and json_end != 0:
-                    json_str = dm_response[json_start:json_end]
-                    dm_data = json.loads(json_str)
-                    potential_order = dm_data.get("turn_order", [])
-                    announcement_message = dm_data.get("announcement", "")
-
-                    valid_player_ids = set(game_state["players"].keys())
-                    if potential_order and announcement_message and all(pid in valid_player_ids for pid in potential_order):
-                        new_turn_order = potential_order
-                    else:
-                        raise ValueError("Invalid data from DM: missing fields or invalid player IDs.")
-                else:
-                    raise ValueError("No JSON object found in DM response.")
-
-            except Exception as e:
-                print(f"DM discussion turn order generation failed: {e}. Falling back to default.")
-                new_turn_order = [pid for pid in game_state["players"] if pid != 'dm']
-                order_text = " -> ".join([game_state["players"][pid]["name"] for pid in new_turn_order])
-                announcement_message = f"本轮的发言顺序是: {order_text}"
-            
-            game_state["turn_order"] = new_turn_order
-            game_state["current_speaker_index"] = 0
-            await sio.emit('game_state_update', {"turn_order": game_state["turn_order"]})
-            
-            # --- Announce the turn order ---
-            order_message = add_message(announcement_message, msg_type="chat", author="DM", author_id="dm")
-            await sio.emit('new_message', order_message)
+            await set_turn_order(session, dm_prompt, "本轮的发言顺序是: ")
 
             # --- 立即启动下一次推进，而不是在本函数内继续执行 ---
             # 这给了前端一个处理状态更新的喘息机会
-            asyncio.create_task(advance_game())
+            schedule_advance(session)
             return # 退出当前函数，避免重复执行
 
         if game_state["current_speaker_index"] >= len(game_state["turn_order"]):
             if round_num == "1":
-                game_state["stage"] = "voting_1"
-                await sio.emit('game_state_update', stage_update_dict("voting_1"))
-                message = add_message("第一轮推理陈述结束，现在进入投票阶段。")
-                await sio.emit('new_message', message)
+                await enter_stage(session, "voting_1")
+                message = add_message(session, "第一轮推理陈述结束，现在进入投票阶段。")
+                await session.publish('new_message', message)
             else: # round 2
-                game_state["stage"] = "final_accusation"
-                await sio.emit('game_state_update', stage_update_dict("final_accusation"))
-                message = add_message("第二轮推理陈述结束，现在进入最终指认阶段。")
-                await sio.emit('new_message', message)
-            asyncio.create_task(advance_game())
+                await enter_stage(session, "final_accusation")
+                message = add_message(session, "第二轮推理陈述结束，现在进入最终指认阶段。")
+                await session.publish('new_message', message)
+            schedule_advance(session)
             return
             
         # ----- Turn-based statement logic -----
         player_id = game_state["turn_order"][game_state["current_speaker_index"]]
         player = game_state["players"][player_id]
 
-        await sio.emit('game_state_update', {"current_player_id": player_id})
+        await session.publish('game_state_update', {"current_player_id": player_id})
 
-        turn_msg = add_message(f"现在轮到 {player['name']} 发言。", msg_type="system", author_id="system")
-        await sio.emit('new_message', turn_msg)
+        turn_msg = add_message(session, f"现在轮到 {player['name']} 发言。", msg_type="system", author_id="system")
+        await session.publish('new_message', turn_msg)
+        speculate_next_speaker(session, "Discussion")
 
         if player["is_ai"]:
             try:
-                await sio.emit('player_typing', {'player_id': player_id, 'player_name': player['name']})
-                print(f"--- Waiting for AI response from {player['name']} ({player_id}) for Discussion ---")
+                await session.emit('player_typing', {'player_id': player_id, 'player_name': player['name']})
+                logger.debug("等待 AI 回复", extra={"player_id": player_id, "signal": "Discussion"})
                 agent = ai_agents.get(player_id)
                 if agent:
-                    statement = agent.act_and_respond("Discussion", "")
+                    chunks = await ai_turn_speech(session, player_id, "Discussion")
                 else: # Fallback for DM or misconfigured agent
-                    statement = f"现在是推理陈述阶段（第 {round_num} 轮）。请 {player['name']} 表达你的推理观点。"
+                    chunks = _text_chunks(f"现在是推理陈述阶段（第 {round_num} 轮）。请 {player['name']} 表达你的推理观点。")
                 
-                print(f"--- Received AI response from {player['name']} ({player_id}) ---")
-                game_state["statements"][player_id] = statement
-
-                chat_msg = add_message(statement, msg_type="chat", author=player["name"], author_id=player_id)
-                await sio.emit('new_message', chat_msg)
+                chat_msg = await stream_message(session, chunks, msg_type="chat", author=player["name"], author_id=player_id)
+                logger.debug("收到 AI 回复", extra={"player_id": player_id})
+                game_state["statements"][player_id] = chat_msg["content"]
                 # --- FIX: 清除正在输入状态 ---
-                await sio.emit('player_done_typing', {'player_id': player_id})
+                await session.emit('player_done_typing', {'player_id': player_id})
 
                 game_state["current_speaker_index"] += 1
-                asyncio.create_task(advance_game())
+                schedule_advance(session)
             finally:
                 # --- 保证无论如何都清除状态，以防中途出错 ---
-                await sio.emit('player_done_typing', {'player_id': player_id})
+                await session.emit('player_done_typing', {'player_id': player_id})
         else:
             game_state["pending_action"] = f"statement_{player_id}"
-            await sio.emit('game_state_update', {
+            await session.publish('game_state_update', {
                 "current_player_id": player_id,
                 "pendingAction": game_state["pending_action"]
             })
 
     elif stage == "voting_1":
         # ------------ AI 投票与发言 ------------
-        import random
+        # 各 AI 的投票互不依赖：并发生成，再按玩家顺序依次记录并广播
+        vote_tasks = []
         for pid, pinfo in game_state["players"].items():
             if pid == 'dm' or not pinfo["is_ai"] or pid in game_state["votes"]:
                 continue
 
             agent = ai_agents.get(pid)
             if agent:
-                await sio.emit('player_typing', {'player_id': pid, 'player_name': pinfo['name']})
-                try:
-                    # AI Agent 现在直接返回结构化数据
-                    vote_result = agent.vote()
-                    
-                    trust_id = vote_result["trust_id"]
-                    suspect_id = vote_result["suspect_id"]
-                    statement = vote_result["statement"]
-
-                    # 记录投票，同时保存 AI 的解释性发言，便于前端展示
-                    game_state["votes"][pid] = {
-                        "trust": trust_id,
-                        "suspect": suspect_id,
-                        "statement": statement
-                    }
+                await session.emit('player_typing', {'player_id': pid, 'player_name': pinfo['name']})
+                vote_tasks.append((pid, pinfo, session.spawn(agent.vote())))
 
-                    # 将 AI 的发言作为角色聊天消息广播
-                    await sio.emit('player_done_typing', {'player_id': pid})
-                    ai_vote_msg = add_message(statement, msg_type="chat", author=pinfo['name'], author_id=pid)
-                    await sio.emit('new_message', ai_vote_msg)
+        for pid, pinfo, task in vote_tasks:
+            try:
+                # AI Agent 现在直接返回结构化数据
+                vote_result = await task
+                
+                trust_id = vote_result["trust_id"]
+                suspect_id = vote_result["suspect_id"]
+                statement = vote_result["statement"]
+
+                # 记录投票，同时保存 AI 的解释性发言，便于前端展示
+                game_state["votes"][pid] = {
+                    "trust": trust_id,
+                    "suspect": suspect_id,
+                    "statement": statement
+                }
+
+                # 将 AI 的发言作为角色聊天消息广播
+                await session.emit('player_done_typing', {'player_id': pid})
+                ai_vote_msg = add_message(session, statement, msg_type="chat", author=pinfo['name'], author_id=pid)
+                await session.publish('new_message', ai_vote_msg)
 
-                except Exception as e:
-                    print(f"Error processing AI vote for {pinfo['name']}: {e}")
-                    # 即使 agent.vote() 内部有回退，这里也加一层保护
-                    await sio.emit('player_done_typing', {'player_id': pid})
+            except Exception as e:
+                logger.error("AI 投票出错: %s", e, extra={"player_id": pid})
+                # 即使 agent.vote() 内部有回退，这里也加一层保护
+                await session.emit('player_done_typing', {'player_id': pid})
 
         
         # --- 后续流程 ---
         pending_votes = any(not p["is_ai"] and pid not in game_state["votes"] for pid, p in game_state["players"].items() if pid != 'dm')
         if pending_votes:
             game_state["pending_action"] = "vote"
-            await sio.emit('game_state_update', {"pendingAction": game_state["pending_action"]})
+            await session.publish('game_state_update', {"pendingAction": game_state["pending_action"]})
         
         expected_voters = len([pid for pid in game_state["players"] if pid != 'dm'])
         if len(game_state["votes"]) >= expected_voters:
@@ -477,58 +686,61 @@ async def advance_game():
                 vote_summary += f"- {voter_name} 信任了 {trust_name}，怀疑了 {suspect_name}\n"
             
             dm_prompt = vote_summary + "\n请你基于此结果，为接下来的流程做准备。"
-            dm_agent.handle_external_message(dm_prompt, should_respond=False)
+            await dm_agent.handle_external_message(dm_prompt, should_respond=False)
 
-            await sio.emit('game_state_update', {"votes": game_state["votes"]})
+            await session.patch(merge_op("votes", game_state["votes"]))
             
             # --- Reset state for next round ---
-            game_state["stage"] = "investigation_2"
             game_state["pending_action"] = "" # Use empty string
+            # 留存本轮投票，供下一轮按怀疑程度决定发言顺序
+            game_state["vote_history"].append(game_state["votes"])
             game_state["votes"] = {} # Clear votes for the next voting round (if any)
             
-            await sio.emit('game_state_update', {
-                "current_stage": "investigation_2",
-                "current_stage_label": translate_stage("investigation_2"),
+            await enter_stage(session, "investigation_2", {
                 "pendingAction": "", # Use empty string
                 "votes": game_state["votes"]
             })
             
-            message = add_message("第一轮投票结束，现在进入追加现场取证阶段。")
-            await sio.emit('new_message', message)
-            asyncio.create_task(advance_game())
+            message = add_message(session, "第一轮投票结束，现在进入追加现场取证阶段。")
+            await session.publish('new_message', message)
+            schedule_advance(session)
 
     elif stage == "final_accusation":
         # --- AI Accusation Logic ---
-        import random
+        # 与投票相同：并发生成各 AI 的指认，按玩家顺序依次记录并广播
+        accuse_tasks = []
         for pid, pinfo in game_state["players"].items():
             if not pinfo["is_ai"] or pid == 'dm' or pid in game_state["accusations"]:
                 continue
             
             agent = ai_agents.get(pid)
             if agent:
-                await sio.emit('player_typing', {'player_id': pid, 'player_name': pinfo['name']})
-                try:
-                    # AI Agent 现在直接返回结构化数据
-                    accusation_result = agent.accuse()
-                    accused_id = accusation_result["accused_id"]
-                    statement = accusation_result["statement"]
-
-                    # 记录指认
-                    game_state["accusations"][pid] = {"accused": accused_id, "method": "无"} # method 暂时保留
-
-                    # 将 AI 的发言作为角色聊天消息广播
-                    await sio.emit('player_done_typing', {'player_id': pid})
-                    accuse_msg = add_message(statement, msg_type="chat", author=pinfo['name'], author_id=pid)
-                    await sio.emit('new_message', accuse_msg)
-
-                except Exception as e:
-                    print(f"Error processing AI accusation for {pinfo['name']}: {e}")
-                    await sio.emit('player_done_typing', {'player_id': pid})
+                await session.emit('player_typing', {'player_id': pid, 'player_name': pinfo['name']})
+                accuse_tasks.append((pid, pinfo, session.spawn(agent.accuse())))
+
+        for pid, pinfo, task in accuse_tasks:
+            try:
+                # AI Agent 现在直接返回结构化数据
+                accusation_result = await task
+                accused_id = accusation_result["accused_id"]
+                statement = accusation_result["statement"]
+
+                # 记录指认
+                game_state["accusations"][pid] = {"accused": accused_id, "method": "无"} # method 暂时保留
+
+                # 将 AI 的发言作为角色聊天消息广播
+                await session.emit('player_done_typing', {'player_id': pid})
+                accuse_msg = add_message(session, statement, msg_type="chat", author=pinfo['name'], author_id=pid)
+                await session.publish('new_message', accuse_msg)
+
+            except Exception as e:
+                logger.error("AI 指认出错: %s", e, extra={"player_id": pid})
+                await session.emit('player_done_typing', {'player_id': pid})
         
         pending_accusation = any(not p.get("is_ai", False) and pid not in game_state["accusations"] for pid, p in game_state["players"].items() if pid != 'dm')
         if pending_accusation:
             game_state["pending_action"] = "accuse"
-            await sio.emit('game_state_update', {"pendingAction": game_state["pending_action"]})
+            await session.publish('game_state_update', {"pendingAction": game_state["pending_action"]})
 
         if len(game_state["accusations"]) == len([p for p in game_state["players"] if p != 'dm']):
             # --- All players have accused, start the reveal sequence ---
@@ -540,38 +752,37 @@ async def advance_game():
 
             # 1. Notify DM and get the TRUTH (as a 'turn' message)
             truth_prompt = accusation_summary + "\n请基于此结果，公布最终的凶手和游戏真相！不要输出你的思考内容，直接作为DM输出真相就可以"
-            truth_message = dm_agent.handle_external_message(truth_prompt)
-            
-            await sio.emit('game_state_update', {"accusations": game_state["accusations"]})
-            
-            final_truth_msg = add_message(truth_message, msg_type="turn", author="DM", author_id="dm")
-            await sio.emit('new_message', final_truth_msg)
+            await session.patch(merge_op("accusations", game_state["accusations"]))
 
-            await asyncio.sleep(5)  # Dramatic pause
+            await stream_message(session, dm_speech(session, truth_prompt, timeout=NARRATIVE_TIMEOUT), msg_type="turn", author="DM", author_id="dm")
+
+            await asyncio.sleep(REVEAL_PAUSE)  # Dramatic pause
 
             # 2. Ask DM for final RESULTS (as a 'turn' message)
             results_prompt = "现在请公布每位玩家的最终得分和游戏结局（谁是赢家，谁是输家）。需要根据游戏规则和玩家的表现来给出最终得分。请你作为游戏DM来回复，不要输出你的思考过程！"
-            final_results_message = "计分板：游戏结束，感谢参与！"
             try:
-                final_results_message = dm_agent.handle_external_message(results_prompt)
+                await stream_message(session, dm_speech(session, results_prompt, timeout=NARRATIVE_TIMEOUT), msg_type="turn", author="DM", author_id="dm")
             except Exception as e:
-                print(f"Error getting final results from DM: {e}")
-
-            final_results_msg = add_message(final_results_message, msg_type="turn", author="DM", author_id="dm")
-            await sio.emit('new_message', final_results_msg)
+                logger.error("获取 DM 结算结果出错: %s", e)
+                final_results_msg = add_message(session, "计分板：游戏结束，感谢参与！", msg_type="turn", author="DM", author_id="dm")
+                await session.publish('new_message', final_results_msg)
 
             # The game state is NOT set to 'game_over' here anymore.
             # The client will trigger it.
+            await session.rag_ingest.flush()
+            session.finished = True
+            session.checkpoint()
 
 
-async def start_game_flow():
+async def start_game_flow(session: GameSession):
     """Initializes the first stage of the game."""
-    print("Starting game flow...")
-    game_state["stage"] = "alibi"
-    await sio.emit('game_state_update', stage_update_dict("alibi"))
+    game_state = session.game_state
+    bind_room(session.room_id)
+    logger.info("开始游戏流程")
+    await enter_stage(session, "alibi")
     # This message is sent to the frontend to indicate the stage start
-    message = add_message("游戏进入第一阶段：不在场证明陈述。")
-    await sio.emit('new_message', message)
+    message = add_message(session, "游戏进入第一阶段：不在场证明陈述。")
+    await session.publish('new_message', message)
 
     all_players = {pid: pinfo["name"] for pid, pinfo in game_state["players"].items() if pid != 'dm'}
     dm_prompt = f"""
@@ -585,54 +796,93 @@ async def start_game_flow():
       "turn_order": ["玩家ID_1", "玩家ID_2", ...],
       "announcement": "用你作为DM的口吻，向所有玩家宣布你制定的发言顺序。"
     }}
-    请确保 "turn_order" 数组中的ID来自给定的玩家列表。
+    请确保 "turn_order" 数组包含给定列表中的每一个玩家ID，且每个只出现一次。
     """
     
-    # --- Robust turn order generation for alibi stage ---
-    new_turn_order = []
-    announcement_message = ""
-    try:
-        dm_response = dm_agent.handle_external_message(dm_prompt).strip()
-        # Find the JSON part of the response
-        json_start = dm_response.find('{')
-        json_end = dm_response.rfind('}') + 1
-        if json_start != -1 and json_end != 0:
-            json_str = dm_response[json_start:json_end]
-            dm_data = json.loads(json_str)
-            potential_order = dm_data.get("turn_order", [])
-            announcement_message = dm_data.get("announcement", "")
-            
-            valid_player_ids = set(game_state["players"].keys())
-            if potential_order and announcement_message and all(pid in valid_player_ids for pid in potential_order):
-                new_turn_order = potential_order
-            else:
-                raise ValueError("Invalid data from DM: missing fields or invalid player IDs.")
-        else:
-            raise ValueError("No JSON object found in DM response.")
+    await set_turn_order(session, dm_prompt, "不在场证明的发言顺序: ")
+
+    # This will immediately call advance_game to prompt the first speaker
+    schedule_advance(session)
+
+async def resume_session(session: GameSession):
+    """从对局日志恢复后继续推进：等待人类玩家的发言保持等待，其余情况从当前阶段重新推进。"""
+    game_state = session.game_state
+    bind_room(session.room_id)
+    logger.info("继续推进恢复的对局", extra={"stage": game_state["stage"], "pending_action": game_state["pending_action"],
+                                        "current_speaker_index": game_state["current_speaker_index"]})
+    if game_state["stage"] == "alibi" and not game_state["turn_order"]:
+        # 发言顺序尚未确定就退出了：重新开始第一阶段
+        game_state["stage"] = "waiting_for_players"
+        await start_game_flow(session)
+        return
+    if (game_state["pending_action"] or "").startswith("statement_"):
+        return
+    await advance_game(session)
+
+
+async def resume_sessions():
+    """从对局日志重建进行中的对局，并在后台继续推进。"""
+    # 分片模式下只恢复归属本 worker 的对局，避免多个进程同时推进同一局、写同一份日志
+    shard = (WORKER_ID, WORKER_COUNT) if WORKER_ID is not None else None
+    sessions.restore(shard=shard)
+
+
+async def warmup():
+    """
+    开始监听之后的后台预热：恢复进行中的对局（各自在后台构建记忆索引），
+    并在线程池中导入记忆模块，让第一局新游戏不必等待。
+    """
+    started = time.monotonic()
+    await resume_sessions()
+    STARTUP.record_background("restore_sessions", time.monotonic() - started)
 
+    started = time.monotonic()
+    try:
+        await asyncio.to_thread(import_rag_manager)
     except Exception as e:
-        print(f"DM alibi turn order generation failed: {e}. Falling back to default.")
-        # Fallback logic
-        new_turn_order = [pid for pid in game_state["players"] if pid != 'dm']
-        order_text = " -> ".join([game_state["players"][pid]["name"] for pid in new_turn_order])
-        announcement_message = f"我已指定不在场证明的发言顺序: {order_text}"
+        logger.error("预热时导入记忆模块失败: %s", e)
+    STARTUP.record_background("rag_import", time.monotonic() - started)
+    STARTUP.warmed_up()
 
-    
-    game_state["turn_order"] = new_turn_order
-    game_state["current_speaker_index"] = 0
-    
-    await sio.emit('game_state_update', {"turn_order": game_state["turn_order"]})
-    
-    # --- Announce the turn order ---
-    order_message = add_message(announcement_message, msg_type="chat", author="DM", author_id="dm")
-    await sio.emit('new_message', order_message)
 
-    print(f"DM has set the turn order: {game_state['turn_order']}")
-    
-    # This will immediately call advance_game to prompt the first speaker
-    asyncio.create_task(advance_game())
+async def start_warmup(app):
+    """启动钩子只派生预热任务，不等待它完成，端口绑定不被对局恢复与记忆模块导入拖慢。"""
+    STARTUP.mark("startup_hooks")
+    app["warmup_task"] = asyncio.create_task(warmup())
+
+app.on_startup.append(start_warmup)
+
+
+async def reap_sessions():
+    """定期释放已结算且无人连接、或长时间无人连接的对局，进程内的对局数不随累计开过的局数增长。"""
+    while True:
+        await asyncio.sleep(SESSION_REAP_INTERVAL)
+        sessions.reap()
 
-async def send_current_state(sid):
+
+async def start_reaper(app):
+    app["reaper_task"] = asyncio.create_task(reap_sessions())
+
+app.on_startup.append(start_reaper)
+
+
+async def cancel_sessions(app):
+    """服务关闭时取消所有对局的调度器与后台任务（状态已写入对局日志，重启后可以恢复），排队中的记忆写入先提交完。"""
+    if "reaper_task" in app:
+        app["reaper_task"].cancel()
+    for session in sessions.sessions.values():
+        session.scheduler.cancel()
+        if session.rag_ingest.depth:
+            await session.rag_ingest.flush()
+        session.rag_ingest.cancel()
+    # 等待对局日志的后台写入全部落盘
+    await asyncio.to_thread(JOURNAL_WRITER.join)
+
+app.on_cleanup.append(cancel_sessions)
+
+
+async def send_current_state(session: GameSession, sid):
+    game_state = session.game_state
     # 仅发送非空字段，避免把有效值覆盖成 null
     state_update = {
         "current_stage": game_state["stage"],
@@ -643,40 +893,66 @@ async def send_current_state(sid):
     if game_state["pending_action"]:
         state_update["pendingAction"] = game_state["pending_action"]
 
-    await sio.emit('game_state_update', state_update, room=sid)
+    await session.emit('game_state_update', state_update, to=sid)
 
 # ----------------- Socket.IO Event Handlers -----------------
+def parse_last_version(auth, query_dict):
+    """客户端在 auth（或 query）中带上最后见过的状态版本号；缺失或非法时视为 0（需要完整快照）。"""
+    raw = (auth or {}).get('lastVersion') if isinstance(auth, dict) else None
+    if raw is None:
+        raw = query_dict.get('lastVersion')
+    try:
+        return max(0, int(raw))
+    except (TypeError, ValueError):
+        return 0
+
+
 @sio.event
-async def connect(sid, environ):
+async def connect(sid, environ, auth=None):
     """Handle new client connections."""
     try:
-        # The query string will be like: EIO=4&transport=websocket&sid=...&playerId=human_player_1
-        query_dict = dict(item.split("=") for item in environ.get('QUERY_STRING', '').split("&") if "=" in item)
+        # The query string will be like: EIO=4&transport=websocket&sid=...&playerId=human_player_1&room=table_1
+        query_dict = dict(parse_qsl(environ.get('QUERY_STRING', '')))
         player_id = query_dict.get('playerId')
+        room_id = query_dict.get('room') or DEFAULT_ROOM_ID
+        last_version = parse_last_version(auth, query_dict)
 
         if not player_id or player_id not in CHARACTERS: # Check against CHARACTERS
-            print(f"Connection rejected: Invalid player_id '{player_id}' from {sid}")
+            logger.warning("拒绝连接：无效的玩家ID", extra={"player_id": player_id, "sid": sid})
             await sio.emit('error', {'message': '无效的玩家ID'}, room=sid)
             return False
-        
-        player_sids[player_id] = sid
+
+        if not is_valid_room_id(room_id):
+            logger.warning("拒绝连接：无效的房间号", extra={"room_id": room_id, "sid": sid})
+            await sio.emit('error', {'message': '无效的房间号'}, room=sid)
+            return False
+
+        session = sessions.get_or_create(room_id)
+        game_state = session.game_state
+        player_sids = session.player_sids
+
+        # 客户端在 auth.wire 中声明支持的打包与压缩格式，不支持或未声明时使用 JSON
+        wire = negotiate_wire(auth)
+        sessions.bind_sid(sid, session, player_id, wire)
+        await sio.enter_room(sid, session.room)
+        bind_room(room_id)
         player_name = CHARACTERS[player_id]['name']
-        print(f"Player {player_id} ({player_name}) connected with sid: {sid}")
+        logger.info("玩家已连接", extra={"player_id": player_id, "sid": sid, "wire": wire})
 
         # No longer sending initial_state. Frontend has it.
         # We just need to let the frontend know it's connected.
         # The frontend can set its 'is_connected' flag.
         # The 'connect' event on the client side handles this.
         
-        message = add_message(f"玩家 {player_name} 已连接。")
-        await sio.emit('new_message', message)
+        message = add_message(session, f"玩家 {player_name} 已连接。")
+        await session.publish('new_message', message)
         
         # Check if this is the first human player connecting, and if so, start the game.
         human_players = [pid for pid, pinfo in CHARACTERS.items() if not pinfo['is_ai']]
         # If there's only one human player and this is them, start the game.
         if len(human_players) == 1 and player_id == human_players[0] and game_state["stage"] == "waiting_for_players":
-            print("First human player connected. Starting game flow automatically.")
-            asyncio.create_task(start_game_flow())
+            logger.info("首位真人玩家已连接，自动开始游戏流程")
+            schedule_start(session)
 
         # Send online status update AFTER potential game start, so stage is correct
         online_players_status = []
@@ -684,65 +960,92 @@ async def connect(sid, environ):
             # FIXING THE NameError: p_id -> pid
             online_players_status.append({"id": pid, "online": (pid in player_sids or p_info["is_ai"])})
 
-        await sio.emit('game_state_update', { 'players': online_players_status })
-        await send_current_state(sid)  # 补发重要字段
+        await session.publish('game_state_update', { 'players': online_players_status })
+        await send_current_state(session, sid)  # 补发重要字段
 
-        # --- 发送完整初始状态（包含历史消息），保证刷新后仍能看到记录 ---
-        initial_payload = {
-            "gameState": build_public_game_state(),
-            "messages": game_state["messages"]
-        }
-        await sio.emit('initial_state', initial_payload, room=sid)
+        # --- 重连：只补发客户端错过的状态事件；无法增量补齐时发送完整快照 ---
+        missed = session.state_log.since(last_version) if last_version else None
+        if missed is not None:
+            await session.emit('sync', {"version": session.state_log.version, "events": missed}, to=sid)
+            logger.info("按版本号补发错过的事件", extra={"sid": sid, "last_version": last_version, "events": len(missed)})
+        else:
+            # --- 发送完整初始状态（包含最近的消息），更早的历史由前端通过 fetch_messages 按需拉取 ---
+            messages, has_more = await session.messages.before(None, INITIAL_MESSAGES)
+            initial_payload = {
+                "version": session.state_log.version,
+                "gameState": build_public_game_state(session),
+                "messages": messages,
+                "hasMoreMessages": has_more
+            }
+            await session.emit('initial_state', initial_payload, to=sid)
 
     except Exception as e:
-        print(f"Error in connect handler: {e}")
+        logger.exception("处理连接时出错: %s", e)
 
 
 @sio.event
 async def disconnect(sid, reason=None):
     """Handle client disconnections."""
-    disconnected_player_id = None
-    for player_id, player_sid in player_sids.items():
-        if player_sid == sid:
-            disconnected_player_id = player_id
-            break
+    session, disconnected_player_id = sessions.unbind_sid(sid)
     
     if disconnected_player_id:
-        del player_sids[disconnected_player_id]
+        game_state = session.game_state
+        player_sids = session.player_sids
         player_name = game_state['players'][disconnected_player_id]['name']
-        print(f"Player {disconnected_player_id} ({player_name}) disconnected.")
-        message = add_message(f"玩家 {player_name} 已断开连接。")
-        await sio.emit('new_message', message)
+        bind_room(session.room_id)
+        logger.info("玩家已断开连接", extra={"player_id": disconnected_player_id, "sid": sid})
+        message = add_message(session, f"玩家 {player_name} 已断开连接。")
+        await session.publish('new_message', message)
         
         online_players_status = []
         for pid, p_info in CHARACTERS.items():
             # FIXING THE NameError: p_id -> pid
             online_players_status.append({"id": pid, "online": (pid in player_sids or p_info["is_ai"])})
 
-        await sio.emit('game_state_update', {
+        await session.publish('game_state_update', {
             'players': online_players_status
         })
 
 
+@sio.on('fetch_messages')
+async def handle_fetch_messages(sid, data=None):
+    """分页拉取更早的公共消息：返回 before 游标（seq）之前的 limit 条，通过 ack 回调返回给前端。"""
+    session, _ = sessions.lookup(sid)
+    if not session:
+        return {"messages": [], "hasMore": False}
+    data = data or {}
+    try:
+        before = int(data["before"]) if data.get("before") is not None else None
+        limit = int(data.get("limit") or INITIAL_MESSAGES)
+    except (TypeError, ValueError):
+        return {"messages": [], "hasMore": False, "error": "invalid cursor"}
+    messages, has_more = await session.messages.before(before, limit)
+    return {"messages": messages, "hasMore": has_more}
+
+
 @sio.on('player_action')
 async def handle_player_action(sid, action):
     """Handle actions from players."""
-    player_id = None
-    for pid, psid in player_sids.items():
-        if psid == sid:
-            player_id = pid
-            break
+    session, player_id = sessions.lookup(sid)
     
     if not player_id:
-        print(f"Action from unknown sid {sid}: {action}")
+        logger.warning("收到未知连接的操作", extra={"sid": sid, "action": action})
         return
 
+    await apply_player_action(session, player_id, action)
+
+
+async def apply_player_action(session: GameSession, player_id, action):
+    """把玩家的一个动作应用到对局上（不依赖 socket 连接，基准测试也直接调用它）。"""
+    game_state = session.game_state
+    bind_room(session.room_id)
+
     action_type = action.get("type")
-    print(f"Received action '{action_type}' from player {player_id}: {action}")
+    logger.info("收到玩家操作", extra={"player_id": player_id, "action_type": action_type})
 
     # Map frontend actions to backend game flow
     if action_type == "start_game" and game_state["stage"] == "waiting_for_players":
-        asyncio.create_task(start_game_flow())
+        schedule_start(session)
 
     elif action_type == "submit_statement" and game_state["pending_action"] == f"statement_{player_id}":
         # Correctly extract the statement from the payload object
@@ -751,29 +1054,30 @@ async def handle_player_action(sid, action):
         
         game_state["statements"][player_id] = statement
         
-        message = add_message(statement, msg_type="chat", author=game_state["players"][player_id]["name"], author_id=player_id)
-        await sio.emit('new_message', message)
+        message = add_message(session, statement, msg_type="chat", author=game_state["players"][player_id]["name"], author_id=player_id)
+        await session.publish('new_message', message)
 
         game_state["pending_action"] = "" # Use empty string
         game_state["current_speaker_index"] += 1
-        asyncio.create_task(advance_game())
+        schedule_advance(session)
 
     elif action_type == "publish_clue":
         clue_to_publish = action.get("payload")
         player = game_state["players"][player_id]
         clue_content = clue_to_publish['content']
         
-        # Add to public clues state and broadcast
-        game_state["public_clues"].append({
+        # Add to public clues state and broadcast（只广播新增的这一条）
+        clue = {
             "publisher_id": player_id,
             "publisher_name": player["name"],
             "content": clue_content
-        })
-        await sio.emit('game_state_update', {"public_clues": game_state["public_clues"]})
+        }
+        game_state["public_clues"].append(clue)
+        await session.patch(append_op("public_clues", clue))
 
         # Send system message to all players
-        message = add_message(f"{player['name']} 公开了线索：\n{clue_content}", msg_type="system")
-        await sio.emit('new_message', message)
+        message = add_message(session, f"{player['name']} 公开了线索：\n{clue_content}", msg_type="system")
+        await session.publish('new_message', message)
     
     elif action_type == "submit_vote" and game_state["pending_action"] == "vote":
         voter_id = player_id
@@ -789,13 +1093,13 @@ async def handle_player_action(sid, action):
                 "suspect": suspect_vote,
                 "statement": statement
             }
-            message = add_message(f"玩家 {game_state['players'][voter_id]['name']} 已完成投票。", msg_type="system")
-            await sio.emit('new_message', message)
+            message = add_message(session, f"玩家 {game_state['players'][voter_id]['name']} 已完成投票。", msg_type="system")
+            await session.publish('new_message', message)
            
-            # 广播更新后的投票状态
-            await sio.emit('game_state_update', {"votes": game_state["votes"]})
+            # 广播新增的这一票
+            await session.patch(merge_op("votes", {voter_id: game_state["votes"][voter_id]}))
             
-            asyncio.create_task(advance_game())
+            schedule_advance(session)
 
     elif action_type == "submit_accusation" and game_state["pending_action"] == "accuse":
         accuser_id = player_id
@@ -804,37 +1108,42 @@ async def handle_player_action(sid, action):
 
         if accuser_id not in game_state["accusations"]:
             game_state["accusations"][accuser_id] = {"accused": accused_id, "method": "无"}
-            message = add_message(f"玩家 {game_state['players'][accuser_id]['name']} 已完成最终指认。")
-            await sio.emit('new_message', message)
+            message = add_message(session, f"玩家 {game_state['players'][accuser_id]['name']} 已完成最终指认。")
+            await session.publish('new_message', message)
 
             # No longer notifying DM here, it will be done in batch at the end.
 
-            await sio.emit('game_state_update', {"accusations": game_state["accusations"]})
-            asyncio.create_task(advance_game())
+            await session.patch(merge_op("accusations", {accuser_id: game_state["accusations"][accuser_id]}))
+            schedule_advance(session)
 
 
 @sio.on('direct_message')
 async def handle_private_message_to_dm(sid, data):
     """Handles private messages from a player to the DM."""
-    player_id = None
-    for pid, psid in player_sids.items():
-        if psid == sid:
-            player_id = pid
-            break
+    session, player_id = sessions.lookup(sid)
 
     if not player_id:
-        print(f"Private message from unknown sid {sid}: {data}")
+        logger.warning("收到未知连接的私聊", extra={"sid": sid})
         return
 
-    player_name = game_state['players'].get(player_id, {}).get('name', '未知玩家')
+    dm_agent = session.dm_agent
     question = data.get('content', '')
 
-    print(f"Received private message from {player_name} ({player_id}) for DM: '{question}'")
+    bind_room(session.room_id)
+    logger.info("收到发给 DM 的私聊", extra={"player_id": player_id})
+    logger.debug("私聊问题: %s", question)
 
     if not question:
         return # Ignore empty messages
 
-    dm_response = dm_agent.whisper(player_id, question)
+    # 私聊回复同样流式推送，但只发给提问的玩家
+    stream_id = uuid.uuid4().hex
+    if STREAMING_ENABLED:
+        chunks = dm_agent.whisper_stream(player_id, question)
+    else:
+        chunks = _single_chunk(dm_agent.whisper(player_id, question))
+    dm_response = await relay_stream(session, chunks, stream_id, "DM", "dm", msg_type="private", to=sid)
+    dm_response = dm_response or WHISPER_UNAVAILABLE_TEXT
 
     # Create the response message payload
     import datetime
@@ -843,16 +1152,119 @@ async def handle_private_message_to_dm(sid, data):
         "from_name": "DM",
         "content": dm_response,
         "type": "private",
-        "timestamp": datetime.datetime.utcnow().isoformat()
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "stream_id": stream_id
     }
 
     # Send the DM's response back only to the originating player
-    await sio.emit('dm_message', response_message, room=sid)
-    print(f"Sent private response from DM to {player_name} ({player_id}).")
+    await session.emit('dm_message', response_message, to=sid)
+    logger.info("已发送 DM 的私聊回复", extra={"player_id": player_id})
+
+
+# ----------------- Load Report -----------------
+# 分片模式下，router 通过该接口获取本进程的负载
+WORKER_ID = None
+WORKER_COUNT = 1
+
+
+async def handle_load(request):
+    return web.json_response({
+        "worker_id": WORKER_ID,
+        "pid": os.getpid(),
+        "sessions": len(sessions.sessions),
+        "connected_sids": len(sessions.sid_rooms),
+        "rooms": sorted(sessions.sessions.keys()),
+        "schedulers": {room_id: session.scheduler.stats() for room_id, session in sessions.sessions.items()},
+        "speculation": {room_id: session.speculator.stats() for room_id, session in sessions.sessions.items()},
+        "rag_ingest": {room_id: session.rag_ingest.stats() for room_id, session in sessions.sessions.items()},
+        "journal_queue": JOURNAL_WRITER.depth,
+        "llm_breakers": get_llm_client().resilience_stats(),
+    })
+
+app.router.add_get('/load', handle_load)
+
+
+async def handle_healthz(request):
+    """存活检查：开始监听即返回 200，不等待后台预热；同时给出启动各阶段的耗时与预热是否完成（warm）。"""
+    return web.json_response({"status": "ok", "worker_id": WORKER_ID, **STARTUP.report()})
+
+app.router.add_get('/healthz', handle_healthz)
+
+
+async def handle_llm_cache(request):
+    """LLM 响应缓存的条目数与按调用类型的命中/未命中统计。"""
+    return web.json_response(get_llm_client().cache.stats())
+
+app.router.add_get('/llm_cache', handle_llm_cache)
+
+
+async def handle_llm_routes(request):
+    """当前的模型路由表，以及按（档位, 模型）划分的调用次数、延迟分位数与 token 数。"""
+    return web.json_response({**get_router().describe(), "stats": route_stats.report()})
+
+app.router.add_get('/llm_routes', handle_llm_routes)
+
+
+async def handle_metrics(request):
+    """Prometheus 文本格式的运行指标。"""
+    return web.Response(body=metrics.REGISTRY.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+metrics.ACTIVE_SESSIONS.set_function(lambda: len(sessions.sessions))
+metrics.CONNECTED_SIDS.set_function(lambda: len(sessions.sid_rooms))
+metrics.OUTBOUND_QUEUED.set_function(lambda: sum(len(o) for s in sessions.sessions.values() for o in s.outboxes.values()))
+metrics.SCHEDULER_QUEUE_DEPTH.set_function(lambda: sum(s.scheduler.depth for s in sessions.sessions.values()))
+metrics.RAG_INGEST_QUEUE_DEPTH.set_function(lambda: sum(s.rag_ingest.depth for s in sessions.sessions.values()))
+app.router.add_get('/metrics', handle_metrics)
+
+STARTUP.mark("app_setup")
+
+
+async def serve(host: str, port: int):
+    """启动服务并一直运行到收到 SIGINT / SIGTERM；端口绑定完成时记录 time-to-listen。"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    STARTUP.listening()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows 不支持，Ctrl+C 时由 KeyboardInterrupt 结束
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
 
 
 # ----------------- Main Application Runner -----------------
 if __name__ == '__main__':
-    initialize_game()
-    print("Starting Socket.IO server on http://localhost:8765")
-    web.run_app(app, host='localhost', port=8765) 
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="剧本杀游戏服务器")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="大于 1 时启动分片模式：本进程作为路由，按房间把连接转发到 N 个 worker 进程")
+    parser.add_argument("--worker-base-port", type=int, default=9000)
+    parser.add_argument("--worker-id", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-count", type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        from shard_router import run_router
+        run_router(os.path.abspath(__file__), args.workers, host=args.host, port=args.port,
+                   base_port=args.worker_base_port)
+    else:
+        WORKER_ID = args.worker_id
+        WORKER_COUNT = args.worker_count
+        logger.info("Socket.IO 服务启动于 http://%s:%s", args.host, args.port)
+        try:
+            asyncio.run(serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass 
\ No newline at end of file
@@ -0,0 +1,227 @@
+import asyncio
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web, WSMsgType
+
+from game_session import DEFAULT_ROOM_ID, find_restorable, shard_for_room
+from structured_log import get_logger, setup_logging
+
+logger = get_logger("router")
+
+# ----------------- 多进程分片配置 -----------------
+LOAD_POLL_INTERVAL = 2.0    # 轮询各 worker /load 的间隔（秒）
+WORKER_START_TIMEOUT = 30.0 # 等待 worker 开始监听的上限（秒）
+
+# 代理 HTTP 长轮询请求时不应透传的逐跳头
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+
+class Worker:
+    """一个承载若干房间的游戏服务进程（python server.py --port ...）。"""
+
+    def __init__(self, worker_id: int, host: str, port: int):
+        self.worker_id = worker_id
+        self.host = host
+        self.port = port
+        self.process: Optional[subprocess.Popen] = None
+        self.rooms: set = set()
+        self.load: Dict = {}
+        self.last_seen: Optional[float] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, script_path: str, worker_count: int):
+        self.process = subprocess.Popen([
+            sys.executable, script_path,
+            "--host", self.host, "--port", str(self.port),
+            "--worker-id", str(self.worker_id), "--worker-count", str(worker_count),
+        ])
+
+    def stop(self):
+        if self.alive:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def describe(self) -> Dict:
+        return {
+            "worker_id": self.worker_id,
+            "port": self.port,
+            "pid": self.process.pid if self.process else None,
+            "alive": self.alive,
+            "assigned_rooms": sorted(self.rooms),
+            "load": self.load,
+            "last_seen": self.last_seen,
+        }
+
+
+class ShardRouter:
+    """
+    多进程入口：对外监听一个端口，按房间号把 socket.io 连接粘滞地转发到固定的 worker 进程。
+    同一房间的所有连接与 advance_game 都在同一个进程内执行；新房间分配给当前负载最低的 worker，
+    从对局日志恢复的房间固定分配给 shard_for_room 指定的 worker（只有它会恢复该局）。
+    """
+
+    def __init__(self, script_path: str, num_workers: int, host: str = "localhost",
+                 worker_host: str = "127.0.0.1", base_port: int = 9000):
+        self.script_path = script_path
+        self.host = host
+        self.workers: List[Worker] = [
+            Worker(i, worker_host, base_port + i) for i in range(num_workers)
+        ]
+        self.assignments: Dict[str, Worker] = {}
+        self._client: Optional[aiohttp.ClientSession] = None
+        self._poll_task: Optional[asyncio.Task] = None
+
+        self.app = web.Application()
+        self.app.router.add_get("/workers", self.handle_workers)
+        self.app.router.add_route("*", "/socket.io/", self.handle_socketio)
+        self.app.on_startup.append(self._on_startup)
+        self.app.on_cleanup.append(self._on_cleanup)
+
+    # ----------------- 生命周期 -----------------
+    async def _on_startup(self, app):
+        self.pin_restored_rooms(await asyncio.to_thread(find_restorable))
+        for worker in self.workers:
+            worker.start(self.script_path, len(self.workers))
+        # 长轮询响应按原样透传（包括压缩编码），不在 router 解压
+        self._client = aiohttp.ClientSession(auto_decompress=False)
+        await self._wait_for_workers()
+        self._poll_task = asyncio.create_task(self._poll_loads())
+
+    async def _on_cleanup(self, app):
+        if self._poll_task:
+            self._poll_task.cancel()
+        if self._client:
+            await self._client.close()
+        for worker in self.workers:
+            worker.stop()
+
+    async def _wait_for_workers(self):
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        pending = list(self.workers)
+        while pending and time.monotonic() < deadline:
+            for worker in list(pending):
+                if await self._refresh_load(worker):
+                    pending.remove(worker)
+            if pending:
+                await asyncio.sleep(0.5)
+        for worker in pending:
+            logger.error("worker %s 未能在 %ss 内启动", worker.worker_id, WORKER_START_TIMEOUT)
+
+    async def _refresh_load(self, worker: Worker) -> bool:
+        try:
+            async with self._client.get(f"{worker.base_url}/load", timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                worker.load = await resp.json()
+                worker.last_seen = time.time()
+                return True
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return False
+
+    async def _poll_loads(self):
+        while True:
+            await asyncio.gather(*(self._refresh_load(w) for w in self.workers if w.alive))
+            await asyncio.sleep(LOAD_POLL_INTERVAL)
+
+    # ----------------- 房间 -> worker 分配 -----------------
+    def _score(self, worker: Worker) -> int:
+        """负载分数：已分配房间数与 worker 自报的连接数之和。"""
+        return len(worker.rooms) + int(worker.load.get("connected_sids", 0))
+
+    def pin_restored_rooms(self, room_ids):
+        """worker 启动后会各自恢复 shard_for_room 指向自己的对局，这些房间的连接事先固定转发到对应的 worker。"""
+        for room_id in room_ids:
+            worker = self.workers[shard_for_room(room_id, len(self.workers))]
+            worker.rooms.add(room_id)
+            self.assignments[room_id] = worker
+            logger.info("恢复的房间 '%s' 分配到 worker %s (port %s)", room_id, worker.worker_id, worker.port)
+
+    def worker_for_room(self, room_id: str) -> Worker:
+        worker = self.assignments.get(room_id)
+        if worker is not None and worker.alive:
+            return worker
+        if worker is not None:
+            # 原 worker 已退出，房间状态随之丢失，重新分配
+            worker.rooms.discard(room_id)
+        candidates = [w for w in self.workers if w.alive] or self.workers
+        worker = min(candidates, key=self._score)
+        worker.rooms.add(room_id)
+        self.assignments[room_id] = worker
+        logger.info("房间 '%s' 分配到 worker %s (port %s)", room_id, worker.worker_id, worker.port)
+        return worker
+
+    # ----------------- 请求处理 -----------------
+    async def handle_workers(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "workers": [w.describe() for w in self.workers],
+            "rooms": {room: w.worker_id for room, w in self.assignments.items()},
+        })
+
+    async def handle_socketio(self, request: web.Request) -> web.StreamResponse:
+        room_id = request.query.get("room") or DEFAULT_ROOM_ID
+        worker = self.worker_for_room(room_id)
+        target = f"{worker.base_url}{request.path_qs}"
+        if request.headers.get("Upgrade", "").lower() == "websocket":
+            return await self._proxy_websocket(request, target)
+        return await self._proxy_http(request, target)
+
+    async def _proxy_websocket(self, request: web.Request, target: str) -> web.WebSocketResponse:
+        client_ws = web.WebSocketResponse()
+        await client_ws.prepare(request)
+        try:
+            async with self._client.ws_connect(target.replace("http://", "ws://", 1)) as worker_ws:
+                async def pump(source, sink):
+                    async for msg in source:
+                        if msg.type == WSMsgType.TEXT:
+                            await sink.send_str(msg.data)
+                        elif msg.type == WSMsgType.BINARY:
+                            await sink.send_bytes(msg.data)
+                        else:
+                            break
+
+                tasks = [
+                    asyncio.create_task(pump(client_ws, worker_ws)),
+                    asyncio.create_task(pump(worker_ws, client_ws)),
+                ]
+                _, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+        except aiohttp.ClientError as e:
+            logger.error("连接 worker 失败: %s", e)
+        finally:
+            await client_ws.close()
+        return client_ws
+
+    async def _proxy_http(self, request: web.Request, target: str) -> web.Response:
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        body = await request.read()
+        try:
+            async with self._client.request(request.method, target, headers=headers, data=body) as resp:
+                payload = await resp.read()
+                out_headers = {k: v for k, v in resp.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+                return web.Response(status=resp.status, body=payload, headers=out_headers)
+        except aiohttp.ClientError as e:
+            return web.Response(status=502, text=f"worker unavailable: {e}")
+
+
+def run_router(script_path: str, num_workers: int, host: str = "localhost", port: int = 8765,
+               base_port: int = 9000):
+    setup_logging()
+    router = ShardRouter(script_path, num_workers, host=host, base_port=base_port)
+    logger.info("分片路由启动于 http://%s:%s，共 %s 个 worker", host, port, num_workers)
+    web.run_app(router.app, host=host, port=port)
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from metrics import SPECULATION, SPECULATION_SAVED
+from structured_log import get_logger
+
+logger = get_logger("speculation")
+
+# ----------------- 预生成配置 -----------------
+# 设为 1 开启：轮到某人发言时，提前在后台生成下一位 AI 玩家的发言
+SPECULATE_ENABLED = os.environ.get("JUBENSHA_SPECULATE", "0") == "1"
+# 除当前发言人自己的那条发言外，草稿生成之后最多允许再新增几条 AI 聊天消息仍然采用。
+# 默认 0：当前发言人之外只要有人发言就丢弃重新生成。
+# 无论该值是多少，草稿开始之后只要有（当前发言人以外的）真人玩家发言，草稿一律作废
+SPECULATE_MAX_STALE = int(os.environ.get("JUBENSHA_SPECULATE_MAX_STALE", "0"))
+
+
+@dataclass
+class Draft:
+    task: asyncio.Task
+    snapshot: int                   # 预期采用时的聊天消息数（开始生成时的数目 + 当前发言人的发言）
+    human_snapshot: int = 0         # 预期采用时真人玩家的聊天消息数
+    started: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+
+
+class Speculator:
+    """
+    发言草稿的预生成：按 (阶段, 玩家) 保存正在生成或已生成的草稿。
+    草稿在当前发言人说话时开始生成，它的发言必然在草稿之后到来，因此 prefetch 传入的计数已经把这条发言算在内。
+    轮到该玩家时，若此外没有真人玩家发言、多出的聊天消息也不超过 max_stale 条就直接采用
+    （生成中则等它完成），否则丢弃并由调用方重新生成。hit / stale / discarded / failed 计入指标，用于估算命中率与浪费率。
+    """
+
+    def __init__(self, spawn: Callable[[Awaitable], asyncio.Task], max_stale: int = SPECULATE_MAX_STALE,
+                 enabled: bool = SPECULATE_ENABLED):
+        self.spawn = spawn
+        self.max_stale = max_stale
+        self.enabled = enabled
+        self.drafts: Dict[Tuple[str, str], Draft] = {}
+        self.outcomes: Counter = Counter()
+        self.saved_seconds = 0.0
+
+    def prefetch(self, stage: str, player_id: str, chat_count: int, generate: Callable[[], Awaitable[Optional[str]]],
+                 human_count: int = 0):
+        """
+        在后台开始生成 player_id 在 stage 中的发言；已有草稿时不重复生成。
+        chat_count / human_count 为当前发言人说完之后应有的（真人玩家）聊天消息数。
+        """
+        key = (stage, player_id)
+        if not self.enabled or key in self.drafts:
+            return
+        draft = Draft(task=self.spawn(generate()), snapshot=chat_count, human_snapshot=human_count)
+        draft.task.add_done_callback(lambda task: self._on_done(draft, task))
+        self.drafts[key] = draft
+        self._count("started")
+
+    @staticmethod
+    def _on_done(draft: Draft, task: asyncio.Task):
+        draft.finished = time.monotonic()
+        # 被丢弃的草稿可能没人 await：在这里取走异常，避免 "exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
+
+    async def take(self, stage: str, player_id: str, chat_count: int, human_count: int = 0) -> Optional[str]:
+        """取出可用的草稿文本；没有草稿、草稿过期或生成失败时返回 None。"""
+        needed_at = time.monotonic()
+        draft = self.drafts.pop((stage, player_id), None)
+        if draft is None:
+            return None
+        stale = chat_count - draft.snapshot
+        if stale > self.max_stale or human_count > draft.human_snapshot:
+            draft.task.cancel()
+            self._count("stale")
+            logger.debug("草稿已过期，丢弃", extra={"player_id": player_id, "new_messages": stale})
+            return None
+        try:
+            text = await draft.task
+        except Exception as e:
+            logger.warning("草稿生成失败: %s", e, extra={"player_id": player_id})
+            text = None
+        if not text:
+            self._count("failed")
+            return None
+        # 节省的时间：草稿在需要之前已经生成了多久（已完成时即整段生成耗时）
+        saved = min(draft.finished or needed_at, needed_at) - draft.started
+        self.saved_seconds += saved
+        SPECULATION_SAVED.inc(saved)
+        self._count("hit")
+        return text
+
+    def discard_all(self):
+        """阶段切换等场合调用：取消并丢弃所有未使用的草稿。"""
+        for draft in self.drafts.values():
+            draft.task.cancel()
+            self._count("discarded")
+        self.drafts.clear()
+
+    def _count(self, outcome: str):
+        self.outcomes[outcome] += 1
+        SPECULATION.inc(outcome=outcome)
+
+    def stats(self) -> dict:
+        started = self.outcomes["started"]
+        wasted = self.outcomes["stale"] + self.outcomes["discarded"] + self.outcomes["failed"]
+        return {
+            **self.outcomes,
+            "hit_rate": self.outcomes["hit"] / started if started else 0.0,
+            "waste_rate": wasted / started if started else 0.0,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
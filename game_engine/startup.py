@@ -0,0 +1,53 @@
+import time
+from typing import Dict, Optional
+
+from metrics import STARTUP_PHASE_SECONDS
+from structured_log import get_logger
+
+logger = get_logger("startup")
+
+
+class StartupTimer:
+    """
+    服务启动耗时的分阶段记录：导入、应用初始化、启动钩子、开始监听（time-to-listen），
+    以及开始监听之后在后台进行的预热（恢复对局、导入记忆模块）。
+    计时从本模块被导入时开始，不含解释器自身的启动时间。
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._last = self.started
+        # 监听之前的各阶段：阶段名 -> 从上一阶段结束到本阶段结束的秒数
+        self.phases: Dict[str, float] = {}
+        # 监听之后的后台预热：阶段名 -> 秒数
+        self.background: Dict[str, float] = {}
+        self.time_to_listen: Optional[float] = None
+        self.warm = False
+
+    def mark(self, phase: str):
+        """结束一个启动阶段，记录它的耗时。"""
+        now = time.monotonic()
+        self.phases[phase] = round(now - self._last, 3)
+        self._last = now
+        STARTUP_PHASE_SECONDS.set(self.phases[phase], phase=phase)
+
+    def listening(self):
+        """端口绑定完成时调用。"""
+        self.mark("listen")
+        self.time_to_listen = round(time.monotonic() - self.started, 3)
+        logger.info("服务开始监听", extra={"time_to_listen": self.time_to_listen, "phases": self.phases})
+
+    def record_background(self, phase: str, seconds: float):
+        self.background[phase] = round(seconds, 3)
+        STARTUP_PHASE_SECONDS.set(self.background[phase], phase=f"warmup_{phase}")
+
+    def warmed_up(self):
+        self.warm = True
+        logger.info("后台预热完成", extra={"background": self.background})
+
+    def report(self) -> dict:
+        return {"warm": self.warm, "time_to_listen": self.time_to_listen,
+                "phases": self.phases, "warmup": self.background}
+
+
+STARTUP = StartupTimer()
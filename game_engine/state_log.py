@@ -0,0 +1,53 @@
+import os
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+# ----------------- 状态日志配置 -----------------
+# 每局保留的最近状态事件条数；客户端落后超过这个范围时改为发送完整快照
+STATE_LOG_SIZE = int(os.environ.get("JUBENSHA_STATE_LOG_SIZE", "2000"))
+
+
+def set_op(key: str, value: Any) -> Dict[str, Any]:
+    """把顶层字段 key 整体替换为 value。"""
+    return {"op": "set", "key": key, "value": value}
+
+
+def merge_op(key: str, value: Dict[str, Any]) -> Dict[str, Any]:
+    """把 value 中的条目合并进字典字段 key（如 votes、accusations）。"""
+    return {"op": "merge", "key": key, "value": value}
+
+
+def append_op(key: str, value: Any) -> Dict[str, Any]:
+    """在列表字段 key（如 public_clues）末尾追加一项。"""
+    return {"op": "append", "key": key, "value": value}
+
+
+class StateLog:
+    """
+    一局游戏的状态事件日志：每条向全房间广播的状态事件都分配一个单调递增的版本号。
+    客户端重连时带上最后见过的版本号，只需补发之后的事件；落后太多或版本号不认识时返回 None，
+    由调用方改发完整快照。
+    """
+
+    def __init__(self, max_entries: int = STATE_LOG_SIZE):
+        self.version = 0
+        self._entries: Deque[Dict[str, Any]] = deque(maxlen=max_entries)
+
+    def append(self, event: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """记录一条事件，返回带 version 字段的负载。"""
+        self.version += 1
+        payload = {**data, "version": self.version}
+        self._entries.append({"version": self.version, "event": event, "data": payload})
+        return payload
+
+    def since(self, version: int) -> Optional[List[Dict[str, Any]]]:
+        """返回 version 之后的全部事件；无法补齐时返回 None。"""
+        if version > self.version:
+            # 客户端的版本号来自另一局（例如服务重启后），无法增量同步
+            return None
+        if version == self.version:
+            return []
+        oldest = self._entries[0]["version"] if self._entries else self.version + 1
+        if version + 1 < oldest:
+            return None
+        return [entry for entry in self._entries if entry["version"] > version]
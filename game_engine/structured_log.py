@@ -0,0 +1,110 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Any, Dict, Optional
+
+# ----------------- 日志配置 -----------------
+# 日志级别：DEBUG 时才会输出每条消息后的消息列表与记忆内容等大段调试信息
+LOG_LEVEL = os.environ.get("JUBENSHA_LOG_LEVEL", "INFO").upper()
+# 输出格式：text（人读）或 json（每行一个 JSON 对象，便于采集）
+LOG_FORMAT = os.environ.get("JUBENSHA_LOG_FORMAT", "text").lower()
+ROOT_LOGGER = "jubensha"
+
+# 当前任务所属的房间；asyncio.create_task 会复制上下文，所以由某个房间的事件派生出的任务都会带上该房间号
+_room: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("log_room", default=None)
+
+# LogRecord 自带的属性，其余属性（通过 extra= 传入）都视为结构化字段
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "room"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def bind_room(room_id: Optional[str]):
+    """把当前任务（及其之后派生的任务）的日志关联到某个房间。"""
+    _room.set(room_id)
+
+
+def _fields(record: logging.LogRecord) -> Dict[str, Any]:
+    return {k: v for k, v in vars(record).items() if k not in _RESERVED_ATTRS and not k.startswith("_")}
+
+
+class _RoomFilter(logging.Filter):
+    """在记录产生的线程（事件循环）里读取房间号；进入队列后就读不到上下文了。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "room"):
+            record.room = _room.get()
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    """时间 级别 logger [房间] 消息 key=value ..."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        room = getattr(record, "room", None)
+        parts = [self.formatTime(record), record.levelname, record.name]
+        if room:
+            parts.append(f"[{room}]")
+        parts.append(record.getMessage())
+        parts.extend(f"{k}={v}" for k, v in _fields(record).items())
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "room": getattr(record, "room", None),
+            "msg": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """
+    配置 jubensha.* 日志：调用方只把记录放进内存队列，
+    由后台线程批量格式化并写出，stdout 的同步 I/O 不再占用事件循环。重复调用无副作用。
+    """
+    global _listener
+    if _listener is not None:
+        return
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level)
+    root.propagate = False
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(_RoomFilter())
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """停止后台线程，并写出队列中剩余的日志。"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
@@ -0,0 +1,191 @@
+import json
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from llm_client import LLMError
+from metrics import STRUCTURED_OUTPUT, STRUCTURED_PARSE_FAILURES
+from structured_log import get_logger
+
+logger = get_logger("structured_output")
+
+# ----------------- 结构化输出配置 -----------------
+# 向服务端请求结构化输出的方式：schema（response_format 为 json_schema）、json（json_object）或 off（只靠提示词）。
+# 某个端点与模型明确拒绝该参数时，LLMClient 记住它并在之后的请求中去掉该参数（只影响该端点与模型）
+STRUCTURED_MODE = os.environ.get("JUBENSHA_LLM_STRUCTURED_MODE", "json")
+# 解析或校验失败后最多发起的修复调用次数
+MAX_REPAIRS = 1
+# 修复提示中最多附带的原始回复字符数
+REPAIR_RAW_CHARS = 2000
+
+# chat(messages, **extra) -> 模型输出；失败时抛出 LLMError。extra 会原样放进请求体（如 response_format）
+ChatFn = Callable[..., Awaitable[str]]
+# 语义校验：schema 之外的约束（如信任与怀疑不能是同一人），返回错误说明，通过时返回 None
+Check = Callable[[Dict[str, Any]], Optional[str]]
+
+_FENCE_PATTERN = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.S)
+_decoder = json.JSONDecoder()
+
+_TYPE_CHECKS = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+}
+
+
+class StructuredOutputError(ValueError):
+    """模型输出无法解析或不符合要求。reason 为 no_json / schema / check，用于指标。"""
+
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def extract_json(text: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    从模型输出中找出第一个 JSON 对象：容忍 ``` 代码块、前后的说明文字以及对象之后多余的内容。
+    找不到时返回 None。
+    """
+    if not text:
+        return None
+    candidates = [m.group(1) for m in _FENCE_PATTERN.finditer(text)] + [text]
+    for candidate in candidates:
+        start = candidate.find("{")
+        while start != -1:
+            try:
+                value, _ = _decoder.raw_decode(candidate, start)
+            except ValueError:
+                value = None
+            if isinstance(value, dict):
+                return value
+            start = candidate.find("{", start + 1)
+    return None
+
+
+def _strip_strings(value: Any) -> Any:
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list):
+        return [_strip_strings(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _strip_strings(v) for k, v in value.items()}
+    return value
+
+
+def validate(value: Any, schema: Dict[str, Any], path: str = "$") -> List[str]:
+    """
+    按 JSON Schema 的一个常用子集校验：type、enum、required、properties、items、
+    minItems / maxItems / uniqueItems、minLength。返回错误说明列表，为空表示通过。
+    """
+    expected = schema.get("type")
+    python_type = _TYPE_CHECKS.get(expected)
+    if python_type is not None and (not isinstance(value, python_type)
+                                    or (expected in ("number", "integer") and isinstance(value, bool))):
+        return [f"{path} 应为 {expected}"]
+    errors = []
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path} 必须是 {schema['enum']} 之一")
+    if expected == "string" and len(value) < schema.get("minLength", 0):
+        errors.append(f"{path} 不能为空")
+    if expected == "object":
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"缺少字段 {path}.{key}")
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key in value:
+                errors.extend(validate(value[key], sub_schema, f"{path}.{key}"))
+    if expected == "array":
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{path} 至少需要 {schema['minItems']} 项")
+        if "maxItems" in schema and len(value) > schema["maxItems"]:
+            errors.append(f"{path} 最多 {schema['maxItems']} 项")
+        if schema.get("uniqueItems") and len({json.dumps(v, sort_keys=True) for v in value}) != len(value):
+            errors.append(f"{path} 中不能有重复项")
+        if "items" in schema:
+            for i, item in enumerate(value):
+                errors.extend(validate(item, schema["items"], f"{path}[{i}]"))
+    return errors
+
+
+def parse_structured(text: Optional[str], schema: Dict[str, Any], check: Optional[Check] = None) -> Dict[str, Any]:
+    """提取并校验一个 JSON 对象，失败时抛出 StructuredOutputError。字符串字段两端的空白会被去掉。"""
+    value = extract_json(text)
+    if value is None:
+        raise StructuredOutputError("回复中没有 JSON 对象", "no_json")
+    value = _strip_strings(value)
+    errors = validate(value, schema)
+    if errors:
+        raise StructuredOutputError("；".join(errors[:5]), "schema")
+    problem = check(value) if check is not None else None
+    if problem:
+        raise StructuredOutputError(problem, "check")
+    return value
+
+
+def response_format(schema: Dict[str, Any], name: str) -> Dict[str, Any]:
+    """按 STRUCTURED_MODE 构造请求体中的 response_format 参数。"""
+    if STRUCTURED_MODE == "schema":
+        return {"response_format": {"type": "json_schema",
+                                    "json_schema": {"name": name, "schema": schema, "strict": True}}}
+    if STRUCTURED_MODE == "json":
+        return {"response_format": {"type": "json_object"}}
+    return {}
+
+
+def repair_messages(raw: Optional[str], schema: Dict[str, Any], error: str) -> List[Dict[str, str]]:
+    """修复调用的提示词：只带上原始回复、schema 与具体问题，不重复整段游戏上下文。"""
+    return [
+        {"role": "system", "content": "你负责把一段文本整理成符合要求的 JSON 对象。只输出 JSON 对象本身，不要输出任何其他文字。"},
+        {"role": "user", "content": f"""要求的 JSON Schema：
+{json.dumps(schema, ensure_ascii=False)}
+
+原始回复：
+{(raw or "")[:REPAIR_RAW_CHARS]}
+
+存在的问题：{error}
+
+请尽量保留原始回复的意思，输出修正后的 JSON 对象。"""},
+    ]
+
+
+async def _call(chat: ChatFn, messages: List[Dict[str, str]], schema: Dict[str, Any],
+                call_type: str) -> Optional[str]:
+    try:
+        return await chat(messages, **response_format(schema, call_type))
+    except LLMError as e:
+        if e.reason == "response_format_rejected":
+            # LLMClient 已记住该端点与模型不支持 response_format，重发时会去掉它，只靠提示词约束 JSON
+            logger.warning("服务端拒绝 response_format，改为仅用提示词约束 JSON 重试: %s", e,
+                           extra={"call_type": call_type})
+            return await _call(chat, messages, schema, call_type)
+        logger.warning("结构化输出调用失败: %s", e, extra={"call_type": call_type})
+        return None
+
+
+async def generate_structured(chat: ChatFn, messages: List[Dict[str, str]], schema: Dict[str, Any],
+                              call_type: str, check: Optional[Check] = None) -> Optional[Dict[str, Any]]:
+    """
+    请求一个符合 schema 的 JSON 对象：支持时让服务端约束输出格式，本地用宽松的提取器解析并校验；
+    不合格时带着具体问题发起至多 MAX_REPAIRS 次修复调用。
+    返回 None 表示最终失败（调用失败或修复后仍不合格），由调用方决定兜底方式。
+    """
+    raw = await _call(chat, messages, schema, call_type)
+    for attempt in range(MAX_REPAIRS + 1):
+        if raw is None:
+            break
+        try:
+            value = parse_structured(raw, schema, check)
+        except StructuredOutputError as e:
+            STRUCTURED_PARSE_FAILURES.inc(call_type=call_type, reason=e.reason)
+            logger.warning("结构化输出不合格（%s）: %s", e.reason, e,
+                           extra={"call_type": call_type, "attempt": attempt})
+            if attempt < MAX_REPAIRS:
+                raw = await _call(chat, repair_messages(raw, schema, str(e)), schema, call_type)
+            continue
+        STRUCTURED_OUTPUT.inc(call_type=call_type, outcome="ok" if attempt == 0 else "repaired")
+        return value
+    STRUCTURED_OUTPUT.inc(call_type=call_type, outcome="failed")
+    return None
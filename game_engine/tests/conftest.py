@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 服务端模块以扁平方式互相导入（from metrics import ...），测试时把 game_engine 加入搜索路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
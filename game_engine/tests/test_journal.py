@@ -0,0 +1,168 @@
+import asyncio
+import json
+
+import pytest
+
+from journal import JOURNAL_FILE, SNAPSHOT_FILE, JournalWriter, SessionJournal, find_journals, load_journal
+
+
+@pytest.fixture
+def writer():
+    return JournalWriter()
+
+
+def _journal(tmp_path, writer, snapshot_every=100):
+    return SessionJournal(str(tmp_path), snapshot_every=snapshot_every, writer=writer)
+
+
+def test_record_appends_only_changed_fields(tmp_path, writer):
+    journal = _journal(tmp_path, writer)
+    assert journal.record({"a": 1, "b": [1, 2]})
+    assert not journal.record({"a": 1, "b": [1, 2]})
+    assert journal.record({"a": 2, "b": [1, 2]})
+    writer.join()
+
+    with open(tmp_path / JOURNAL_FILE, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    assert entries == [{"n": 1, "set": {"a": 1, "b": [1, 2]}}, {"n": 2, "set": {"a": 2}}]
+    assert load_journal(str(tmp_path)) == (2, {"a": 2, "b": [1, 2]})
+
+
+def test_snapshot_truncates_journal_and_load_replays_later_entries(tmp_path, writer):
+    journal = _journal(tmp_path, writer, snapshot_every=2)
+    journal.record({"stage": "alibi", "votes": {}})
+    journal.record({"stage": "discussion_1", "votes": {}})
+    journal.record({"stage": "discussion_1", "votes": {"p1": "p2"}})
+    writer.join()
+
+    with open(tmp_path / SNAPSHOT_FILE, encoding="utf-8") as f:
+        assert json.load(f) == {"n": 2, "state": {"stage": "discussion_1", "votes": {}}}
+    with open(tmp_path / JOURNAL_FILE, encoding="utf-8") as f:
+        assert [json.loads(line)["n"] for line in f] == [3]
+    assert load_journal(str(tmp_path)) == (3, {"stage": "discussion_1", "votes": {"p1": "p2"}})
+
+
+def test_load_ignores_truncated_last_line(tmp_path, writer):
+    journal = _journal(tmp_path, writer)
+    journal.record({"a": 1})
+    writer.join()
+    with open(tmp_path / JOURNAL_FILE, "a", encoding="utf-8") as f:
+        f.write('{"n": 2, "set": {"a"')
+    assert load_journal(str(tmp_path)) == (1, {"a": 1})
+
+
+def test_load_without_journal_returns_none(tmp_path):
+    assert load_journal(str(tmp_path)) is None
+
+
+def test_resume_from_continues_numbering_and_diffs(tmp_path, writer):
+    journal = _journal(tmp_path, writer)
+    journal.record({"a": 1, "b": 2})
+    writer.join()
+
+    n, state = load_journal(str(tmp_path))
+    resumed = _journal(tmp_path, writer)
+    resumed.resume_from(n, state)
+    assert not resumed.record({"a": 1, "b": 2})
+    assert resumed.record({"a": 1, "b": 3})
+    writer.join()
+    assert load_journal(str(tmp_path)) == (2, {"a": 1, "b": 3})
+
+
+def test_find_journals_lists_only_session_dirs(tmp_path, writer):
+    session_dir = tmp_path / "game_r1_1"
+    session_dir.mkdir()
+    (tmp_path / "empty").mkdir()
+    _journal(session_dir, writer).record({"a": 1})
+    writer.join()
+    assert find_journals(str(tmp_path)) == [str(session_dir)]
+    assert find_journals(str(tmp_path / "missing")) == []
+
+
+# ----------------- 从日志恢复对局 -----------------
+server = pytest.importorskip("server")
+from game_session import find_restorable, shard_for_room
+from shard_router import ShardRouter
+
+
+def _restorable(tmp_path, room_id, agents=None, **game_state):
+    session_dir = tmp_path / f"game_{room_id}_1"
+    session_dir.mkdir()
+    state = {"room_id": room_id, "finished": False, "state_version": 7, "agents": agents or {},
+             **{f"game_state.{key}": value for key, value in game_state.items()}}
+    journal = SessionJournal(str(session_dir))
+    journal.snapshot(state)
+    journal.writer.join()
+    return session_dir
+
+
+def test_session_manager_restores_unfinished_games_only(tmp_path):
+    _restorable(tmp_path, "live", agents={"ai_player_1": {"clues_obtained": ["血迹"]}},
+                stage="discussion_1", turn_order=["p1"])
+    _restorable(tmp_path, "lobby", stage="waiting_for_players")
+
+    async def scenario():
+        manager = server.SessionManager(sio=None)
+        restored = manager.restore(str(tmp_path))
+        for session in restored:
+            session.scheduler.cancel()
+        return restored
+
+    restored = asyncio.run(scenario())
+    assert [s.room_id for s in restored] == ["live"]
+    session = restored[0]
+    assert session.game_state["stage"] == "discussion_1"
+    assert session.state_log.version == 7
+    # 恢复时不应提前创建 Agent 与记忆索引
+    assert session._ai_agents is None
+    assert session.rag_ingest.rag_manager is None
+    # 未创建 Agent 时导出的仍是恢复出的线索，创建后线索写入对应的 Agent
+    assert session.export_state()["agents"] == {"ai_player_1": {"clues_obtained": ["血迹"]}}
+    assert session.ai_agents["ai_player_1"].knowledge_base["clues_obtained"] == ["血迹"]
+    assert session.ai_agents["ai_player_2"].knowledge_base["clues_obtained"] == []
+    assert session.export_state()["agents"]["ai_player_1"] == {"clues_obtained": ["血迹"]}
+
+
+def test_each_restorable_game_is_resumed_by_exactly_one_worker(tmp_path):
+    rooms = [f"room{i}" for i in range(6)]
+    for room_id in rooms:
+        _restorable(tmp_path, room_id, stage="discussion_1", turn_order=["p1"])
+
+    async def scenario():
+        owners = {}
+        for worker_id in range(3):
+            manager = server.SessionManager(sio=None)
+            for session in manager.restore(str(tmp_path), shard=(worker_id, 3)):
+                session.scheduler.cancel()
+                owners.setdefault(session.room_id, []).append(worker_id)
+        return owners
+
+    owners = asyncio.run(scenario())
+    assert sorted(owners) == rooms
+    assert all(workers == [shard_for_room(room_id, 3)] for room_id, workers in owners.items())
+
+    # router 把恢复出的房间固定转发到恢复它的 worker
+    router = ShardRouter("server.py", 3)
+    router.pin_restored_rooms(find_restorable(str(tmp_path)))
+    assert {room_id: worker.worker_id for room_id, worker in router.assignments.items()} == \
+        {room_id: workers[0] for room_id, workers in owners.items()}
+
+
+@pytest.mark.parametrize("pending_action, advanced", [("statement_human_player_1", False), (None, True)])
+def test_resume_session_waits_for_pending_human_statement(tmp_path, monkeypatch, pending_action, advanced):
+    _restorable(tmp_path, "room", stage="discussion_1", turn_order=["human_player_1"], pending_action=pending_action)
+    calls = []
+
+    async def fake_advance(session):
+        calls.append(session.room_id)
+
+    monkeypatch.setattr(server, "advance_game", fake_advance)
+
+    async def scenario():
+        manager = server.SessionManager(sio=None)
+        session, = manager.restore(str(tmp_path))
+        await server.resume_session(session)
+        session.scheduler.cancel()
+
+    asyncio.run(scenario())
+    assert calls == (["room"] if advanced else [])
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+import llm_cache
+from llm_cache import LLMCache, cache_key
+
+
+def test_cache_key_depends_on_model_messages_and_extra():
+    messages = [{"role": "user", "content": "你好"}]
+    key = cache_key("m1", messages, temperature=0.2)
+    assert key == cache_key("m1", [dict(m) for m in messages], temperature=0.2)
+    assert key != cache_key("m2", messages, temperature=0.2)
+    assert key != cache_key("m1", messages, temperature=0.7)
+
+
+def test_enabled_only_for_cacheable_types():
+    cache = LLMCache(cacheable_types={"summary"})
+    assert cache.enabled_for("summary")
+    assert not cache.enabled_for("statement")
+    assert not cache.enabled_for(None)
+    assert not LLMCache(max_entries=0, cacheable_types={"summary"}).enabled_for("summary")
+
+
+def test_lru_evicts_least_recently_used_entry():
+    async def scenario():
+        cache = LLMCache(max_entries=2)
+        await cache.put("a", "A")
+        await cache.put("b", "B")
+        # 读取 a 之后 b 成为最久未用的条目
+        assert await cache.get("a", "summary") == "A"
+        await cache.put("c", "C")
+        return cache, [await cache.get(key, "summary") for key in ("a", "b", "c")]
+
+    cache, values = asyncio.run(scenario())
+    assert values == ["A", None, "C"]
+    assert cache.evictions == 1
+    assert cache.stats()["by_call_type"]["summary"] == {"hits": 3, "misses": 1}
+
+
+def test_expired_entries_are_misses(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now[0])
+
+    async def scenario():
+        cache = LLMCache(ttl=10)
+        await cache.put("k", "v")
+        now[0] += 9
+        fresh = await cache.get("k", "summary")
+        now[0] += 2
+        return cache, fresh, await cache.get("k", "summary")
+
+    cache, fresh, expired = asyncio.run(scenario())
+    assert (fresh, expired) == ("v", None)
+    assert cache.stats()["entries"] == 0
+
+
+def test_sqlite_store_survives_restart_and_drops_expired_rows(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache" / "llm.sqlite")
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now[0])
+
+    async def scenario():
+        first = LLMCache(ttl=10, path=path)
+        await first.put("k", "v")
+        # 新实例的内存 LRU 为空，只能从磁盘读到
+        second = LLMCache(ttl=10, path=path)
+        restored = await second.get("k", "summary")
+        now[0] += 11
+        third = LLMCache(ttl=10, path=path)
+        expired = await third.get("k", "summary")
+        return restored, second.stats()["entries"], expired, third._disk.get("k")
+
+    restored, entries, expired, row = asyncio.run(scenario())
+    assert (restored, entries) == ("v", 1)
+    assert expired is None
+    assert row is None
+
+
+@pytest.mark.parametrize("reply, cached", [("", None), ("  \n", None), ("你好", "你好")])
+def test_client_caches_only_non_empty_replies(reply, cached):
+    from llm_client import LLMClient
+
+    async def fake_post(*args, **kwargs):
+        return reply
+
+    async def fake_stream(*args, **kwargs):
+        yield reply
+
+    async def scenario():
+        client = LLMClient(cache=LLMCache(cacheable_types={"summary"}))
+        client._post_with_retries = fake_post
+        client._stream_with_retries = fake_stream
+        messages = [{"role": "user", "content": "摘要"}]
+        await client.chat("http://llm/v1", {}, "m", messages, call_type="summary")
+        chat_cached = await client.cache.get(cache_key("m", messages), "summary")
+        streamed = [delta async for delta in client.stream_chat("http://llm/v1", {}, "m2", messages, call_type="summary")]
+        stream_cached = await client.cache.get(cache_key("m2", messages), "summary")
+        return streamed, chat_cached, stream_cached
+
+    streamed, chat_cached, stream_cached = asyncio.run(scenario())
+    assert streamed == [reply]
+    assert (chat_cached, stream_cached) == (cached, cached)
@@ -0,0 +1,74 @@
+import pytest
+
+import llm_resilience
+from llm_resilience import CircuitBreaker, backoff_delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(llm_resilience.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _opened(threshold=2, cooldown=10):
+    breaker = CircuitBreaker("test:1", threshold=threshold, cooldown=cooldown)
+    for _ in range(threshold):
+        breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("test:1", threshold=3, cooldown=10)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_breaker_lets_one_probe_through_after_cooldown(clock):
+    breaker = _opened()
+    clock[0] += 10
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.stats() == {"state": "closed", "consecutive_failures": 0}
+
+
+def test_failed_probe_reopens_breaker(clock):
+    breaker = _opened()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock[0] += 9
+    assert not breaker.allow()
+
+
+def test_released_probe_can_be_retried(clock):
+    breaker = _opened()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_backoff_delay_uses_capped_full_jitter(monkeypatch):
+    monkeypatch.setattr(llm_resilience, "RETRY_BASE_DELAY", 0.5)
+    monkeypatch.setattr(llm_resilience, "RETRY_MAX_DELAY", 5.0)
+    bounds = []
+    monkeypatch.setattr(llm_resilience.random, "uniform", lambda lo, hi: bounds.append((lo, hi)) or hi)
+    assert [backoff_delay(retry) for retry in (1, 2, 3, 4)] == [1.0, 2.0, 4.0, 5.0]
+    assert all(lo == 0.0 for lo, _ in bounds)
+
+
+def test_backoff_delay_stays_within_bounds():
+    assert all(0.0 <= backoff_delay(1) <= 2 * llm_resilience.RETRY_BASE_DELAY for _ in range(100))
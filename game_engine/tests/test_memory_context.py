@@ -0,0 +1,61 @@
+from memory_context import MemoryContext
+
+
+class _History:
+    def __init__(self, lines=()):
+        self.lines = list(lines)
+
+    def list_history(self):
+        return self.lines
+
+
+def _context(lines, **kwargs):
+    kwargs.setdefault("recent_window", 8)
+    kwargs.setdefault("token_budget", 10_000)
+    return MemoryContext(rag_manager=_History(lines), **kwargs)
+
+
+def test_recent_lines_grouped_into_window_chunks():
+    memory = _context([f"第{i}句" for i in range(7)])
+    messages = memory.as_messages()
+    assert [m["content"] for m in messages] == ["第0句\n第1句\n第2句\n第3句", "第4句\n第5句\n第6句"]
+    assert all(m["role"] == "user" for m in messages)
+
+
+def test_summary_is_a_single_message_before_chunks():
+    memory = _context(["旧1", "旧2", "新1"])
+    memory.summaries = [("第一轮", "摘要一"), ("第二轮", "摘要二")]
+    memory.summarized_upto = 2
+    messages = memory.as_messages()
+    assert messages[0]["content"] == "--- 之前阶段的摘要 ---\n【第一轮摘要】摘要一\n【第二轮摘要】摘要二"
+    assert [m["content"] for m in messages[1:]] == ["新1"]
+
+
+def test_full_chunks_stay_stable_when_lines_are_appended():
+    source = _History([f"第{i}句" for i in range(9)])
+    memory = MemoryContext(rag_manager=source, recent_window=8, token_budget=10_000)
+    before = memory.as_messages()
+    source.lines.append("第9句")
+    after = memory.as_messages()
+    # 写满的块逐字节不变，新发言只追加在最后一块
+    assert after[0] == before[0]
+    assert after[1]["content"] == before[1]["content"] + "\n第9句"
+
+
+def test_window_advance_keeps_remaining_chunks_intact():
+    source = _History([f"第{i}句" for i in range(8)])
+    memory = MemoryContext(rag_manager=source, recent_window=8, token_budget=10_000)
+    before = memory.as_messages()
+    source.lines.append("第8句")
+    after = memory.as_messages()
+    # 窗口起点前移一个步长：最早的一块移出，其余块原样保留
+    assert after[0] == before[1]
+    assert after[1]["content"] == "第8句"
+
+
+def test_budget_truncated_first_chunk_keeps_later_chunks_aligned():
+    lines = [f"第{i}句" for i in range(7)]
+    unlimited = _context(lines).as_messages()
+    # 预算只够最后 5 句：第一块被截短，后面的块与不截断时相同
+    truncated = _context(lines, token_budget=15).as_messages()
+    assert [m["content"] for m in truncated] == ["第2句\n第3句", unlimited[1]["content"]]
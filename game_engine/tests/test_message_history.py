@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import pytest
+
+from journal import JournalWriter
+from message_history import MAX_FETCH_LIMIT, MESSAGES_FILE, MessageHistory
+
+
+class _ManualWriter:
+    """写入线程的替身：提交的写入先攒着，调用 run() 时才按序执行。"""
+
+    def __init__(self, immediate=True):
+        self.immediate = immediate
+        self.jobs = []
+
+    def submit(self, write):
+        self.jobs.append(write)
+        if self.immediate:
+            self.run()
+
+    def run(self):
+        while self.jobs:
+            self.jobs.pop(0)()
+
+
+def _history(tmp_path, count, max_recent=3, writer=None):
+    history = MessageHistory(str(tmp_path), max_recent=max_recent, writer=writer or _ManualWriter())
+    for i in range(count):
+        history.append({"content": f"第{i + 1}条"})
+    return history
+
+
+def _page(history, cursor, limit):
+    page, has_more = asyncio.run(history.before(cursor, limit))
+    return [message["seq"] for message in page], has_more
+
+
+def test_append_assigns_seq_and_keeps_bounded_ring(tmp_path):
+    history = _history(tmp_path, 5)
+    assert len(history) == 5
+    assert [m["seq"] for m in history.recent(10)] == [3, 4, 5]
+
+
+def test_unwritten_messages_stay_in_memory(tmp_path):
+    writer = _ManualWriter(immediate=False)
+    history = _history(tmp_path, 5, writer=writer)
+    # 写入线程还没执行：文件里还没有这些消息，内存缓冲不能丢掉它们
+    assert not (tmp_path / MESSAGES_FILE).exists()
+    assert _page(history, None, 5) == ([1, 2, 3, 4, 5], False)
+    writer.run()
+    history.append({"content": "第6条"})
+    writer.run()
+    assert [m["seq"] for m in history.recent(10)] == [4, 5, 6]
+    assert _page(history, None, 6) == ([1, 2, 3, 4, 5, 6], False)
+
+
+@pytest.mark.parametrize("cursor, limit, seqs, more", [
+    (None, 2, [9, 10], True),
+    # 跨越磁盘与内存缓冲的边界
+    (9, 4, [5, 6, 7, 8], True),
+    # 只在磁盘上的一页，到最早一条为止
+    (4, 10, [1, 2, 3], False),
+    (1, 5, [], False),
+    # 超出范围的游标按最新处理
+    (99, 1, [10], True),
+])
+def test_before_pages_backwards_across_disk_and_ring(tmp_path, cursor, limit, seqs, more):
+    assert _page(_history(tmp_path, 10), cursor, limit) == (seqs, more)
+
+
+def test_before_walks_whole_history_without_gaps(tmp_path):
+    history = _history(tmp_path, 10)
+    seen, cursor, more = [], None, True
+    while more:
+        seqs, more = _page(history, cursor, 3)
+        seen = seqs + seen
+        cursor = seqs[0]
+    assert seen == list(range(1, 11))
+    assert [m["content"] for m in history.recent(2)] == ["第9条", "第10条"]
+
+
+def test_before_caps_limit(tmp_path):
+    seqs, has_more = _page(_history(tmp_path, MAX_FETCH_LIMIT + 5), None, MAX_FETCH_LIMIT + 5)
+    assert len(seqs) == MAX_FETCH_LIMIT
+    assert has_more
+
+
+def test_load_restores_pages_and_truncates_partial_line(tmp_path):
+    writer = JournalWriter()
+    _history(tmp_path, 6, writer=writer).close()
+    writer.join()
+    path = tmp_path / MESSAGES_FILE
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"content": "残缺"}, ensure_ascii=False)[:-3])
+
+    history = MessageHistory(str(tmp_path), max_recent=2, writer=writer)
+    history.load()
+    assert len(history) == 6
+    assert _page(history, 5, 3) == ([2, 3, 4], True)
+    assert history.append({"content": "新"})["seq"] == 7
+    writer.join()
+    assert _page(history, None, 2) == ([6, 7], True)
+    assert _page(history, 3, 5) == ([1, 2], False)
+    assert json.loads(path.read_text(encoding="utf-8").splitlines()[-1])["content"] == "新"
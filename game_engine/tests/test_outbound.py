@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+import outbound
+from outbound import Outbox
+from state_log import append_op, set_op
+
+
+class _Sio:
+    def __init__(self):
+        self.sent = []
+
+    async def emit(self, event, data, room=None):
+        self.sent.append((event, data))
+
+
+@pytest.fixture(autouse=True)
+def fast_tick(monkeypatch):
+    monkeypatch.setattr(outbound, "OUTBOUND_TICK", 0)
+
+
+def _deliver(puts, **kwargs):
+    async def scenario():
+        sio = _Sio()
+        box = Outbox(sio, "sid", **kwargs)
+        for event, data in puts:
+            box.put(event, data, 10)
+        await box._flusher
+        return sio.sent, box
+
+    return asyncio.run(scenario())
+
+
+def test_consecutive_state_updates_coalesce():
+    sent, _ = _deliver([
+        ("game_state_update", {"stage": "a", "round": 1}),
+        ("game_state_update", {"stage": "b"}),
+        ("state_patch", {"ops": [set_op("stage", "c")]}),
+        ("state_patch", {"ops": [append_op("public_clues", "x")]}),
+    ])
+    assert sent == [
+        ("game_state_update", {"stage": "b", "round": 1}),
+        ("state_patch", {"ops": [set_op("stage", "c"), append_op("public_clues", "x")]}),
+    ]
+
+
+def test_versioned_and_unversioned_frames_are_not_merged():
+    sent, _ = _deliver([
+        ("game_state_update", {"stage": "a", "version": 1}),
+        ("game_state_update", {"stage": "b"}),
+    ])
+    assert len(sent) == 2
+
+
+def test_message_deltas_merge_per_stream_without_mutating_input():
+    first = {"stream_id": "s1", "delta": "你"}
+    sent, _ = _deliver([
+        ("message_delta", first),
+        ("message_delta", {"stream_id": "s1", "delta": "好"}),
+        ("message_delta", {"stream_id": "s2", "delta": "！"}),
+    ])
+    assert sent == [
+        ("message_delta", {"stream_id": "s1", "delta": "你好"}),
+        ("message_delta", {"stream_id": "s2", "delta": "！"}),
+    ]
+    assert first == {"stream_id": "s1", "delta": "你"}
+
+
+def test_typing_state_superseded_and_duplicates_dropped():
+    sent, _ = _deliver([
+        ("player_typing", {"player_id": "p1"}),
+        ("new_message", {"content": "hi"}),
+        ("player_done_typing", {"player_id": "p1"}),
+        ("player_done_typing", {"player_id": "p1"}),
+    ])
+    assert sent == [("new_message", {"content": "hi"}), ("player_done_typing", {"player_id": "p1"})]
+
+
+def test_overflow_closes_slow_client(monkeypatch):
+    monkeypatch.setattr(outbound, "OUTBOUND_MAX_FRAMES", 2)
+    dropped = []
+
+    async def scenario():
+        box = Outbox(_Sio(), "sid", on_overflow=dropped.append)
+        for i in range(3):
+            box.put("new_message", {"n": i}, 10)
+        return box
+
+    box = asyncio.run(scenario())
+    assert box.closed and len(box) == 0
+    assert dropped == ["sid"]
+
+
+def test_packed_connection_sends_one_frame_per_tick():
+    msgpack = pytest.importorskip("msgpack")
+    from wire_format import PACKED_EVENT, WireFormat
+
+    sent, _ = _deliver([("new_message", {"content": "a"}), ("state_patch", {"ops": []})], wire=WireFormat())
+    assert len(sent) == 1 and sent[0][0] == PACKED_EVENT
+    assert msgpack.unpackb(sent[0][1][1:], raw=False) == [["new_message", {"content": "a"}],
+                                                          ["state_patch", {"ops": []}]]
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+import game_session
+from game_session import SESSION_IDLE_TTL, SessionManager
+
+
+@pytest.fixture(autouse=True)
+def rag_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(game_session, "RAG_ROOT", str(tmp_path))
+
+
+def _run(scenario):
+    """在事件循环中执行 scenario(manager)，结束时取消所有剩余对局的后台任务。"""
+    restored = []
+
+    async def main():
+        manager = SessionManager(sio=None, on_restore=restored.append)
+        try:
+            return await scenario(manager)
+        finally:
+            for session in manager.sessions.values():
+                session.scheduler.cancel()
+
+    return asyncio.run(main()), restored
+
+
+def test_finished_game_is_evicted_after_last_connection_leaves():
+    async def scenario(manager):
+        session = manager.get_or_create("room")
+        manager.bind_sid("sid1", session, "human_player_1")
+        session.finished = True
+        kept = manager.reap()
+        manager.unbind_sid("sid1")
+        return kept, manager.reap(), manager.sessions, session
+
+    (kept, evicted, remaining, session), _ = _run(scenario)
+    assert kept == []
+    assert evicted == ["room"]
+    assert remaining == {}
+    assert session.outboxes == {}
+
+
+def test_idle_game_is_evicted_after_ttl_and_restored_on_reconnect():
+    async def scenario(manager):
+        session = manager.get_or_create("room")
+        session.game_state.update(stage="discussion_1", turn_order=["human_player_1"],
+                                  pending_action="statement_human_player_1")
+        session.checkpoint()
+        idle_since = session.idle_since
+        early = manager.reap(now=idle_since + SESSION_IDLE_TTL - 1)
+        evicted = manager.reap(now=idle_since + SESSION_IDLE_TTL)
+        await asyncio.to_thread(session.journal.writer.join)
+        again = manager.get_or_create("room")
+        return early, evicted, session, again
+
+    (early, evicted, session, again), restored = _run(scenario)
+    assert early == []
+    assert evicted == ["room"]
+    # 同一房间再次进入时从日志恢复原来的对局，并交给服务端继续推进
+    assert again is not session
+    assert restored == [again]
+    assert again.session_dir == session.session_dir
+    assert again.game_state["stage"] == "discussion_1"
+    assert again.game_state["pending_action"] == "statement_human_player_1"
+
+
+def test_idle_lobby_is_dropped_without_restore():
+    async def scenario(manager):
+        session = manager.get_or_create("lobby")
+        evicted = manager.reap(now=session.idle_since + SESSION_IDLE_TTL)
+        return evicted, manager.get_or_create("lobby")
+
+    (evicted, fresh), restored = _run(scenario)
+    assert evicted == ["lobby"]
+    assert restored == []
+    assert fresh.game_state["stage"] == "waiting_for_players"
+
+
+def test_connected_or_busy_sessions_are_kept():
+    async def scenario(manager):
+        connected = manager.get_or_create("connected")
+        manager.bind_sid("sid1", connected, "human_player_1")
+        busy = manager.get_or_create("busy")
+        busy.finished = True
+        busy.scheduler.running = "advance"
+        return manager.reap(now=10 ** 9)
+
+    evicted, _ = _run(scenario)
+    assert evicted == []
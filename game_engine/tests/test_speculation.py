@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from speculation import Speculator
+
+
+def _speculator(max_stale=0):
+    return Speculator(asyncio.ensure_future, max_stale=max_stale, enabled=True)
+
+
+async def _text(value):
+    return value
+
+
+def test_draft_used_when_nothing_new_was_said():
+    async def scenario():
+        spec = _speculator()
+        spec.prefetch("discussion_1", "p2", 3, lambda: _text("草稿"))
+        return await spec.take("discussion_1", "p2", 3), spec.outcomes
+
+    text, outcomes = asyncio.run(scenario())
+    assert text == "草稿"
+    assert outcomes["hit"] == 1
+
+
+def test_draft_discarded_after_any_new_message_by_default():
+    async def scenario():
+        spec = _speculator()
+        spec.prefetch("discussion_1", "p2", 3, lambda: _text("草稿"))
+        return await spec.take("discussion_1", "p2", 4), spec.outcomes
+
+    text, outcomes = asyncio.run(scenario())
+    assert text is None
+    assert outcomes["stale"] == 1
+
+
+def test_human_message_always_invalidates_draft():
+    async def scenario():
+        spec = _speculator(max_stale=5)
+        spec.prefetch("discussion_1", "p2", 3, lambda: _text("草稿"), human_count=1)
+        ai_only = await spec.take("discussion_1", "p2", 4, human_count=1)
+        spec.prefetch("discussion_1", "p3", 4, lambda: _text("草稿"), human_count=1)
+        after_human = await spec.take("discussion_1", "p3", 5, human_count=2)
+        return ai_only, after_human
+
+    ai_only, after_human = asyncio.run(scenario())
+    assert ai_only == "草稿"
+    assert after_human is None
+
+
+def test_failed_draft_returns_none():
+    async def failing():
+        raise RuntimeError("boom")
+
+    async def scenario():
+        spec = _speculator()
+        spec.prefetch("alibi", "p2", 0, failing)
+        return await spec.take("alibi", "p2", 0), spec.outcomes
+
+    text, outcomes = asyncio.run(scenario())
+    assert text is None
+    assert outcomes["failed"] == 1
+
+
+# ----------------- 走完整的推进流程 -----------------
+def test_advance_game_uses_drafts_for_next_ai_speakers(tmp_path, monkeypatch):
+    server = pytest.importorskip("server")
+    monkeypatch.setattr(server, "schedule_advance", lambda session: None)
+    monkeypatch.setattr(server, "STREAMING_ENABLED", False)
+    calls = []
+
+    def fake_speech(player_id):
+        async def act_and_respond(signal, external_input):
+            calls.append(player_id)
+            return f"{player_id} 的推理"
+        return act_and_respond
+
+    async def scenario():
+        session = server.GameSession("spec", sio=None, session_dir=str(tmp_path))
+        session.speculator.enabled = True
+        for player_id, agent in session.ai_agents.items():
+            agent.act_and_respond = fake_speech(player_id)
+        session.game_state.update(stage="discussion_1", current_speaker_index=0,
+                                  turn_order=["ai_player_1", "ai_player_2", "human_player_1", "ai_player_3"])
+        try:
+            for _ in range(4):
+                await server.advance_game(session)
+                if session.game_state["pending_action"] == "statement_human_player_1":
+                    await server.apply_player_action(session, "human_player_1", {
+                        "type": "submit_statement", "payload": {"statement": "我有话说"}})
+        finally:
+            session.scheduler.cancel()
+        return session
+
+    session = asyncio.run(scenario())
+    outcomes = session.speculator.outcomes
+    # 当前发言人自己的发言（包括真人玩家的陈述）不会让下一位的草稿过期
+    assert (outcomes["hit"], outcomes["stale"]) == (2, 0)
+    assert session.speculator.stats()["hit_rate"] == 1.0
+    assert sorted(calls) == ["ai_player_1", "ai_player_2", "ai_player_3"]
+    assert session.game_state["statements"]["ai_player_3"] == "ai_player_3 的推理"
@@ -0,0 +1,37 @@
+from state_log import StateLog
+
+
+def _log(events, max_entries=10):
+    log = StateLog(max_entries=max_entries)
+    for i in range(events):
+        log.append("state_patch", {"n": i})
+    return log
+
+
+def test_append_assigns_increasing_versions():
+    log = StateLog()
+    first = log.append("game_state_update", {"stage": "a"})
+    second = log.append("game_state_update", {"stage": "b"})
+    assert (first["version"], second["version"], log.version) == (1, 2, 2)
+
+
+def test_since_returns_events_after_version():
+    log = _log(5)
+    assert [entry["version"] for entry in log.since(2)] == [3, 4, 5]
+    assert log.since(0)[0] == {"version": 1, "event": "state_patch", "data": {"n": 0, "version": 1}}
+
+
+def test_since_current_version_is_empty():
+    assert _log(3).since(3) == []
+    assert StateLog().since(0) == []
+
+
+def test_since_unknown_future_version_needs_snapshot():
+    assert _log(3).since(4) is None
+
+
+def test_since_beyond_retained_entries_needs_snapshot():
+    log = _log(8, max_entries=5)
+    # 保留的是 4..8：从 3 之后补齐刚好可以，更早的需要完整快照
+    assert [entry["version"] for entry in log.since(3)] == [4, 5, 6, 7, 8]
+    assert log.since(2) is None
@@ -0,0 +1,172 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from llm_client import LLMClient, LLMError, rejects_response_format
+from structured_output import (StructuredOutputError, extract_json, generate_structured, parse_structured,
+                               repair_messages, validate)
+
+VOTE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "trust": {"type": "string", "enum": ["甲", "乙"]},
+        "suspect": {"type": "string", "enum": ["甲", "乙"]},
+        "statement": {"type": "string", "minLength": 1},
+    },
+    "required": ["trust", "suspect", "statement"],
+}
+
+
+# ----------------- extract_json -----------------
+def test_extract_json_from_fence_and_prose():
+    text = '好的，我的决定如下：\n```json\n{"a": 1}\n```\n以上。'
+    assert extract_json(text) == {"a": 1}
+
+
+def test_extract_json_skips_braces_that_are_not_json():
+    assert extract_json('先说明 {不是 JSON} 然后 {"a": {"b": 2}} 多余内容 }') == {"a": {"b": 2}}
+
+
+def test_extract_json_returns_none_without_object():
+    assert extract_json("") is None
+    assert extract_json(None) is None
+    assert extract_json("[1, 2, 3]") is None
+
+
+# ----------------- validate -----------------
+def test_validate_accepts_valid_object():
+    assert validate({"trust": "甲", "suspect": "乙", "statement": "理由"}, VOTE_SCHEMA) == []
+
+
+def test_validate_reports_missing_enum_and_empty():
+    errors = validate({"trust": "丙", "statement": ""}, VOTE_SCHEMA)
+    assert any("suspect" in e for e in errors)
+    assert any("trust" in e for e in errors)
+    assert any("statement" in e for e in errors)
+
+
+def test_validate_array_constraints_and_bool_is_not_integer():
+    schema = {"type": "array", "items": {"type": "integer"}, "minItems": 2, "maxItems": 3, "uniqueItems": True}
+    assert validate([1, 2], schema) == []
+    assert validate([1], schema)
+    assert validate([1, 1], schema)
+    assert validate([1, 2, 3, 4], schema)
+    assert validate([1, True], schema)
+
+
+def test_parse_structured_reasons_and_strips_strings():
+    assert parse_structured('{"trust": " 甲 ", "suspect": "乙", "statement": "x"}', VOTE_SCHEMA)["trust"] == "甲"
+    for text, reason in (("没有 JSON", "no_json"), ('{"trust": "甲"}', "schema")):
+        with pytest.raises(StructuredOutputError) as info:
+            parse_structured(text, VOTE_SCHEMA)
+        assert info.value.reason == reason
+    with pytest.raises(StructuredOutputError) as info:
+        parse_structured('{"trust": "甲", "suspect": "甲", "statement": "x"}', VOTE_SCHEMA,
+                         check=lambda d: "不能相同" if d["trust"] == d["suspect"] else None)
+    assert info.value.reason == "check"
+
+
+# ----------------- 修复调用 -----------------
+def test_repair_messages_carry_raw_reply_and_problem():
+    messages = repair_messages("原始回复", VOTE_SCHEMA, "缺少字段 $.suspect")
+    assert "原始回复" in messages[-1]["content"]
+    assert "缺少字段 $.suspect" in messages[-1]["content"]
+
+
+def test_generate_structured_repairs_once():
+    replies = iter(['{"trust": "甲"}', '{"trust": "甲", "suspect": "乙", "statement": "修好了"}'])
+    calls = []
+
+    async def chat(messages, **extra):
+        calls.append(messages)
+        return next(replies)
+
+    value = asyncio.run(generate_structured(chat, [{"role": "user", "content": "投票"}], VOTE_SCHEMA, "vote"))
+    assert value["statement"] == "修好了"
+    assert len(calls) == 2
+    assert "缺少字段" in calls[1][-1]["content"]
+
+
+def test_generate_structured_gives_up_after_failed_repair():
+    async def chat(messages, **extra):
+        return "还是没有 JSON"
+
+    assert asyncio.run(generate_structured(chat, [], VOTE_SCHEMA, "vote")) is None
+
+
+def test_generate_structured_returns_none_on_call_failure():
+    async def chat(messages, **extra):
+        raise LLMError("HTTP 401: bad key", reason="http_4xx", status=401, body="bad key")
+
+    assert asyncio.run(generate_structured(chat, [], VOTE_SCHEMA, "vote")) is None
+
+
+# ----------------- response_format 被拒绝 -----------------
+def test_only_explicit_response_format_errors_count_as_rejection():
+    def error(status, body):
+        return LLMError("x", reason="http_4xx", status=status, body=body)
+
+    assert rejects_response_format(error(400, '{"error": "response_format is not supported"}'))
+    assert rejects_response_format(error(422, "unknown field json_schema"))
+    assert not rejects_response_format(error(401, "invalid api key"))
+    assert not rejects_response_format(error(429, "rate limited"))
+    assert not rejects_response_format(error(400, "maximum context length exceeded"))
+
+
+def _fake_provider(rejecting_model):
+    seen = []
+
+    async def handle(request):
+        body = await request.json()
+        seen.append((body["model"], "response_format" in body))
+        if body["model"] == rejecting_model and "response_format" in body:
+            return web.json_response({"error": {"message": "response_format is not supported"}}, status=400)
+        return web.json_response({"choices": [{"message": {"content": '{"ok": true}'}}]})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handle)
+    return app, seen
+
+
+def test_rejection_is_remembered_per_endpoint_and_model():
+    async def scenario():
+        app, seen = _fake_provider("plain-model")
+        async with TestServer(app) as server:
+            url = str(server.make_url("/v1/chat/completions"))
+            client = LLMClient()
+            rf = {"response_format": {"type": "json_object"}}
+            try:
+                with pytest.raises(LLMError) as info:
+                    await client.chat(url, {}, "plain-model", [], call_type="vote", **rf)
+                assert info.value.reason == "response_format_rejected"
+                assert await client.chat(url, {}, "plain-model", [], call_type="vote", **rf) == '{"ok": true}'
+                assert await client.chat(url, {}, "json-model", [], call_type="vote", **rf) == '{"ok": true}'
+            finally:
+                await client.close()
+        return seen
+
+    seen = asyncio.run(scenario())
+    assert seen == [("plain-model", True), ("plain-model", False), ("json-model", True)]
+
+
+def test_other_client_errors_do_not_disable_response_format():
+    async def scenario():
+        async def handle(request):
+            return web.json_response({"error": {"message": "invalid api key"}}, status=401)
+
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", handle)
+        async with TestServer(app) as server:
+            client = LLMClient()
+            try:
+                with pytest.raises(LLMError) as info:
+                    await client.chat(str(server.make_url("/v1/chat/completions")), {}, "m", [],
+                                      call_type="vote", response_format={"type": "json_object"})
+                assert info.value.reason == "http_4xx"
+            finally:
+                await client.close()
+            return client.format_rejected
+
+    assert asyncio.run(scenario()) == set()
@@ -0,0 +1,31 @@
+from turn_order import compute_turn_order, new_seed, rotation_order, shuffle_order, suspicion_order
+
+PLAYERS = ["p1", "p2", "p3", "p4", "p5"]
+
+
+def test_orders_are_permutations():
+    for policy in ("suspicion", "shuffle", "rotation"):
+        order = compute_turn_order(policy, PLAYERS, "seed", "discussion_1", [])
+        assert sorted(order) == sorted(PLAYERS)
+
+
+def test_same_seed_is_deterministic_for_resume():
+    assert shuffle_order(PLAYERS, "abc", "alibi") == shuffle_order(PLAYERS, "abc", "alibi")
+
+
+def test_games_in_the_same_room_get_different_orders():
+    orders = {tuple(shuffle_order(PLAYERS, new_seed(), "alibi")) for _ in range(20)}
+    assert len(orders) > 1
+
+
+def test_rotation_shifts_by_speaking_stage():
+    assert rotation_order(PLAYERS, "alibi") == PLAYERS
+    assert rotation_order(PLAYERS, "discussion_1") == ["p2", "p3", "p4", "p5", "p1"]
+
+
+def test_suspected_players_tend_to_speak_first():
+    votes = [{"p1": {"trust": "p3", "suspect": "p5"}, "p2": {"trust": "p3", "suspect": "p5"},
+              "p3": {"trust": "p1", "suspect": "p5"}, "p4": {"trust": "p3", "suspect": "p5"}}]
+    firsts = [suspicion_order(PLAYERS, f"seed{i}", "discussion_2", votes)[0] for i in range(300)]
+    assert firsts.count("p5") > firsts.count("p3")
+    assert firsts.count("p5") > 300 / len(PLAYERS)
@@ -0,0 +1,68 @@
+import zlib
+
+import pytest
+
+import wire_format
+from wire_format import FLAG_DEFLATE, FLAG_PLAIN, WireFormat, json_size, json_str_size, negotiate
+
+
+@pytest.mark.parametrize("text", ["", "abc", "你好，我是船长", 'say "hi"\n\\ ok'])
+def test_json_str_size_matches_serialized_length(text):
+    header = {"stream_id": "s1", "from_name": "船长"}
+    assert json_size({**header, "delta": text}) - json_size({**header, "delta": ""}) == json_str_size(text) - 2
+
+
+msgpack = pytest.importorskip("msgpack")
+
+
+def _decode(frame: bytes):
+    body = frame[1:]
+    if frame[0] == FLAG_DEFLATE:
+        body = zlib.decompressobj(wbits=-15).decompress(body)
+    return msgpack.unpackb(body, raw=False)
+
+
+def _frames(count):
+    return [("new_message", {"seq": i, "sender": "ai_player_1", "content": "线索" * 20, "bin": b"\x00\x01"}, 0)
+            for i in range(count)]
+
+
+def test_plain_round_trip():
+    frames = _frames(3)
+    frame = WireFormat().encode_batch(frames)
+    assert frame[0] == FLAG_PLAIN
+    assert _decode(frame) == [[event, data] for event, data, _ in frames]
+
+
+def test_deflate_round_trip_for_large_batches():
+    frames = _frames(10)
+    frame = WireFormat(deflate=True).encode_batch(frames)
+    assert frame[0] == FLAG_DEFLATE
+    assert _decode(frame) == [[event, data] for event, data, _ in frames]
+
+
+def test_small_batches_are_not_compressed(monkeypatch):
+    monkeypatch.setattr(wire_format, "COMPRESS_MIN_BYTES", 10_000)
+    frame = WireFormat(deflate=True).encode_batch(_frames(2))
+    assert frame[0] == FLAG_PLAIN
+    assert len(_decode(frame)) == 2
+
+
+def test_empty_batch_round_trip():
+    assert _decode(WireFormat().encode_batch([])) == []
+
+
+@pytest.mark.parametrize("auth, expected", [
+    ({"wire": {"formats": ["msgpack"], "compression": ["deflate"]}}, WireFormat(deflate=True)),
+    ({"wire": {"formats": ["msgpack"]}}, WireFormat(deflate=False)),
+    ({"wire": {"formats": ["cbor"]}}, None),
+    ({}, None),
+    (None, None),
+])
+def test_negotiate(auth, expected):
+    assert negotiate(auth) == expected
+
+
+def test_negotiate_respects_server_switch(monkeypatch):
+    monkeypatch.setattr(wire_format, "PACKED_ENABLED", False)
+    assert negotiate({"wire": {"formats": ["msgpack"]}}) is None
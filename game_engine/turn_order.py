@@ -0,0 +1,68 @@
+import os
+import random
+import secrets
+from collections import Counter
+from typing import Dict, List
+
+# ----------------- 发言顺序配置 -----------------
+# 发言顺序的决定方式，都在本地即时算出：
+#   suspicion：按历次投票中被怀疑的程度加权随机，被怀疑越多越可能先发言自辩（没有投票记录时等同于 shuffle）
+#   shuffle：由本局的随机种子与阶段确定的随机顺序（种子随游戏状态写入日志，恢复后顺序不变）
+#   rotation：座位顺序，每进入一个发言阶段轮换一位
+#   dm：旧方式，阻塞等待 DM 的 LLM 调用给出顺序与宣布词
+TURN_ORDER_POLICY = os.environ.get("JUBENSHA_TURN_ORDER", "suspicion")
+# DM 风格的顺序宣布词在首位发言人开始后于后台生成，超过该时长（秒）仍未生成就放弃；设为 0 则不生成
+ANNOUNCE_BUDGET = float(os.environ.get("JUBENSHA_TURN_ORDER_ANNOUNCE_BUDGET", "8"))
+
+# 被信任一次相当于抵消半次怀疑；权重的下限避免某人几乎不可能排在前面
+TRUST_DISCOUNT = 0.5
+MIN_WEIGHT = 0.25
+
+# 发言阶段在整局中的序号，rotation 据此轮换
+SPEAKING_STAGES = ("alibi", "discussion_1", "discussion_2")
+
+
+def new_seed() -> str:
+    """每局游戏开始时生成的随机种子，保存在 game_state["turn_order_seed"] 中。"""
+    return secrets.token_hex(8)
+
+
+def _rng(seed: str, stage: str) -> random.Random:
+    return random.Random(f"{seed}:{stage}")
+
+
+def shuffle_order(player_ids: List[str], seed: str, stage: str) -> List[str]:
+    order = list(player_ids)
+    _rng(seed, stage).shuffle(order)
+    return order
+
+
+def rotation_order(player_ids: List[str], stage: str) -> List[str]:
+    offset = SPEAKING_STAGES.index(stage) if stage in SPEAKING_STAGES else 0
+    offset %= max(1, len(player_ids))
+    return list(player_ids[offset:]) + list(player_ids[:offset])
+
+
+def suspicion_order(player_ids: List[str], seed: str, stage: str,
+                    vote_history: List[Dict[str, dict]]) -> List[str]:
+    """
+    加权随机排序（Efraimidis–Spirakis：每人的排序键为 u^(1/w)），权重为 1 + 被怀疑次数 - 0.5 × 被信任次数。
+    """
+    suspected = Counter(vote.get("suspect") for votes in vote_history for vote in votes.values())
+    trusted = Counter(vote.get("trust") for votes in vote_history for vote in votes.values())
+    rng = _rng(seed, stage)
+    keys = {}
+    for pid in player_ids:
+        weight = max(MIN_WEIGHT, 1.0 + suspected[pid] - TRUST_DISCOUNT * trusted[pid])
+        keys[pid] = rng.random() ** (1.0 / weight)
+    return sorted(player_ids, key=lambda pid: keys[pid], reverse=True)
+
+
+def compute_turn_order(policy: str, player_ids: List[str], seed: str, stage: str,
+                       vote_history: List[Dict[str, dict]]) -> List[str]:
+    """按策略算出本阶段的发言顺序；同一种子、同一阶段、同样的投票记录总是得到同样的结果。"""
+    if policy == "rotation":
+        return rotation_order(player_ids, stage)
+    if policy == "shuffle":
+        return shuffle_order(player_ids, seed, stage)
+    return suspicion_order(player_ids, seed, stage, vote_history)
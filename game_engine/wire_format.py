@@ -0,0 +1,83 @@
+import json
+import os
+import zlib
+from dataclasses import dataclass
+from typing import Any, List, Optional, Tuple
+
+from metrics import WIRE_BYTES, WIRE_BYTES_SAVED
+
+try:
+    import msgpack
+except ImportError:  # 未安装 msgpack 时只支持 JSON
+    msgpack = None
+
+# ----------------- 线路格式配置 -----------------
+# 设为 0 时忽略客户端的协商请求，所有连接都使用 JSON
+PACKED_ENABLED = os.environ.get("JUBENSHA_WIRE_PACKED", "1") != "0"
+# 打包后超过该字节数的帧再做 deflate 压缩；更小的帧压缩收益抵不过开销
+COMPRESS_MIN_BYTES = int(os.environ.get("JUBENSHA_WIRE_COMPRESS_MIN", "256"))
+
+PACKED_EVENT = "packed"
+# 打包帧的第一个字节：后面的内容是否经过 deflate（raw，无 zlib 头）
+FLAG_PLAIN = 0
+FLAG_DEFLATE = 1
+# socket.io 发送二进制负载时额外的文本头（'451-["packed",{"_placeholder":true,"num":0}]'）
+BINARY_PACKET_OVERHEAD = 45
+# JSON 事件的文本包除负载外还包含 '42["<event>",' 与结尾的 ']'
+JSON_PACKET_OVERHEAD = 6
+
+
+def json_size(data: Any) -> int:
+    """负载按 socket.io 默认方式（紧凑分隔符、非 ASCII 字符转义为 \\uXXXX）编码为 JSON 后的字节数。"""
+    return len(json.dumps(data, separators=(",", ":")))
+
+
+def json_str_size(text: str) -> int:
+    """字符串编码为 JSON 后的字节数（含两侧引号），不做序列化：ASCII 字符 1 字节，其余字符转义后 6 字节。"""
+    ascii_count = len(text.encode("ascii", "ignore"))
+    escaped = text.count("\n") + text.count('"') + text.count("\\")
+    return 2 + ascii_count + escaped + 6 * (len(text) - ascii_count)
+
+
+@dataclass
+class WireFormat:
+    """一个连接协商出的线路格式：一个 tick 内的事件打包成一帧 msgpack，可选 deflate 压缩。"""
+    deflate: bool = False
+
+    def encode_batch(self, frames: List[Tuple[str, Any, int]]) -> bytes:
+        """
+        把若干 (event, data, JSON 字节数) 打包成一帧二进制负载：msgpack 编码的 [[event, data], ...]。
+        合并成一帧可以摊薄 socket.io 二进制包的头部开销，也让 deflate 能利用事件之间重复的字段名。
+        同时按事件类型记录发出的字节数与相对 JSON 节省的字节数（整帧大小按各事件编码后的长度分摊）。
+        """
+        packer = msgpack.Packer(use_bin_type=True)
+        items = [packer.pack([event, data]) for event, data, _ in frames]
+        body = packer.pack_array_header(len(items)) + b"".join(items)
+        flag = FLAG_PLAIN
+        if self.deflate and len(body) >= COMPRESS_MIN_BYTES:
+            compressor = zlib.compressobj(level=6, wbits=-15)
+            compressed = compressor.compress(body) + compressor.flush()
+            if len(compressed) < len(body):
+                body, flag = compressed, FLAG_DEFLATE
+        frame = bytes([flag]) + body
+
+        sent_total = len(frame) + BINARY_PACKET_OVERHEAD
+        raw_total = sum(len(item) for item in items) or 1
+        for (event, _, json_size), item in zip(frames, items):
+            sent = sent_total * len(item) / raw_total
+            WIRE_BYTES.inc(sent, event=event, format="packed")
+            WIRE_BYTES_SAVED.inc(json_size + len(event) + JSON_PACKET_OVERHEAD - sent, event=event)
+        return frame
+
+
+def negotiate(auth) -> Optional[WireFormat]:
+    """
+    根据客户端在 auth.wire 中声明的能力选择线路格式，例如 {"formats": ["msgpack"], "compression": ["deflate"]}。
+    客户端未声明、服务端关闭或缺少 msgpack 时返回 None（使用 JSON）。
+    """
+    wire = auth.get("wire") if isinstance(auth, dict) else None
+    if not PACKED_ENABLED or msgpack is None or not isinstance(wire, dict):
+        return None
+    if "msgpack" not in (wire.get("formats") or []):
+        return None
+    return WireFormat(deflate="deflate" in (wire.get("compression") or []))
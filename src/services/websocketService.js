@@ -1,23 +1,60 @@
 import { io } from 'socket.io-client'
+import { decode } from '@msgpack/msgpack'
 import { useGameStore } from '../store/gameStore.js'
 
+// 房间号取自页面地址的 ?room=xxx，同一房间的玩家同桌游戏；未指定时进入默认房间
+const getRoomId = () => new URLSearchParams(window.location.search).get('room') || 'default'
+
+// 页面地址带 ?wire=msgpack 时请求二进制打包格式（网络较差时可显著减少流量），否则使用 JSON
+const wantsPackedWire = () => new URLSearchParams(window.location.search).get('wire') === 'msgpack'
+const supportsDeflate = typeof DecompressionStream !== 'undefined'
+
+// 打包帧：第 1 个字节为标志位（1 表示后面的内容经过 raw deflate 压缩），其余为 msgpack 编码的 [[event, data], ...]
+const FLAG_DEFLATE = 1
+
+const inflateRaw = async (bytes) => {
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate-raw'))
+  return new Uint8Array(await new Response(stream).arrayBuffer())
+}
+
+const unpackFrame = async (frame) => {
+  const bytes = new Uint8Array(frame)
+  const body = bytes.subarray(1)
+  return decode(bytes[0] === FLAG_DEFLATE ? await inflateRaw(body) : body)
+}
+
 class WebsocketService {
   socket = null
   store = null
+  // 连接建立后、收到 sync / initial_state 之前到达的带版本事件先缓存，补齐后再按序应用
+  syncing = false
+  pendingEvents = []
+  // 解压是异步的：用一条 Promise 链保证打包帧按到达顺序分发
+  unpacking = Promise.resolve()
+
+  connect(playerId, roomId = getRoomId()) {
+    this.store = useGameStore()
 
-  connect(playerId) {
     // DEV: 'http://localhost:8765'
     // PROD: window.location.host
     this.socket = io('http://localhost:8765', {
-      query: { playerId },
+      query: { playerId, room: roomId },
+      // 每次（重）连接时带上最后见过的状态版本号，服务端只补发错过的事件
+      // 同时声明客户端支持的打包与压缩格式，由服务端决定是否启用
+      auth: (cb) => cb({
+        lastVersion: this.store.state_version,
+        ...(wantsPackedWire() && {
+          wire: { formats: ['msgpack'], compression: supportsDeflate ? ['deflate'] : [] }
+        }),
+      }),
       transports: ['websocket'],
       upgrade: false,
     })
 
-    this.store = useGameStore()
-
     this.socket.on('connect', () => {
       console.log('WebSocket connected successfully.')
+      this.syncing = true
+      this.pendingEvents = []
       this.store.setConnectionStatus(true)
     })
 
@@ -30,22 +67,52 @@ class WebsocketService {
       console.error('WebSocket connection error:', err)
     })
 
+    // 打包格式下服务端把一段时间内的事件装进一个 packed 帧：解包后按顺序交给同名事件的监听器处理
+    this.socket.on('packed', (frame) => {
+      this.unpacking = this.unpacking
+        .then(() => unpackFrame(frame))
+        .then((events) => {
+          for (const [event, data] of events) {
+            for (const listener of this.socket.listeners(event)) {
+              listener(data)
+            }
+          }
+        })
+        .catch((err) => console.error('Failed to unpack frame:', err))
+    })
+
     this.socket.on('initial_state', (payload) => {
       console.log('Received initial state for reconnection:', payload)
       // 使用新的 action 来原子化地更新整个 store
       this.store.setInitialState(payload);
+      this.finishSync([])
+    })
+
+    // 重连补发：只包含上次断开后错过的状态事件
+    this.socket.on('sync', (payload) => {
+      console.log(`Resyncing ${payload.events.length} missed events up to version ${payload.version}`)
+      this.finishSync(payload.events)
     })
 
     this.socket.on('game_state_update', (newState) => {
       console.log('Game state updated:', newState)
-      this.store.setGameState(newState)
+      this.receiveVersioned('game_state_update', newState)
+    })
+
+    this.socket.on('state_patch', (patch) => {
+      this.receiveVersioned('state_patch', patch)
     })
 
     this.socket.on('new_message', (newMessage) => {
       console.log('New message received:', newMessage)
-      this.store.addMessage(newMessage)
+      this.receiveVersioned('new_message', newMessage)
     })
     
+    // --- 流式输出：AI / DM 发言的增量片段，结束时由 new_message / dm_message 收尾 ---
+    this.socket.on('message_delta', (delta) => {
+      this.store.appendMessageDelta(delta)
+    })
+
     this.socket.on('dm_message', (newMessage) => {
         console.log('New DM message received:', newMessage)
         this.store.addDmMessage(newMessage)
@@ -74,6 +141,65 @@ class WebsocketService {
     })
   }
 
+  // 带 version 的事件按版本号去重并依次应用；没有 version 的（只发给本连接的）直接应用
+  receiveVersioned(event, data) {
+    if (typeof data?.version === 'number' && this.syncing) {
+      this.pendingEvents.push({ event, data })
+      return
+    }
+    this.applyEvent(event, data)
+  }
+
+  applyEvent(event, data) {
+    if (typeof data?.version === 'number') {
+      if (data.version <= this.store.state_version) return
+      this.store.setStateVersion(data.version)
+    }
+    if (event === 'game_state_update') {
+      this.store.setGameState(data)
+    } else if (event === 'state_patch') {
+      this.store.applyStatePatch(data)
+    } else if (event === 'new_message') {
+      this.store.addMessage(data)
+    }
+  }
+
+  finishSync(events) {
+    for (const { event, data } of events) {
+      this.applyEvent(event, data)
+    }
+    const buffered = this.pendingEvents
+    this.syncing = false
+    this.pendingEvents = []
+    for (const { event, data } of buffered) {
+      this.applyEvent(event, data)
+    }
+  }
+
+  // 拉取当前最早一条消息之前的历史消息，返回是否加载成功
+  fetchOlderMessages(limit = 50) {
+    if (!this.socket || !this.socket.connected || this.store.loading_older_messages) {
+      return Promise.resolve(false)
+    }
+    const oldest = this.store.messages.find(m => typeof m.seq === 'number')
+    if (!oldest) {
+      return Promise.resolve(false)
+    }
+    this.store.loading_older_messages = true
+    return new Promise((resolve) => {
+      this.socket.emit('fetch_messages', { before: oldest.seq, limit }, (response) => {
+        this.store.loading_older_messages = false
+        if (!response || response.error) {
+          console.error('Failed to fetch older messages:', response?.error)
+          resolve(false)
+          return
+        }
+        this.store.prependMessages(response.messages, response.hasMore)
+        resolve(true)
+      })
+    })
+  }
+
   disconnect() {
     if (this.socket) {
       this.socket.disconnect()
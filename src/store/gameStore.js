@@ -7,6 +7,8 @@ export const useGameStore = defineStore('game', {
     typing_players: {}, // 新增：追踪正在输入的玩家
     my_player_id: 'human_player_1',
     is_connected: false,
+    // 已应用的最新状态版本号，重连时发给服务端以便只补发错过的事件
+    state_version: 0,
     
     // 从后端同步的公开游戏信息
     game_state: {
@@ -112,6 +114,9 @@ export const useGameStore = defineStore('game', {
     messages: [
       { id: 1, type: 'system', content: '东方之星号谋杀案，调查开始。', timestamp: new Date() },
     ],
+    // 服务端是否还有更早的历史消息（向上滚动时通过 fetch_messages 分页加载）
+    has_more_messages: false,
+    loading_older_messages: false,
 
     // 与DM的私聊消息
     dm_messages: [
@@ -253,9 +258,9 @@ export const useGameStore = defineStore('game', {
       this.is_connected = status
     },
     setGameState(newState) {
-      // 只合并非空字段，避免服务端空值覆盖已有数据
+      // 只合并非空字段，避免服务端空值覆盖已有数据；version 是事件元数据，不进入 game_state
       const filtered = Object.fromEntries(
-        Object.entries(newState).filter(([, v]) => v !== null && v !== undefined)
+        Object.entries(newState).filter(([k, v]) => k !== 'version' && v !== null && v !== undefined)
       )
 
       // 特殊处理 players 深合并，保持名称 / public_info 等不被覆盖
@@ -277,21 +282,78 @@ export const useGameStore = defineStore('game', {
       }
       this.game_state = { ...this.game_state, ...filtered }
     },
+    // 应用 state_patch 中的增量操作：set 替换字段，merge 合并进字典，append 追加到列表
+    applyStatePatch(patch) {
+      for (const op of patch.ops || []) {
+        if (op.op === 'set') {
+          this.setGameState({ [op.key]: op.value })
+        } else if (op.op === 'merge') {
+          this.game_state[op.key] = { ...(this.game_state[op.key] || {}), ...op.value }
+        } else if (op.op === 'append') {
+          this.game_state[op.key] = [...(this.game_state[op.key] || []), op.value]
+        }
+      }
+    },
+    setStateVersion(version) {
+      if (typeof version === 'number' && version > this.state_version) {
+        this.state_version = version
+      }
+    },
     setMyInfo(newInfo) {
       this.my_info = newInfo
     },
     addMessage(newMessage) {
+      // 流式消息结束：用正式消息替换掉对应的草稿
+      if (newMessage.stream_id) {
+        const index = this.messages.findIndex(m => m.stream_id === newMessage.stream_id)
+        if (index !== -1) {
+          this.messages[index] = { ...this.messages[index], ...newMessage, streaming: false }
+          return
+        }
+      }
       this.messages.push({
         id: Date.now() + Math.random(),
         timestamp: new Date(),
         ...newMessage
       })
     },
+    // 流式输出的增量片段：按 stream_id 追加到草稿消息上，私聊片段进入 dm_messages
+    appendMessageDelta(delta) {
+      const target = delta.type === 'private' ? this.dm_messages : this.messages
+      let draft = target.find(m => m.stream_id === delta.stream_id)
+      if (!draft) {
+        target.push({
+          id: Date.now() + Math.random(),
+          stream_id: delta.stream_id,
+          from_id: delta.from_id,
+          from_name: delta.from_name,
+          type: delta.type,
+          content: '',
+          streaming: true,
+          timestamp: new Date().toISOString()
+        })
+        draft = target[target.length - 1]
+      }
+      draft.content += delta.delta
+    },
     setMessages(messages) {
       this.messages = messages
     },
+    // 向上翻页加载到的更早消息：插到列表开头，按 seq 去重
+    prependMessages(messages, hasMore) {
+      const known = new Set(this.messages.map(m => m.seq).filter(seq => seq !== undefined))
+      this.messages.unshift(...messages.filter(m => !known.has(m.seq)))
+      this.has_more_messages = hasMore
+    },
     // 新增 action
     addDmMessage(newMessage) {
+      if (newMessage.stream_id) {
+        const index = this.dm_messages.findIndex(m => m.stream_id === newMessage.stream_id)
+        if (index !== -1) {
+          this.dm_messages[index] = { ...this.dm_messages[index], ...newMessage, streaming: false }
+          return
+        }
+      }
       this.dm_messages.push({
         id: Date.now() + Math.random(),
         ...newMessage
@@ -312,12 +374,17 @@ export const useGameStore = defineStore('game', {
     },
     // 【新增】处理重连时的完整状态
     setInitialState(payload) {
+      // 完整快照：之后只接受比它更新的事件
+      if (typeof payload.version === 'number') {
+        this.state_version = payload.version;
+      }
       if (payload.gameState) {
         // 使用现有的 setGameState 进行合并，保证逻辑统一
         this.setGameState(payload.gameState);
       }
       if (payload.messages) {
         this.messages = payload.messages;
+        this.has_more_messages = !!payload.hasMoreMessages;
       }
       // 如果有私聊信息，也可以在这里恢复
       if (payload.dm_messages) {